@@ -0,0 +1,114 @@
+import argparse
+import time
+from typing import Callable, Dict, List, Tuple
+
+import torch
+
+from neuralteleportation.export import export_network
+from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
+from neuralteleportation.training.experiment_setup import get_dataset_info, get_model, get_model_names
+
+
+def argument_parser() -> argparse.Namespace:
+    """
+        Simple argument parser for the teleportation micro-benchmarks.
+    """
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the teleportation operations on models of the '
+                                                 'model zoo.')
+    parser.add_argument("--models", "-m", type=str, nargs='+',
+                        default=["MLPCOB", "vgg16_bnCOB", "resnet18COB", "resnet50COB", "densenet121COB"],
+                        choices=get_model_names())
+    parser.add_argument("--dataset", type=str, default="cifar10", choices=["cifar10", "cifar100", "mnist"],
+                        help="Dataset used to initialize the shape of the network")
+    parser.add_argument("--repeats", type=int, default=10, help="Number of timed calls for each operation.")
+    parser.add_argument("--device", type=str, default='cpu', help="Device on which to run the benchmark.")
+    parser.add_argument("--flat_weights", action="store_true",
+                        help="Store the weights of the models in a single contiguous tensor.")
+    parser.add_argument("--batch_size", type=int, default=32,
+                        help="Batch size of the forward passes compared with the exported plain torch network.")
+    parser.add_argument("--graph_backend", type=str, default='jit', choices=["jit", "fx"],
+                        help="Backend used to compute the graph of the models.")
+
+    return parser.parse_args()
+
+
+def time_operation(operation: Callable[[], None], repeats: int = 10) -> float:
+    """
+        Time an operation and return the mean duration of a call.
+
+    Args:
+        operation (Callable): operation to time, called without arguments.
+        repeats (int): number of timed calls.
+
+    Returns:
+        mean time of a call, in milliseconds.
+    """
+    operation()  # Warm-up call
+    start = time.perf_counter()
+    for _ in range(repeats):
+        operation()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def benchmark_teleportation(model: NeuralTeleportationModel, repeats: int = 10) -> Dict[str, float]:
+    """
+        Benchmark the operations that walk the network graph to apply a change of basis.
+
+    Args:
+        model (NeuralTeleportationModel): model to benchmark.
+        repeats (int): number of timed calls for each operation.
+
+    Returns:
+        Dict of the mean time (ms) of a call to each operation.
+    """
+    cob = model.generate_random_cob()
+    weights = model.get_weights().clone()
+    return {"set_change_of_basis": time_operation(lambda: model.set_change_of_basis(cob), repeats),
+            "get_cob": time_operation(lambda: model.get_cob(), repeats),
+            "teleport": time_operation(lambda: model.teleport(cob), repeats),
+            "get_weights": time_operation(lambda: model.get_weights(), repeats),
+            "set_weights": time_operation(lambda: model.set_weights(weights), repeats)}
+
+
+def benchmark_forward(model: NeuralTeleportationModel, input_shape: Tuple, repeats: int = 10) -> Dict[str, float]:
+    """
+        Benchmark the forward pass of a teleported model against the same network exported to plain torch layers.
+
+    Args:
+        model (NeuralTeleportationModel): model to benchmark.
+        input_shape (tuple): shape of the input batch.
+        repeats (int): number of timed calls for each operation.
+
+    Returns:
+        Dict of the mean time (ms) of a forward pass of the teleported model and of the plain network.
+    """
+    model.eval()
+    model.random_teleport()
+    plain_network = export_network(model)
+    param = next(model.parameters())
+    x = torch.rand(input_shape, dtype=param.dtype, device=param.device)
+    return {"forward": time_operation(lambda: model(x), repeats),
+            "plain_forward": time_operation(lambda: plain_network(x), repeats)}
+
+
+if __name__ == '__main__':
+    args = argument_parser()
+
+    input_channels, image_size = get_dataset_info(args.dataset, "input_channels", "image_size").values()
+
+    results: List[Dict] = []
+    for model_name in args.models:
+        model = get_model(args.dataset, model_name, device=args.device, graph_backend=args.graph_backend)
+        if args.flat_weights:
+            model.flatten_weights()
+        with torch.no_grad():
+            timings = benchmark_teleportation(model, repeats=args.repeats)
+            timings.update(benchmark_forward(model, (args.batch_size, input_channels, *image_size),
+                                             repeats=args.repeats))
+        results.append({"model": model_name, "layers": len(model.graph), **timings})
+
+    header = "{:20} {:>8}" + " {:>20}" * (len(results[0]) - 2)
+    row = "{:20} {:>8}" + " {:>20.3f}" * (len(results[0]) - 2)
+    print(header.format(*results[0].keys()))
+    for result in results:
+        print(row.format(*result.values()))
@@ -83,7 +83,7 @@ if __name__ == '__main__':
 
     w1 = model1.get_weights(concat=False, flatten=False, bias=False)
     w2 = model2.get_weights(concat=False, flatten=False, bias=False)
-    calculated_cob = model1.calculate_cob(w1, w2, concat=True, eta=0.00001, steps=6000)
+    calculated_cob = model1.calculate_cob(w1, w2, concat=True)
     torch.save(calculated_cob, pjoin(save_path, 'calculated_cob.pt'))
 
     model1.teleport(calculated_cob)
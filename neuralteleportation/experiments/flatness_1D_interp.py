@@ -12,6 +12,7 @@ from neuralteleportation.training.experiment_setup import get_dataset_subsets, g
 from neuralteleportation.training.config import TrainingMetrics
 from neuralteleportation.losslandscape.losslandscape import LandscapeConfig, generate_1D_linear_interp, plot_interp
 from neuralteleportation.metrics import accuracy
+from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
 from neuralteleportation.utils.pathutils import get_nonexistent_path
 
 
@@ -52,9 +53,26 @@ def argument_parser():
     parser.add_argument("--weightsB", type=str, help="Weights for model B", default=None)
     parser.add_argument("--dataset", type=str, default="cifar10", choices=['mnist', 'cifar10', 'cifar100'])
 
+    # Sharpness params
+    parser.add_argument("--sharpness_k", type=int, default=0,
+                        help="Number of top Hessian eigenvalues to report before and after teleportation (0 to skip)")
+    parser.add_argument("--sharpness_batch_size", type=int, default=128,
+                        help="Size of the training batch on which the Hessian eigenvalues are computed")
+
     return parser.parse_args()
 
 
+def get_sharpness(model: NeuralTeleportationModel, data: torch.Tensor, target: torch.Tensor, k: int) -> list:
+    """
+        Compute the top k eigenvalues of the Hessian of the model's loss on a batch of data.
+    """
+    was_training = model.training
+    model.eval()
+    eigenvalues = model.get_hessian_top_eigenvalues(data, target, nn.CrossEntropyLoss(), k=k)
+    model.train(was_training)
+    return eigenvalues.tolist()
+
+
 if __name__ == '__main__':
     args = argument_parser()
 
@@ -143,6 +161,14 @@ if __name__ == '__main__':
     plot_interp(loss, acc_t, a, acc_val=acc_v, loss_val=loss_v, title='Interpolation between model A and B',
                 savepath=pjoin(save_path, 'interAB.jpg'))
 
+    if args.sharpness_k > 0:
+        sharpness_data, sharpness_target = next(iter(torch.utils.data.DataLoader(
+            trainset, batch_size=args.sharpness_batch_size)))
+        sharpness_data, sharpness_target = sharpness_data.to(device), sharpness_target.to(device)
+        sharpness = {'A': get_sharpness(modelA, sharpness_data, sharpness_target, args.sharpness_k),
+                     'B': get_sharpness(modelB, sharpness_data, sharpness_target, args.sharpness_k)}
+        print("Top Hessian eigenvalues of model A: {}, model B: {}".format(sharpness['A'], sharpness['B']))
+
     # Random teleportation
     if args.teleportA:
         print("Teleport model A")
@@ -163,6 +189,14 @@ if __name__ == '__main__':
     res = test(teleportation_model, valset, metric, configB)
     print("Model B Scored {} acc on valset".format(res['accuracy']))
 
+    if args.sharpness_k > 0:
+        sharpness.update({'TA': get_sharpness(modelA, sharpness_data, sharpness_target, args.sharpness_k),
+                          'TB': get_sharpness(modelB, sharpness_data, sharpness_target, args.sharpness_k)})
+        print("Top Hessian eigenvalues of teleported model A: {}, teleported model B: {}".format(sharpness['TA'],
+                                                                                               sharpness['TB']))
+        with open(pjoin(save_path, 'sharpness.json'), 'w') as f:
+            json.dump(sharpness, f, indent=0)
+
     # interpolate between teleported models
     print("Interpolating between teleported models...")
     param_o = modelA.get_params()
@@ -37,7 +37,8 @@ def make_experiment(out_root: Path):
     return experiment_dir
 
 
-def run_experiment(config_path: Path, out_root: Path, data_root_dir: Path = None, save_weights=False) -> None:
+def run_experiment(config_path: Path, out_root: Path, data_root_dir: Path = None, save_weights=False,
+                   dataset_backend: str = "torchvision") -> None:
     with open(str(config_path), 'r') as stream:
         config = yaml.safe_load(stream)
 
@@ -50,7 +51,7 @@ def run_experiment(config_path: Path, out_root: Path, data_root_dir: Path = None
 
     # datasets
     for dataset_name in config["datasets"]:
-        dataset_kwargs = {}
+        dataset_kwargs = {"backend": dataset_backend}
         if data_root_dir is not None:
             dataset_kwargs.update(root=data_root_dir, download=False)
         train_set, val_set, test_set = get_dataset_subsets(dataset_name, **dataset_kwargs)
@@ -171,6 +172,9 @@ def main():
     parser.add_argument("--out_root_dir", type=Path, default=default_out_root,
                         help="Root directory where the outputs of the training will be stored (e.g. metrics).")
     parser.add_argument("--save_weights", action="store_true")
+    parser.add_argument("--dataset_backend", type=str, default="torchvision", choices=["torchvision", "tensor"],
+                        help="Backend used to load the datasets. The tensor backend decodes the images once in tensor "
+                             "files under the data root directory, and applies the data augmentation on batches.")
     args = parser.parse_args()
 
     # Manage output directory (for metrics)
@@ -180,7 +184,7 @@ def main():
     args.out_root_dir.mkdir(parents=True, exist_ok=True)
 
     run_experiment(args.config, data_root_dir=args.data_root_dir, out_root=args.out_root_dir,
-                   save_weights=args.save_weights)
+                   save_weights=args.save_weights, dataset_backend=args.dataset_backend)
 
 
 if __name__ == '__main__':
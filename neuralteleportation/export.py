@@ -0,0 +1,180 @@
+import copy
+import inspect
+from typing import Union
+
+import torch
+import torch.nn as nn
+
+from neuralteleportation.layers.merge import Add, Concat
+from neuralteleportation.layers.neuralteleportation import NeuralTeleportationLayerMixin, COBForwardMixin
+from neuralteleportation.layers.neuron import BatchNormMixin
+from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
+
+
+class PlainAdd(nn.Module):
+    """Add layer without change of basis, used in exported networks in place of `Add`."""
+
+    def forward(self, input1, input2):
+        return input1 + input2
+
+
+class PlainConcat(nn.Module):
+    """Concatenation layer without change of basis, used in exported networks in place of `Concat`."""
+
+    def forward(self, *args, dim: Union[int, None] = 1):
+        return torch.cat(list(args), dim=dim)
+
+
+def export_network(model: NeuralTeleportationModel) -> nn.Module:
+    """
+        Export the network of a teleported model as a network of plain torch layers with the same outputs.
+
+        The change of basis applied in the forward pass of the activation, pooling, upsampling, batch norm and add
+        layers is folded into the weights of the adjacent neuron layers:
+            - Positive scale invariant layers (ReLU, MaxPool, ...) do not need the change of basis when it is positive.
+              Changes of basis that cannot be removed (e.g. before a Tanh) are reset to ones by teleporting the model.
+            - The residual scalings of Add layers are removed by teleporting the layers before the addition to the
+              change of basis of the residual connection.
+            - The change of basis at the input of batch norm layers is folded into their running statistics.
+
+        The model is not modified. Since the running statistics of batch norm layers are modified, the exported
+        network is meant for inference and is returned in eval mode.
+
+    Args:
+        model (NeuralTeleportationModel): teleported model to export.
+
+    Returns:
+        nn.Module, copy of the model's network where all the change of basis layers are replaced by torch layers.
+    """
+    model = copy.deepcopy(model)
+    model.teleport(_get_foldable_cob(model))
+
+    plain_layers = {}
+    for layer in model.graph:
+        module = layer['module']
+        if isinstance(module, BatchNormMixin):
+            plain_layers[module] = _fold_batch_norm(module, layer['prev_cob'])
+    for module in model.network.modules():
+        if isinstance(module, NeuralTeleportationLayerMixin) and module not in plain_layers:
+            plain_layers[module] = _get_plain_layer(module)
+
+    network = model.network
+    if network in plain_layers:
+        network = plain_layers[network]
+    _swap_plain_layers(network, plain_layers)
+
+    return network.eval()
+
+
+def _get_foldable_cob(model: NeuralTeleportationModel) -> torch.Tensor:
+    """
+        Compute a cob that teleports the model to a function-equivalent model whose change of basis can be folded.
+
+        The position of each element of the cob in the layers' change of basis is found by propagating the indexes
+        of the cob through the teleportation plan. The cob is then modified until no change of basis remains in the
+        forward pass of the layers, other than positive changes of basis before positive scale invariant layers.
+
+    Args:
+        model (NeuralTeleportationModel): teleported model.
+
+    Returns:
+        (torch.Tensor) foldable cob
+    """
+    cob = model.get_cob().clone().double()
+
+    # The input and output ones propagate as ones, which are shifted to the index 0 of fixed elements.
+    indexes = torch.arange(2, len(cob) + 2, dtype=torch.double)
+    layer_indexes = [(None if prev_idx is None else prev_idx.long() - 1, idx.long() - 1)
+                     for prev_idx, idx in model.plan.get_layer_cobs(indexes)]
+    cob_with_fixed = torch.cat([torch.ones(1, dtype=cob.dtype), cob])
+
+    def reset_to_ones(idx: torch.Tensor, mask: torch.Tensor) -> bool:
+        changed = bool(((cob_with_fixed[idx] != 1) & mask).any())
+        cob_with_fixed[idx[mask]] = 1
+        return changed
+
+    changed = True
+    while changed:
+        changed = False
+        for layer_plan, (prev_idx, idx) in zip(model.plan.layers, layer_indexes):
+            module = layer_plan.module
+            if isinstance(module, Add):
+                # The input from the previous layer must have the change of basis of the residual connection.
+                values, prev_values = cob_with_fixed[idx], cob_with_fixed[prev_idx]
+                fixed = (idx == 0) | (prev_idx == 0)
+                changed |= reset_to_ones(idx, fixed & (values != prev_values))
+                changed |= reset_to_ones(prev_idx, fixed & (values != prev_values))
+                mismatch = ~fixed & (cob_with_fixed[idx] != cob_with_fixed[prev_idx])
+                if mismatch.any():
+                    cob_with_fixed[prev_idx[mismatch]] = cob_with_fixed[idx[mismatch]]
+                    changed = True
+            elif isinstance(module, COBForwardMixin) and not isinstance(module, BatchNormMixin):
+                if getattr(module, 'positive_scale_invariant', False):
+                    changed |= reset_to_ones(prev_idx, cob_with_fixed[prev_idx] <= 0)
+                else:
+                    changed |= reset_to_ones(prev_idx, torch.ones_like(prev_idx, dtype=torch.bool))
+
+    return cob_with_fixed[1:]
+
+
+def _fold_batch_norm(module: BatchNormMixin, prev_cob: torch.Tensor) -> nn.Module:
+    """
+        Get a plain batch norm layer equivalent in eval mode to a batch norm layer applied to an input divided by the
+        change of basis of the previous layer.
+
+        The input is normalized by (x / cob - mean) / sqrt(var + eps) = (x - cob * mean) / sqrt(cob^2 (var + eps)),
+        so the change of basis is folded in the running mean and variance, and its sign in the weight.
+
+    Args:
+        module (BatchNormMixin): batch norm change of basis layer.
+        prev_cob (torch.Tensor): change of basis of the previous layer.
+
+    Returns:
+        plain batch norm layer.
+    """
+    plain_layer = _get_plain_layer(module)
+    prev_cob = prev_cob.flatten().type_as(plain_layer.running_mean)
+    with torch.no_grad():
+        plain_layer.running_mean.mul_(prev_cob)
+        plain_layer.running_var.add_(plain_layer.eps).mul_(prev_cob ** 2).sub_(plain_layer.eps)
+        if plain_layer.weight is not None:
+            plain_layer.weight.mul_(prev_cob.sign())
+    return plain_layer
+
+
+def _get_plain_layer(module: NeuralTeleportationLayerMixin) -> nn.Module:
+    """
+        Create the torch layer equivalent to a change of basis layer, with the same parameters and buffers.
+
+    Args:
+        module (NeuralTeleportationLayerMixin): change of basis layer.
+
+    Returns:
+        torch layer.
+    """
+    if isinstance(module, Add):
+        return PlainAdd()
+    if isinstance(module, Concat):
+        return PlainConcat()
+
+    base_layer = module.base_layer()
+    args = inspect.getfullargspec(base_layer.__init__).args
+    params = {k: v for k, v in module.__dict__.items() if k in args}
+    if 'bias' in args:
+        params['bias'] = module.bias is not None
+
+    plain_layer = base_layer(**params)
+    plain_layer.load_state_dict(module.state_dict())
+    return plain_layer.to(next(module.parameters(), torch.empty(0)).device)
+
+
+def _swap_plain_layers(module: nn.Module, plain_layers: dict) -> None:
+    """
+    Recursively iterate over the children of a module and replace the change of basis layers by their plain
+    equivalent. This function operates in-place.
+    """
+    for name, child in module.named_children():
+        if child in plain_layers:
+            module.add_module(name, plain_layers[child])
+        else:
+            _swap_plain_layers(child, plain_layers)
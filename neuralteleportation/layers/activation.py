@@ -7,6 +7,7 @@ from neuralteleportation.layers.neuralteleportation import NeuralTeleportationLa
 
 class ActivationLayerMixin(COBForwardMixin, NeuralTeleportationLayerMixin):
     cob_field = 'cob'
+    positive_scale_invariant = False  # Whether f(c * x) = c * f(x) for all c > 0
 
     def apply_cob(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         self.cob = prev_cob
@@ -14,12 +15,60 @@ class ActivationLayerMixin(COBForwardMixin, NeuralTeleportationLayerMixin):
     def teleport(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         pass
 
-    def _forward(self, input: torch.Tensor) -> torch.Tensor:
-        return self.cob * self.base_layer().forward(self, input / self.cob)
+    def _forward(self, input: torch.Tensor, cob: torch.Tensor) -> torch.Tensor:
+        if self._can_forward_inplace(input):
+            if torch.is_grad_enabled() and input.requires_grad:
+                return _InplaceCOBActivation.apply(input, cob, self)
+            return self._forward_inplace(input, cob)
+        return cob * self.base_layer().forward(self, input / cob)
+
+    def _forward_inplace(self, input: torch.Tensor, cob: torch.Tensor) -> torch.Tensor:
+        return self.base_layer().forward(self, input.div_(cob)).mul_(cob)
+
+    def _can_forward_inplace(self, input: torch.Tensor) -> bool:
+        """
+            Whether the activation can be computed in-place in its input.
+
+            The layer must be inplace and define `_derivative_from_output(output)`, the derivative of the activation
+            computed from its output for the backward pass. Autograd must also allow the input to be modified in-place
+            (i.e. it is not a leaf or a view of a leaf).
+        """
+        if not getattr(self, 'inplace', False) or not hasattr(self, '_derivative_from_output'):
+            return False
+        if not isinstance(input, torch.Tensor) or torch.jit.is_tracing():
+            return False
+        return not input.requires_grad or not (input.is_leaf or input._is_view())
+
+
+class _InplaceCOBActivation(torch.autograd.Function):
+    """
+        Compute cob * f(input / cob) in-place in the input of an inplace activation f.
+
+        Like torch's inplace activations, only the output is saved for the backward pass, so that the activation does
+        not allocate any tensor in the forward pass. The derivative of f at input / cob is computed from
+        f(input / cob) = output / cob.
+    """
+
+    @staticmethod
+    def forward(ctx, input: torch.Tensor, cob: torch.Tensor, layer: ActivationLayerMixin) -> torch.Tensor:
+        layer._forward_inplace(input, cob)
+        ctx.mark_dirty(input)
+        ctx.save_for_backward(input, cob)
+        ctx.layer = layer
+        return input
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        output, cob = ctx.saved_tensors
+        return grad_output * ctx.layer._derivative_from_output(output / cob), None, None
 
 
 class ReLUCOB(ActivationLayerMixin, nn.ReLU):
     reshape_cob = True
+    positive_scale_invariant = True
+
+    def _derivative_from_output(self, output: torch.Tensor) -> torch.Tensor:
+        return (output > 0).type_as(output)
 
 
 class TanhCOB(ActivationLayerMixin, nn.Tanh):
@@ -32,11 +81,19 @@ class SigmoidCOB(ActivationLayerMixin, nn.Sigmoid):
 
 class IdentityCOB(ActivationLayerMixin, nn.Identity):
     reshape_cob = True
+    positive_scale_invariant = True
 
 
 class LeakyReLUCOB(ActivationLayerMixin, nn.LeakyReLU):
     reshape_cob = True
+    positive_scale_invariant = True
+
+    def _derivative_from_output(self, output: torch.Tensor) -> torch.Tensor:
+        return (output > 0).type_as(output).mul_(1 - self.negative_slope).add_(self.negative_slope)
 
 
 class ELUCOB(ActivationLayerMixin, nn.ELU):
     reshape_cob = True
+
+    def _derivative_from_output(self, output: torch.Tensor) -> torch.Tensor:
+        return torch.where(output > 0, torch.ones_like(output), output + self.alpha)
@@ -1,4 +1,4 @@
-from typing import Union
+from typing import Tuple, Union
 
 import numpy as np
 import torch
@@ -7,6 +7,81 @@ import torch.nn as nn
 from neuralteleportation.layers.neuralteleportation import NeuralTeleportationLayerMixin
 
 
+class SharedConcatStorage:
+    """Preallocated storage shared by the concatenation layers of a dense block.
+
+    In a dense block, the input of every layer is the concatenation of the features of all the previous layers, which
+    are a prefix of the final concatenated features. The features are written once in a slice of a single storage
+    and the concatenations are views of the storage, instead of being copied again at every layer.
+
+    The change of basis of each channel is fixed for the whole block, so the features are divided by the cob of their
+    channels when they are written in the storage. The batch norm layers that read the storage then use the views
+    directly, instead of copying them to undo the change of basis.
+
+    Args:
+        num_features (int): number of channels of the concatenation of all the features.
+    """
+
+    def __init__(self, num_features: int):
+        self.num_features = num_features
+        self.storage = None
+        self.inputs = []
+        self.offset = 0
+
+    def concat(self, inputs: Tuple[torch.Tensor, ...], cob: torch.Tensor = None) -> torch.Tensor:
+        """Concatenate features along the channels by writing them in the storage, without their change of basis.
+
+        Args:
+            inputs (Tuple[torch.Tensor, ...]): features to concatenate. The features must start with the features of
+                                              the previous call, unless they start a new forward pass.
+            cob (torch.Tensor): change of basis of the concatenated channels, of shape [channels, 1, ...], or None if
+                                it is all ones.
+
+        Returns:
+            view of the storage containing the concatenated features divided by the cob.
+        """
+        if not self.inputs or len(inputs) < len(self.inputs) or any(x is not y for x, y in zip(inputs, self.inputs)):
+            # New forward pass: a new storage is allocated since the previous one can still be used by autograd
+            first = inputs[0]
+            self.storage = first.new_empty((first.shape[0], self.num_features) + first.shape[2:])
+            self.inputs = []
+            self.offset = 0
+
+        with torch.no_grad():
+            for input in inputs[len(self.inputs):]:
+                # Written through .data, so that the views of the storage saved by autograd are not invalidated
+                features = self.storage.data[:, self.offset:self.offset + input.shape[1]]
+                if cob is None:
+                    features.copy_(input)
+                else:
+                    torch.div(input, cob[self.offset:self.offset + input.shape[1]], out=features)
+                self.offset += input.shape[1]
+        self.inputs = list(inputs)
+
+        output = _SharedConcat.apply(self.storage[:, :self.offset], cob, *inputs)
+        if self.offset == self.num_features:
+            # The last concatenation of the block, the features are not needed anymore
+            self.inputs = []
+        return output
+
+
+class _SharedConcat(torch.autograd.Function):
+    """Concatenation whose output is a view of a storage in which the inputs were written, divided by their cob."""
+
+    @staticmethod
+    def forward(ctx, output: torch.Tensor, cob: torch.Tensor, *inputs: torch.Tensor) -> torch.Tensor:
+        ctx.sizes = [input.shape[1] for input in inputs]
+        ctx.cob = cob
+        return output.view_as(output)
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        grads = grad_output.split(ctx.sizes, dim=1)
+        if ctx.cob is not None:
+            grads = tuple(grad / cob for grad, cob in zip(grads, ctx.cob.split(ctx.sizes)))
+        return (None, None) + tuple(grads)
+
+
 class Concat(NeuralTeleportationLayerMixin, nn.Module):
     """Implementation of concatenation layer for teleportation that wraps torch.cat.
 
@@ -22,15 +97,31 @@ class Concat(NeuralTeleportationLayerMixin, nn.Module):
                 x2 = layer2(x1) #Computed second
 
                 x3 = self.Concat(x1, x2) # x1 comes before x2.
+
+    Args:
+        shared_storage (SharedConcatStorage): storage shared with other concatenation layers, in which the inputs are
+                                              concatenated along the channels during training.
+        output_without_cob (bool): if true, the output read from the shared storage is not multiplied back by the cob,
+                                   which must then be undone by the next layer (e.g. a batch norm layer reading from
+                                   the same shared storage).
     """
 
+    def __init__(self, shared_storage: SharedConcatStorage = None, output_without_cob: bool = False):
+        super().__init__()
+        self.shared_storage = shared_storage
+        self.output_without_cob = output_without_cob
+
     def apply_cob(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
-        pass
+        self.cob = next_cob
 
     def teleport(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         pass
 
     def forward(self, *args, dim: Union[int, None] = 1):
+        if self.shared_storage is not None and self.training and dim == 1:
+            cob = None if self.cob is None else self.get_cob_buffer('cob_buffer', self.cob, args[0], skip_ones=True)
+            output = self.shared_storage.concat(args, cob)
+            return output if cob is None or self.output_without_cob else output * cob
         return torch.cat(list(args), dim=dim)
 
 
@@ -49,23 +140,22 @@ class Add(NeuralTeleportationLayerMixin, nn.Module):
 
                 x3 = Add(x1, x2) # x1 comes before x2.
     """
+    cob_ratio: torch.Tensor = None
+
     def apply_cob(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         self.prev_cob = prev_cob
         self.next_cob = next_cob
 
+        # The ratio is precomputed so that the forward pass is a single multiply-add, or a plain add without ratio
+        cob_ratio = (next_cob / prev_cob).detach()
+        self.cob_ratio = None if bool((cob_ratio == 1).all()) else cob_ratio
+
     def teleport(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         pass
 
     def forward(self, input1, input2):
-        if self.prev_cob is None:
-            self.prev_cob = torch.ones(input2.shape[1])
-        if self.next_cob is None:
-            self.next_cob = torch.ones(input2.shape[1])
-
-        cob1_shape = (input2.shape[1],) + tuple([1 for _ in range(input2.dim() - 2)])
-        self.prev_cob = self.prev_cob.view(cob1_shape).float().type_as(input1)
-
-        next_cob_shape = (input2.shape[1],) + tuple([1 for _ in range(input2.dim() - 2)])
-        self.next_cob = self.next_cob.view(next_cob_shape).float().type_as(input1)
+        if self.cob_ratio is None:
+            return torch.add(input1, input2)
 
-        return torch.add(input1, self.next_cob * input2 / self.prev_cob)
+        cob_ratio = self.get_cob_buffer('cob_ratio_buffer', self.cob_ratio, input2)
+        return torch.addcmul(input1, input2, cob_ratio)
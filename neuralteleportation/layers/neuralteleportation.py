@@ -17,23 +17,66 @@ class NeuralTeleportationLayerMixin(object):
     def apply_cob(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         raise NotImplemented
 
+    def get_cob_buffer(self, name: str, cob: torch.Tensor, input: torch.Tensor, sign: bool = False,
+                       skip_ones: bool = False) -> torch.Tensor:
+        """Get a change of basis reshaped to broadcast over the channels of the input, on its device and in its dtype.
+
+        The reshaped cob is cached in a non-persistent buffer of the module, so that it follows the module when it is
+        moved to another device or dtype. It is only rebuilt when the cob is changed (e.g. by `apply_cob`) or when it
+        does not match the input.
+
+        Args:
+            name: name of the buffer.
+            cob: change of basis, of shape [channels].
+            input: input of the layer, of shape [batch, channels, ...].
+            sign: if true, the buffer contains the sign of the cob.
+            skip_ones: if true, the buffer is None when it only contains ones, so that the cob can be skipped.
+
+        Returns:
+            cob (or its sign) of shape [channels, 1, ...] that broadcasts over the input.
+        """
+        buffer = self._buffers.get(name)
+        sources = self.__dict__.setdefault('_cob_buffer_sources', {})
+        source = sources.get(name)
+        if source is None or source[0] is not cob or source[1] != cob._version or (buffer is not None and (
+                buffer.dim() != input.dim() - 1 or buffer.dtype != input.dtype or buffer.device != input.device)):
+            cob_shape = (-1,) + (1,) * (input.dim() - 2)
+            buffer = cob.detach().sign() if sign else cob.detach()
+            if skip_ones and bool((buffer == 1).all()):
+                buffer = None
+            if buffer is not None:
+                buffer = buffer.reshape(cob_shape).to(device=input.device, dtype=input.dtype)
+            if name in self._buffers:
+                self._buffers[name] = buffer
+            else:
+                self.register_buffer(name, buffer, persistent=False)
+            sources[name] = (cob, cob._version)
+        return buffer
+
 
 class COBForwardMixin(object):
     cob_field: str
     reshape_cob: bool
 
     def forward(self, input: torch.Tensor) -> torch.Tensor:
-        if getattr(self, self.cob_field) is None:
-            setattr(self, self.cob_field, torch.ones(input.shape[1]))
-
-        if self.reshape_cob:
-            cob_shape = (input.shape[1],) + tuple([1 for _ in range(input.dim() - 2)])
-            cob_view = getattr(self, self.cob_field).view(cob_shape).float().type_as(input).detach()
-            setattr(self, self.cob_field, cob_view)
-
-        return self._forward(input)
-
-    def _forward(self, input: torch.Tensor) -> torch.Tensor:
+        cob = getattr(self, self.cob_field)
+        if cob is None:
+            cob = torch.ones(input.shape[1])
+            setattr(self, self.cob_field, cob)
+
+        if self.reshape_cob and getattr(self, 'positive_scale_invariant', False):
+            # cob * f(input / cob) = sign * f(input / sign), so only the sign of the cob is needed, if any
+            cob = self.get_cob_buffer(self.cob_field + '_sign_buffer', cob, input, sign=True, skip_ones=True)
+            if cob is None:
+                return self.base_layer().forward(self, input)
+        elif self.reshape_cob:
+            cob = self.get_cob_buffer(self.cob_field + '_buffer', cob, input, skip_ones=True)
+            if cob is None:
+                return self.base_layer().forward(self, input)
+
+        return self._forward(input, cob)
+
+    def _forward(self, input: torch.Tensor, cob: torch.Tensor) -> torch.Tensor:
         raise NotImplementedError
 
 
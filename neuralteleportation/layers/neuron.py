@@ -4,7 +4,8 @@ import numpy as np
 import torch
 import warnings
 import torch.nn as nn
-from tqdm import tqdm
+import torch.nn.functional as F
+from torch.func import functional_call, grad, vmap
 
 from neuralteleportation.changeofbasisutils import get_random_cob
 from neuralteleportation.layers.neuralteleportation import NeuralTeleportationLayerMixin, COBForwardMixin
@@ -14,11 +15,6 @@ class NeuronLayerMixin(NeuralTeleportationLayerMixin):
     in_features: int
     out_features: int
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self._set_proxy_weights()
-
     def _set_proxy_weights(self):
         """
             Create new tensor for weights and bias to allow gradient to be computed with respect to cob.
@@ -58,6 +54,14 @@ class NeuronLayerMixin(NeuralTeleportationLayerMixin):
         """
         return torch.ones(self.in_features)
 
+    def get_weight_names(self) -> Tuple[str, ...]:
+        """Get the names of the tensors of the layer, in the order in which they are returned by `get_weights`.
+
+        Returns:
+            tuple of tensor names.
+        """
+        return ('weight', 'bias') if self.bias is not None else ('weight',)
+
     def get_nb_params(self) -> int:
         """Get the number of parameters in the layer (weight and bias).
 
@@ -105,34 +109,91 @@ class NeuronLayerMixin(NeuralTeleportationLayerMixin):
     def set_weights(self, weights: torch.Tensor):
         """Set weights for the layer.
 
+        The weights are copied in place to keep the same parameters, so that optimizers stay attached to the layer.
+
         Args:
             weights: weights to apply to the model.
         """
         counter = 0
         w_shape = self.weight.shape
-        w_nb_params = np.prod(w_shape)
-        self.w = weights[counter:counter + w_nb_params].reshape(w_shape)
-        self.weight = torch.nn.Parameter(self.w, requires_grad=True)
-        counter += w_nb_params
+        w_nb_params = int(np.prod(w_shape))
+        with torch.no_grad():
+            self.weight.copy_(weights[counter:counter + w_nb_params].reshape(w_shape))
+            counter += w_nb_params
 
-        if self.bias is not None:
-            b_shape = self.bias.shape
-            b_nb_params = np.prod(b_shape)
-            self.b = weights[counter:counter + b_nb_params].reshape(b_shape)
-            self.bias = torch.nn.Parameter(self.b, requires_grad=True)
+            if self.bias is not None:
+                b_shape = self.bias.shape
+                b_nb_params = int(np.prod(b_shape))
+                self.bias.copy_(weights[counter:counter + b_nb_params].reshape(b_shape))
 
     def teleport(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
-        self.w = self.weight * self._get_cob_weight_factor(prev_cob, next_cob).type_as(self.weight)
-        # This helps avoid a crash due to self.w not being a leaf variable,
-        # meaning it is not at the begining of the graph and 
-        # was created from an operation on other tensors (self.weight here).
-        self.w = self.w.clone().detach().requires_grad_()
-        self.weight = nn.Parameter(self.w, requires_grad=True)
+        """Teleport the weights of the layer in place.
+
+        The parameters are scaled in place, so that optimizers stay attached to the layer.
+
+        Args:
+            prev_cob: change of basis of the previous layer.
+            next_cob: change of basis of the following layer.
+        """
+        with torch.no_grad():
+            for weight, factor in zip((self.weight, self.bias), self.get_weight_factors(prev_cob, next_cob)):
+                weight.mul_(factor)
+
+    def get_weight_factors(self, prev_cob: torch.Tensor, next_cob: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        """Get the factors by which the weight and bias of the layer are scaled when it is teleported.
+
+        Args:
+            prev_cob: change of basis of the previous layer.
+            next_cob: change of basis of the following layer.
+
+        Returns:
+            tuple of factors that broadcast with the weight and bias tensors.
+        """
+        factors = (self._get_cob_weight_factor(prev_cob, next_cob).type_as(self.weight),)
         if self.bias is not None:
-            self.b = self.bias * next_cob.type_as(self.bias)
-            # Same as self.w
-            self.b = self.b.clone().detach().requires_grad_()
-            self.bias = torch.nn.Parameter(self.b, requires_grad=True)
+            factors += (next_cob.type_as(self.bias),)
+        return factors
+
+    def get_teleported_weights(self, prev_cob: torch.Tensor, next_cob: torch.Tensor,
+                               bias: bool = True) -> Tuple[torch.Tensor, ...]:
+        """Get the weights of the layer teleported with a batch of changes of basis, without modifying the layer.
+
+        Args:
+            prev_cob: batch of changes of basis of the previous layer, of shape [K, in_features].
+            next_cob: batch of changes of basis of the following layer, of shape [K, out_features].
+            bias: if true, the bias is included.
+
+        Returns:
+            tuple of teleported weight tensors, each of shape [K, *parameter_shape].
+        """
+        weights = (self.weight * self._get_cob_weight_factor(prev_cob, next_cob).type_as(self.weight),)
+        if self.bias is not None and bias:
+            weights += (self.bias * next_cob.type_as(self.bias),)
+        return weights
+
+    def get_per_sample_grad(self, input: torch.Tensor, grad_output: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        """Compute the gradient of the loss of each sample with respect to the weights of the layer.
+
+        The gradients are computed from the input of the layer and the gradient of the loss with respect to its output,
+        which are available after a single forward and backward pass over the batch. This generic implementation
+        differentiates the forward pass of the layer on each sample (vectorized with `torch.func.vmap`). Layers
+        override it with a closed form where one exists.
+
+        Args:
+            input: input of the layer for the batch.
+            grad_output: gradient of the loss of each sample with respect to the output of the layer.
+
+        Returns:
+            tuple of per-sample gradient tensors, each of shape [B, *parameter_shape], in the order of `get_grad`.
+        """
+        params = {name: getattr(self, name).detach() for name in ('weight', 'bias') if getattr(self, name) is not None}
+
+        def sample_output_product(params, input, grad_output):
+            output = functional_call(self, params, (input.unsqueeze(0),))
+            return (output * grad_output.unsqueeze(0)).sum()
+
+        grads = vmap(grad(sample_output_product), in_dims=(None, 0, 0))(params, input, grad_output)
+        return tuple(grads[name] for name in params)
 
     def apply_cob(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         pass
@@ -140,6 +201,9 @@ class NeuronLayerMixin(NeuralTeleportationLayerMixin):
     def _get_cob_weight_factor(self, prev_cob: torch.Tensor, next_cob: torch.Tensor) -> torch.Tensor:
         """Computes the factor to apply to the weights of the current layer to perform a change of basis.
 
+        The changes of basis can have leading batch dimensions, in which case the factors have the same leading
+        batch dimensions.
+
         Args:
             prev_cob: change of basis of the previous layer.
             next_cob: change of basis of the following layer.
@@ -149,14 +213,37 @@ class NeuronLayerMixin(NeuralTeleportationLayerMixin):
         """
         raise NotImplementedError
 
-    @staticmethod
-    def calculate_cob(initial_weights, target_weights, prev_cob, ) -> torch.Tensor:
+    def _sum_per_output_channel(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Sum a tensor with the shape of the weights of the layer over all dimensions but the output channels."""
+        return tensor.reshape(len(tensor), -1).sum(dim=1)
+
+    def _sum_per_input_channel(self, tensor: torch.Tensor, in_channels: int) -> torch.Tensor:
+        """Sum a tensor with the shape of the weights of the layer over all dimensions but the input channels.
+
+        The number of input channels can be smaller than the number of input features (e.g. a linear layer after a
+        convolution), in which case the features of each input channel are summed together.
+        """
+        return tensor.transpose(0, 1).reshape(in_channels, -1).sum(dim=1)
+
+    def _get_input_scaled_weights(self, weights: torch.Tensor, prev_cob: torch.Tensor) -> torch.Tensor:
+        """Apply the change of basis of the previous layer to weights of the layer, with an output cob of ones."""
+        weights = weights.detach()
+        prev_cob = prev_cob.to(weights)
+        return weights * self._get_cob_weight_factor(prev_cob, self.get_output_cob().to(weights))
+
+    def calculate_cob(self, initial_weights, target_weights, prev_cob) -> torch.Tensor:
         """
         Compute the cob to teleport from the initial_weights to the target_weights.
         Using the closed form solution to:
 
                     min_T ||T(initial_weights) - target_weights||
 
+        The problem is separable per output channel, so the cob of all the channels is computed at once:
+
+                    t = <w, target_weights> / <w, w>
+
+        where w are the initial weights with the change of basis of the previous layer applied.
+
         Args:
             initial_weights (torch.Tensor): initial weights on which teleportation is applied
             target_weights (torch.Tensor): target weigths to obtain with teleportation.
@@ -166,106 +253,98 @@ class NeuronLayerMixin(NeuralTeleportationLayerMixin):
             torch.Tensor, calculated cob
 
         """
-        raise NotImplementedError
+        weights = self._get_input_scaled_weights(initial_weights, prev_cob)
+        return self._sum_per_output_channel(weights * target_weights.detach()) / \
+            self._sum_per_output_channel(weights * weights)
 
-    @staticmethod
-    def calculate_last_cob(initial_weights1, initial_weights2,
-                           target_weights1, target_weights2, prev_cob, eta, steps) -> torch.Tensor:
+    def calculate_last_cob(self, initial_weights1, target_weights1, initial_weights2, target_weights2, prev_cob,
+                           steps, next_layer: 'NeuronLayerMixin' = None) -> torch.Tensor:
         """
         Compute the cob to teleport from the initial_weights to the target_weight for the last cob considering that the
         output cob is always ones.
 
         prev_cob -- w1 --> cob -- w2 --> ones
 
+        The cob of all the channels is computed at once. For each channel, the loss
+
+            ||t * w1 - w1_hat||^2 + ||w2 / t - w2_hat||^2
+
+        is minimal where its derivative is zero, i.e. at a root of the quartic
+
+            (w1.w1) t^4 - (w1.w1_hat) t^3 + (w2.w2_hat) t - w2.w2 = 0.
+
+        The real roots of the quartics are computed as the eigenvalues of their companion matrices, refined with Newton
+        iterations, and the root with the lowest loss is kept for each channel.
+
         Args:
             initial_weights1 (torch.Tensor): layer n-1 initial weights on which teleportation is applied
-            initial_weights2 (torch.Tensor): layer n initial weights on which teleportation is applied
             target_weights1 (torch.Tensor): layer n-1 target weigths to obtain with teleportation.
+            initial_weights2 (torch.Tensor): layer n initial weights on which teleportation is applied
             target_weights2 (torch.Tensor): layer n target weigths to obtain with teleportation.
             prev_cob (torch.Tensor): Change of basis from the previous layer
-            eta (float): learning rate for the gradient descent
-            steps (int): number of gradient descent steps
+            steps (int): maximum number of Newton iterations to refine the roots
+            next_layer (NeuronLayerMixin): layer n, defaults to a layer of the same type as layer n-1.
 
         Returns:
-            torch.Tensor, calculated cob
+            torch.Tensor, calculated cob, or None if the calculation failed.
 
         """
-        raise NotImplementedError
+        next_layer = self if next_layer is None else next_layer
+
+        w1 = self._get_input_scaled_weights(initial_weights1, prev_cob).double()
+        w1_hat = target_weights1.detach().double()
+        w2 = initial_weights2.detach().double()  # Output cob is ones
+        w2_hat = target_weights2.detach().double()
+
+        a = self._sum_per_output_channel(w1 * w1)
+        b = self._sum_per_output_channel(w1 * w1_hat)
+        c = next_layer._sum_per_input_channel(w2 * w2, self.out_features)
+        d = next_layer._sum_per_input_channel(w2 * w2_hat, self.out_features)
+
+        # Companion matrices of the monic quartics t^4 - b/a t^3 + d/a t - c/a
+        companion = torch.zeros(len(a), 4, 4, dtype=a.dtype, device=a.device)
+        companion[:, 0, 0] = b / a
+        companion[:, 0, 2] = -d / a
+        companion[:, 0, 3] = c / a
+        companion[:, 1:, :3] = torch.eye(3, dtype=a.dtype, device=a.device)
+        roots = torch.linalg.eigvals(companion)
+
+        # Keep the (almost) real roots and refine them with Newton iterations on the quartic
+        t = torch.where(roots.imag.abs() <= 1e-6 * roots.abs(), roots.real, torch.full_like(roots.real, np.nan))
+        a, b, c, d = a[:, None], b[:, None], c[:, None], d[:, None]
+        for step in range(steps):
+            update = (a * t ** 4 - b * t ** 3 + d * t - c) / (4 * a * t ** 3 - 3 * b * t ** 2 + d)
+            t = t - update
+            if not torch.any(update.abs() > 1e-12 * t.abs()):
+                break
+
+        loss = a * t ** 2 - 2 * b * t + c / t ** 2 - 2 * d / t
+        loss[torch.isnan(loss)] = np.inf
+        t = t.gather(1, loss.argmin(dim=1, keepdim=True)).squeeze(1)
+
+        if torch.isnan(t).any() or torch.isinf(t).any():
+            warnings.warn("Calculating last cob failed. Calculated cob value is nan.")
+            return None
+
+        return t.type_as(initial_weights1)
 
 
 class LinearCOB(NeuronLayerMixin, nn.Linear):
 
-    def teleport(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
-        if len(prev_cob) != self.in_features:  # if previous layer is Conv2D, duplicate cob for each feature map.
-            feature_map_size = self.in_features // len(prev_cob)  # size of feature maps
-            cob = []
-            for i, c in enumerate(prev_cob):
-                cob.append(c.repeat(feature_map_size))
-            prev_cob = torch.cat(cob, dim=0)
-
-        super().teleport(prev_cob, next_cob)
-
     def _get_cob_weight_factor(self, prev_cob: torch.Tensor, next_cob: torch.Tensor) -> torch.Tensor:
-        return next_cob[..., None] / prev_cob[None, ...]
-
-    @staticmethod
-    def calculate_cob(weights, target_weights, prev_cob) -> torch.Tensor:
-        """
-        Compute the cob to teleport from the current weights to the target_weights
-        """
-        cob = []
-        prev_cob = prev_cob.type_as(weights)
-        for (wi, wi_hat) in zip(weights, target_weights):
-            ti = (wi / prev_cob).dot(wi_hat) / (wi / prev_cob).dot(wi / prev_cob)
-            cob.append(ti)
-
-        return torch.tensor(cob)
+        if prev_cob.shape[-1] != self.in_features:  # if previous layer is Conv2D, duplicate cob for each feature map.
+            feature_map_size = self.in_features // prev_cob.shape[-1]  # size of feature maps
+            prev_cob = prev_cob.repeat_interleave(feature_map_size, dim=-1)
 
-    @staticmethod
-    def calculate_last_cob(initial_weights1, target_weights1,
-                           initial_weights2, target_weights2, prev_cob, eta, steps) -> torch.Tensor:
-        t = []
-        t0 = prev_cob.type_as(initial_weights1)
-        t2 = torch.ones(target_weights2.shape[0]).type_as(initial_weights1)
+        return next_cob[..., :, None] / prev_cob[..., None, :]
 
-        for i in tqdm(range(initial_weights1.shape[0])):
-            w0 = initial_weights1[i, :]
-            w0_hat = target_weights1[i, :]
-            w1 = initial_weights2[:, i]
-            w1_hat = target_weights2[:, i]
-
-            ti = torch.tensor(1.0)
-
-            grads = []
-
-            for step in range(steps):
-                grad = (2 * ti * (w0 / t0).dot(w0 / t0) -
-                        2 * (w0 / t0).dot(w0_hat) -
-                        2 * torch.pow(ti, -3) * (w1 * t2).dot(w1 * t2) +
-                        2 * torch.pow(ti, -2) * (w1 * t2).dot(w1_hat))
-                ti = ti - eta * grad.item()
-
-                if torch.isnan(ti).any():
-                    warnings.warn("Calculating last cob failed. Calculated cob value is nan.")
-                    return None
-
-                """ Uncomment to debug"""
-                # loss = (ti * (w0 / t0) - w0_hat).dot(ti * (w0 / t0) - w0_hat) + \
-                #        (torch.pow(ti, -1) * (w1 * t2) - w1_hat).dot(torch.pow(ti, -1) * (w1 * t2) - w1_hat)
-                # if np.mod(st, 400) == -1:
-                #    print("step ", step, "loss : ", loss)
-
-                # grads.append(grad.detach().item())
-
-            """ Uncomment to debug the gradient descent. """
-            # plt.figure()
-            # plt.title("{}".format(i))
-            # plt.plot(grads)
-            # plt.show()
-
-            t.append(ti)
-
-        return torch.tensor(t)
+    def get_per_sample_grad(self, input: torch.Tensor, grad_output: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        input = input.reshape(input.shape[0], -1, self.in_features)
+        grad_output = grad_output.reshape(grad_output.shape[0], -1, self.out_features)
+        grads = (torch.einsum('bno,bni->boi', grad_output, input),)
+        if self.bias is not None:
+            grads += (grad_output.sum(dim=1),)
+        return grads
 
 
 class ConvMixin(NeuronLayerMixin):
@@ -279,17 +358,36 @@ class ConvMixin(NeuronLayerMixin):
 class Conv2dCOB(ConvMixin, nn.Conv2d):
 
     def _get_cob_weight_factor(self, prev_cob: torch.Tensor, next_cob: torch.Tensor) -> torch.Tensor:
-        return (next_cob[..., None] / prev_cob[None, ...])[..., None, None]
+        return (next_cob[..., :, None] / prev_cob[..., None, :])[..., None, None]
+
+    def get_per_sample_grad(self, input: torch.Tensor, grad_output: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        if self.groups != 1 or self.padding_mode != 'zeros':
+            return super().get_per_sample_grad(input, grad_output)
+
+        # Each output position is the dot product of the weights with a patch of the input
+        patches = F.unfold(input, self.kernel_size, dilation=self.dilation, padding=self.padding, stride=self.stride)
+        grad_output = grad_output.flatten(start_dim=2)
+        grads = (torch.einsum('bol,bil->boi', grad_output, patches).reshape(-1, *self.weight.shape),)
+        if self.bias is not None:
+            grads += (grad_output.sum(dim=2),)
+        return grads
 
 
 class ConvTranspose2dCOB(ConvMixin, nn.ConvTranspose2d):
 
     def _get_cob_weight_factor(self, prev_cob: torch.Tensor, next_cob: torch.Tensor) -> torch.Tensor:
-        return (next_cob[None, ...] / prev_cob[..., None])[..., None, None]
+        return (next_cob[..., None, :] / prev_cob[..., :, None])[..., None, None]
+
+    def _sum_per_output_channel(self, tensor: torch.Tensor) -> torch.Tensor:
+        return tensor.transpose(0, 1).reshape(self.out_channels, -1).sum(dim=1)
+
+    def _sum_per_input_channel(self, tensor: torch.Tensor, in_channels: int) -> torch.Tensor:
+        return tensor.reshape(in_channels, -1).sum(dim=1)
 
 
 class BatchNormMixin(COBForwardMixin, NeuronLayerMixin):
     cob_field = 'prev_cob'
+    input_without_cob = False  # Whether the change of basis of the input is undone before this layer in training
 
     def __init__(self, num_features: int):
         super().__init__(num_features)
@@ -305,8 +403,44 @@ class BatchNormMixin(COBForwardMixin, NeuronLayerMixin):
     def _get_cob_weight_factor(self, prev_cob: np.ndarray, next_cob: np.ndarray) -> np.ndarray:
         return next_cob
 
-    def _forward(self, input: torch.Tensor) -> torch.Tensor:
-        return self.base_layer().forward(self, input / self.prev_cob)
+    def _forward(self, input: torch.Tensor, prev_cob: torch.Tensor) -> torch.Tensor:
+        if self.input_without_cob and self.training:
+            return self.base_layer().forward(self, input)
+        return self.base_layer().forward(self, input / prev_cob)
+
+    def _sum_per_input_channel(self, tensor: torch.Tensor, in_channels: int) -> torch.Tensor:
+        # The weights do not depend on the change of basis of the previous layer, which is applied in the forward pass
+        return tensor.new_zeros(in_channels)
+
+    def get_teleported_weights(self, prev_cob: torch.Tensor, next_cob: torch.Tensor,
+                               bias: bool = True) -> Tuple[torch.Tensor, ...]:
+        """Get the weights of the layer teleported with a batch of changes of basis, without modifying the layer.
+
+        The running statistics are not affected by the change of basis, but are included to match `get_weights`.
+        """
+        weights = super().get_teleported_weights(prev_cob, next_cob, bias=bias)
+        batch_shape = next_cob.shape[:-1]
+        return weights + (self.running_mean.expand(*batch_shape, -1), self.running_var.expand(*batch_shape, -1))
+
+    def get_weight_names(self) -> Tuple[str, ...]:
+        return super().get_weight_names() + ('running_mean', 'running_var')
+
+    def get_per_sample_grad(self, input: torch.Tensor, grad_output: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        if self.training:
+            raise ValueError("Per-sample gradients of batch norm layers are only defined in eval mode, where the "
+                             "samples are normalized independently.")
+
+        shape = (1, -1) + (1,) * (input.dim() - 2)
+        prev_cob = self.get_cob_buffer(self.cob_field + '_buffer', self.prev_cob, input, skip_ones=True)
+        if prev_cob is not None:
+            input = input / prev_cob
+        normalized_input = (input - self.running_mean.reshape(shape)) / \
+            torch.sqrt(self.running_var.reshape(shape) + self.eps)
+        sum_dims = tuple(range(2, input.dim()))
+        grads = ((grad_output * normalized_input).sum(dim=sum_dims),)
+        if self.bias is not None:
+            grads += (grad_output.sum(dim=sum_dims),)
+        return grads
 
     def get_nb_params(self) -> int:
         """Get the number of parameters in the layer (weight and bias).
@@ -363,29 +497,25 @@ class BatchNormMixin(COBForwardMixin, NeuronLayerMixin):
         """
         counter = 0
         w_shape = self.weight.shape
-        w_nb_params = np.prod(w_shape)
-        self.w = weights[counter:counter + w_nb_params].reshape(w_shape)
-        self.weight = torch.nn.Parameter(self.w, requires_grad=True)
-        counter += w_nb_params
-
-        if self.bias is not None:
-            b_shape = self.bias.shape
-            b_nb_params = np.prod(b_shape)
-            self.b = weights[counter:counter + b_nb_params].reshape(b_shape)
-            self.bias = torch.nn.Parameter(self.b, requires_grad=True)
-            counter += b_nb_params
-
-        m_shape = self.running_mean.shape
-        m_nb_params = np.prod(m_shape)
-        m = weights[counter:counter + m_nb_params].reshape(m_shape).type_as(self.running_mean).detach()
-        self.register_buffer('running_mean', m)
-        counter += m_nb_params
-
-
-        v_shape = self.running_var.shape
-        v_nb_params = np.prod(v_shape)
-        v = weights[counter:counter + v_nb_params].reshape(v_shape).type_as(self.running_var).detach()
-        self.register_buffer('running_var', v)
+        w_nb_params = int(np.prod(w_shape))
+        with torch.no_grad():
+            self.weight.copy_(weights[counter:counter + w_nb_params].reshape(w_shape))
+            counter += w_nb_params
+
+            if self.bias is not None:
+                b_shape = self.bias.shape
+                b_nb_params = int(np.prod(b_shape))
+                self.bias.copy_(weights[counter:counter + b_nb_params].reshape(b_shape))
+                counter += b_nb_params
+
+            m_shape = self.running_mean.shape
+            m_nb_params = int(np.prod(m_shape))
+            self.running_mean.copy_(weights[counter:counter + m_nb_params].reshape(m_shape))
+            counter += m_nb_params
+
+            v_shape = self.running_var.shape
+            v_nb_params = int(np.prod(v_shape))
+            self.running_var.copy_(weights[counter:counter + v_nb_params].reshape(v_shape))
 
 
 class BatchNorm2dCOB(BatchNormMixin, nn.BatchNorm2d):
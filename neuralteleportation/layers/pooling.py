@@ -8,11 +8,12 @@ from neuralteleportation.layers.neuralteleportation import NeuralTeleportationLa
 class MaxPool2dCOB(COBForwardMixin, NeuralTeleportationLayerMixin, nn.MaxPool2d):
     """Wrapper for the MaxPool2d change of basis layer.
 
-    Max pooling is positive scale invariant. It is necessary to un-apply and re-apply the change of basis for the
-    operation.
+    Max pooling is positive scale invariant. Only the sign of the change of basis needs to be un-applied and
+    re-applied for the operation, and nothing is done when the change of basis is positive.
     """
     cob_field = 'cob'
     reshape_cob = True
+    positive_scale_invariant = True
 
     def apply_cob(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         self.cob = prev_cob
@@ -20,8 +21,8 @@ class MaxPool2dCOB(COBForwardMixin, NeuralTeleportationLayerMixin, nn.MaxPool2d)
     def teleport(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         pass
 
-    def _forward(self, input: torch.Tensor) -> torch.Tensor:
-        return self.cob * self.base_layer().forward(self, input / self.cob)
+    def _forward(self, input: torch.Tensor, cob: torch.Tensor) -> torch.Tensor:
+        return cob * self.base_layer().forward(self, input / cob)
 
 
 class AdaptiveAvgPool2dCOB(NeuralTeleportationLayerMixin, nn.AdaptiveAvgPool2d):
@@ -53,11 +54,12 @@ class AvgPool2dCOB(NeuralTeleportationLayerMixin, nn.AvgPool2d):
 class UpsampleCOB(COBForwardMixin, NeuralTeleportationLayerMixin, nn.Upsample):
     """Wrapper for the Upsample change of basis layer.
 
-    Upsampling is positive scale invariant. It is necessary to un-apply and re-apply the change of basis for the
-    opperation.
+    Upsampling is positive scale invariant. Only the sign of the change of basis needs to be un-applied and
+    re-applied for the opperation, and nothing is done when the change of basis is positive.
     """
     cob_field = 'cob'
     reshape_cob = True
+    positive_scale_invariant = True
 
     def apply_cob(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         self.cob = prev_cob
@@ -65,5 +67,5 @@ class UpsampleCOB(COBForwardMixin, NeuralTeleportationLayerMixin, nn.Upsample):
     def teleport(self, prev_cob: torch.Tensor, next_cob: torch.Tensor):
         pass
 
-    def _forward(self, input: torch.Tensor) -> torch.Tensor:
-        return self.cob * self.base_layer().forward(self, input / self.cob)
+    def _forward(self, input: torch.Tensor, cob: torch.Tensor) -> torch.Tensor:
+        return cob * self.base_layer().forward(self, input / cob)
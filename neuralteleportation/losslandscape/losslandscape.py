@@ -10,7 +10,9 @@ from torch.utils.data.dataset import Dataset
 
 from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
 from neuralteleportation.training.config import TrainingConfig, TrainingMetrics
-from neuralteleportation.training.experiment_setup import get_optimizer_from_model_and_config
+from neuralteleportation.training.experiment_setup import (
+    get_optimizer_from_model_and_config, get_dataloader_from_dataset_and_config,
+)
 from neuralteleportation.training.training import test, train_epoch
 
 
@@ -99,7 +101,7 @@ def generate_teleportation_training_weights(model: NeuralTeleportationModel,
         If teleport_every is different than 0, the model will teleport every time.
     """
     w = [model.get_weights().clone().detach().cpu()]
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=config.batch_size, drop_last=True)
+    trainloader = get_dataloader_from_dataset_and_config(trainset, config, shuffle=False, drop_last=True)
     optim = get_optimizer_from_model_and_config(model, config)
 
     for e in range(config.epochs):
@@ -1,3 +1,5 @@
+from typing import Dict, Union
+
 import torch
 
 
@@ -10,16 +12,15 @@ def accuracy_topk(output, target, topk=1):
         topk: int, k top predictions to compare
 
     Returns:
-        float, accuracy
+        torch.Tensor, accuracy as a scalar tensor on the device of the output
     """
     with torch.no_grad():
         batch_size = target.size(0)
         _, pred = output.topk(topk, 1, True, True)
         pred = pred.t()
         correct = pred.eq(target.view(1, -1).expand_as(pred))
-        correct = correct[:topk].view(-1).float().sum(0)
-        acc = correct / batch_size
-        return acc.item()
+        correct = correct[:topk].reshape(-1).float().sum(0)
+        return correct / batch_size
 
 
 def accuracy(output, target):
@@ -28,3 +29,52 @@ def accuracy(output, target):
 
 def accuracy_top5(output, target):
     return accuracy_topk(output, target, topk=5)
+
+
+class MetricsAccumulator:
+    """
+        Running sums of the values of metrics over batches, weighted by the number of samples in each batch.
+
+        Tensor values are summed in tensors on their device, so accumulating the metrics of a batch does not wait for
+        the device to finish computing them. The host only synchronizes with the device when the means are read by
+        `compute`.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.count = 0
+
+    def update(self, values: Dict[str, Union[torch.Tensor, float]], batch_size: int) -> None:
+        """
+            Add the values of the metrics of a batch to the running sums.
+
+        Args:
+            values (Dict[str, Union[torch.Tensor, float]]): mean value of each metric over the batch.
+            batch_size (int): number of samples in the batch.
+        """
+        for name, value in values.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach().float() * batch_size
+            else:
+                value = value * batch_size
+            self.sums[name] = value if name not in self.sums else self.sums[name] + value
+        self.count += batch_size
+
+    def compute(self) -> Dict[str, float]:
+        """
+            Get the mean of each metric over the accumulated samples, with a single synchronization per device.
+
+        Returns:
+            Dict of the mean value of each metric.
+        """
+        means = {name: value / self.count for name, value in self.sums.items() if not isinstance(value, torch.Tensor)}
+
+        tensor_names = {}
+        for name, value in self.sums.items():
+            if isinstance(value, torch.Tensor):
+                tensor_names.setdefault(value.device, []).append(name)
+        for names in tensor_names.values():
+            values = torch.stack([self.sums[name] for name in names]).div_(self.count).tolist()
+            means.update(zip(names, values))
+
+        return {name: means[name] for name in self.sums}
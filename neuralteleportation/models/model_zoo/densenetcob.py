@@ -14,7 +14,7 @@ from torch.hub import load_state_dict_from_url
 from torch.jit.annotations import List
 
 from neuralteleportation.layers.activation import ReLUCOB
-from neuralteleportation.layers.merge import Concat
+from neuralteleportation.layers.merge import Concat, SharedConcatStorage
 from neuralteleportation.layers.neuralteleportation import FlattenCOB
 from neuralteleportation.layers.dropout import DropoutCOB
 from neuralteleportation.layers.neuron import BatchNorm2dCOB, LinearCOB, Conv2dCOB
@@ -31,7 +31,8 @@ model_urls = {
 
 
 class _DenseLayerCOB(nn.Module):
-    def __init__(self, num_input_features, growth_rate, bn_size, drop_rate, memory_efficient=False):
+    def __init__(self, num_input_features, growth_rate, bn_size, drop_rate, memory_efficient=False,
+                 shared_storage=None):
         super(_DenseLayerCOB, self).__init__()
         self.add_module('norm1', BatchNorm2dCOB(num_input_features)),
         self.add_module('relu1', ReLUCOB(inplace=True)),
@@ -45,8 +46,10 @@ class _DenseLayerCOB(nn.Module):
                                            bias=False)),
         self.drop_rate = float(drop_rate)
         self.memory_efficient = memory_efficient
-        self.concat = Concat()
+        self.concat = Concat(shared_storage, output_without_cob=True)
         self.dropout = DropoutCOB(self.drop_rate)
+        # The features are written in the shared storage without their cob, so the batch norm does not undo it
+        self.norm1.input_without_cob = shared_storage is not None
 
     def bn_function(self, inputs):
         # type: (List[Tensor]) -> Tensor
@@ -58,7 +61,7 @@ class _DenseLayerCOB(nn.Module):
     def any_requires_grad(self, input):
         # type: (List[Tensor]) -> bool
         for tensor in input:
-            if tensor.requires_grad:
+            if isinstance(tensor, Tensor) and tensor.requires_grad:
                 return True
         return False
 
@@ -66,9 +69,9 @@ class _DenseLayerCOB(nn.Module):
     def call_checkpoint_bottleneck(self, input):
         # type: (List[Tensor]) -> Tensor
         def closure(*inputs):
-            return self.bn_function(*inputs)
+            return self.bn_function(inputs)
 
-        return cp.checkpoint(closure, input)
+        return cp.checkpoint(closure, *input)
 
     @torch.jit._overload_method  # noqa: F811
     def forward(self, input):
@@ -88,7 +91,7 @@ class _DenseLayerCOB(nn.Module):
         else:
             prev_features = input
 
-        if self.memory_efficient and self.any_requires_grad(prev_features):
+        if self.memory_efficient and self.any_requires_grad(prev_features) and not torch.jit.is_tracing():
             if torch.jit.is_scripting():
                 raise Exception("Memory Efficient not supported in JIT")
 
@@ -105,8 +108,10 @@ class _DenseLayerCOB(nn.Module):
 class _DenseBlockCOB(nn.ModuleDict):
     _version = 2
 
-    def __init__(self, num_layers, num_input_features, bn_size, growth_rate, drop_rate, memory_efficient=False):
+    def __init__(self, num_layers, num_input_features, bn_size, growth_rate, drop_rate, memory_efficient=False,
+                 shared_storage=False):
         super(_DenseBlockCOB, self).__init__()
+        storage = SharedConcatStorage(num_input_features + num_layers * growth_rate) if shared_storage else None
         for i in range(num_layers):
             layer = _DenseLayerCOB(
                 num_input_features + i * growth_rate,
@@ -114,9 +119,10 @@ class _DenseBlockCOB(nn.ModuleDict):
                 bn_size=bn_size,
                 drop_rate=drop_rate,
                 memory_efficient=memory_efficient,
+                shared_storage=storage,
             )
             self.add_module('denselayer%d' % (i + 1), layer)
-        self.concat = Concat()
+        self.concat = Concat(storage)
 
     def forward(self, init_features):
         features = [init_features]
@@ -151,11 +157,13 @@ class DenseNetCOB(nn.Module):
         num_classes (int) - number of classification classes
         memory_efficient (bool) - If True, uses checkpointing. Much more memory efficient,
           but slower. Default: *False*. See `"paper" <https://arxiv.org/pdf/1707.06990.pdf>`_
+        shared_storage (bool) - If True, the features of each dense block are concatenated in a single
+          preallocated storage during training, instead of being copied again by every dense layer. Default: *False*.
     """
 
     def __init__(self, growth_rate, block_config, num_init_features,
                  num_classes, bn_size=4, drop_rate=0, input_channels=3,
-                 memory_efficient=False):
+                 memory_efficient=False, shared_storage=False):
 
         super(DenseNetCOB, self).__init__()                     
         # First convolution
@@ -176,7 +184,8 @@ class DenseNetCOB(nn.Module):
                 bn_size=bn_size,
                 growth_rate=growth_rate,
                 drop_rate=drop_rate,
-                memory_efficient=memory_efficient
+                memory_efficient=memory_efficient,
+                shared_storage=shared_storage
             )
             self.features.add_module('denseblock%d' % (i + 1), block)
             num_features = num_features + num_layers * growth_rate
@@ -1,5 +1,11 @@
+import hashlib
+import inspect
+import json
+import os
 from _collections import defaultdict
-from typing import Dict
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Union
 
 import torch
 import torch.nn as nn
@@ -12,36 +18,87 @@ class NetworkGrapher:
         This class computes the graph of a given network using torch.jit.
         The graph is essential for teleporting networks containing residual and dense layers.
 
+        Two backends are available to compute the graph:
+            - 'jit': the network is run on the sample input and traced with torch.jit.
+            - 'fx': the network is traced symbolically with torch.fx, without running it. The cost of building the
+                    graph does not depend on the input size, and no sample input is required.
+
+        The structure of the graph is cached in memory, and optionally on disk, keyed by the signature of the network's
+        architecture and the input shape. Networks with the same architecture then reuse the graph without tracing.
+
     Args:
         network (nn.Module): network to be graphed.
-        sample_input (torch.Tensor): Sample input for the network. (Required for  torch.jit.Trace(.))
+        sample_input (torch.Tensor): Sample input for the network. (Required for  torch.jit.Trace(.), can be None
+                                     with the 'fx' backend)
+        cache_dir (str): directory in which the graphs are cached on disk. If None, `NetworkGrapher.cache_dir` is
+                         used, and the graphs are only cached in memory if it is also None.
+        use_cache (bool): if false, the graph is always computed from the network.
+        backend (str): backend used to compute the graph, 'jit' or 'fx'.
     """
 
-    def __init__(self, network: nn.Module, sample_input: torch.Tensor):
+    backends = ('jit', 'fx')
+
+    # Default directory of the disk cache, shared by all the graphers.
+    cache_dir: str = None
+
+    # In-memory cache of the graph structures, shared by all the graphers.
+    _cache: Dict[str, List[Dict]] = {}
+
+    def __init__(self, network: nn.Module, sample_input: torch.Tensor = None, cache_dir: str = None,
+                 use_cache: bool = True, backend: str = 'jit'):
+        if backend not in self.backends:
+            raise ValueError("Unknown graph backend {}, expected one of {}".format(backend, self.backends))
+        if backend == 'jit' and sample_input is None:
+            raise ValueError("A sample input is required to compute the graph with the 'jit' backend.")
+
         self.network = network
         self.sample_input = sample_input
-        self.ordered_layers = self.get_ordered_layers()
-        self.graph = self.get_graph()
+        self.backend = backend
+        if cache_dir is not None:
+            self.cache_dir = cache_dir
+
+        graph = self._load_graph() if use_cache else None
+        if graph is None:
+            if backend == 'fx':
+                graph = self.get_graph_from_symbolic_trace()
+                self.ordered_layers = [layer['module'] for layer in graph]
+            else:
+                self.ordered_layers = self.get_ordered_layers()
+                graph = self.get_graph()
+            if use_cache:
+                self._save_graph(graph)
+        else:
+            self.ordered_layers = [layer['module'] for layer in graph]
+        self.graph = graph
 
-    def get_ordered_layers(self):
+    @staticmethod
+    def get_layers(model: nn.Module) -> List[nn.Module]:
         """
-            Get layer from self.network in the order of the forward pass.
+            Get the leaf modules of a network, in the order in which they are registered.
+
+        Args:
+            model (nn.Module): network.
 
         Returns:
             List of nn.Modules
         """
+        layers = []
+        for layer in model.children():
+            if len(list(layer.children())) > 0:
+                layers.extend(NetworkGrapher.get_layers(layer))
+            else:
+                layers.append(layer)
 
-        def get_layers(model):
-            layers = []
-            for layer in model.children():
-                if len(list(layer.children())) > 0:
-                    layers.extend(get_layers(layer))
-                else:
-                    layers.append(layer)
+        return layers
 
-            return layers
+    def get_ordered_layers(self):
+        """
+            Get layer from self.network in the order of the forward pass.
 
-        all_layers = get_layers(self.network)
+        Returns:
+            List of nn.Modules
+        """
+        all_layers = self.get_layers(self.network)
 
         ordered_layers = []
 
@@ -59,6 +116,95 @@ class NetworkGrapher:
 
         return ordered_layers
 
+    def get_cache_key(self) -> str:
+        """
+            Get the signature of the network's architecture and the input shape, used as key of the graph cache.
+
+            The signature contains the class of the network, which defines the forward pass, the representation
+            of the network, which contains the class and the hyperparameters of every module, and the public
+            attributes of the modules that are not in their representation (e.g. flags used in the forward pass). It
+            also contains the source code of the classes of the modules (except torch's, identified by the version of
+            torch), so that the cached graph is not used after the forward pass of a module is edited.
+
+        Returns:
+            hexadecimal digest of the signature.
+        """
+        network_class = type(self.network)
+        input_shape = None if self.sample_input is None else tuple(self.sample_input.shape)
+        attributes = [sorted((k, v) for k, v in vars(module).items()
+                             if not k.startswith('_') and k != 'training' and
+                             isinstance(v, (bool, int, float, str, tuple, type(None))))
+                      for module in self.network.modules()]
+        sources = sorted({_get_class_source_digest(cls) for module in self.network.modules()
+                          for cls in type(module).__mro__ if not cls.__module__.startswith(('torch', 'builtins'))})
+        signature = "{}.{}\n{!r}\n{!r}\n{}\n{}\n{}\n{}".format(network_class.__module__, network_class.__qualname__,
+                                                                self.network, attributes, input_shape, self.backend,
+                                                                sources, torch.__version__)
+        return hashlib.sha1(signature.encode()).hexdigest()
+
+    def _get_cache_path(self, key: str) -> Union[str, None]:
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, "{}.json".format(key))
+
+    def _load_graph(self) -> Union[List[Dict], None]:
+        """
+            Load the graph of the network from the cache.
+
+        Returns:
+            network graph, or None if the graph is not in the cache.
+        """
+        key = self.get_cache_key()
+        structure = self._cache.get(key)
+
+        path = self._get_cache_path(key)
+        if structure is None and path is not None and os.path.isfile(path):
+            with open(path) as f:
+                structure = json.load(f)
+            self._cache[key] = structure
+
+        if structure is None:
+            return None
+
+        # The modules are stored by their position in the registered leaf modules of the network
+        layers = self.get_layers(self.network)
+        if any(not 0 <= layer['module'] < len(layers) for layer in structure):
+            return None
+        return [{'idx': layer['idx'], 'out': list(layer['out']), 'module': layers[layer['module']],
+                 'in': list(layer['in'])} for layer in structure]
+
+    def _save_graph(self, graph: List[Dict]) -> None:
+        """
+            Save the structure of the graph of the network in the cache.
+
+        Args:
+            graph (List[Dict]): network graph.
+        """
+        positions = {module: i for i, module in enumerate(self.get_layers(self.network))}
+        if any(layer['module'] not in positions for layer in graph):
+            return
+
+        structure = [{'idx': layer['idx'], 'out': list(layer['out']), 'module': positions[layer['module']],
+                      'in': list(layer['in'])} for layer in graph]
+        key = self.get_cache_key()
+        self._cache[key] = structure
+
+        path = self._get_cache_path(key)
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a temporary file first so that concurrent runs never read a partial file
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(structure, f)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        """
+            Clear the in-memory graph cache. The graphs cached on disk are kept.
+        """
+        cls._cache.clear()
+
     @staticmethod
     def get_graph_from_trace(trace):
         """
@@ -109,6 +255,46 @@ class NetworkGrapher:
 
         return graph
 
+    def get_graph_from_symbolic_trace(self):
+        """
+            Use torch.fx to get the graph of the network, without running the network.
+
+            The leaf modules of the network are kept as single nodes of the symbolic trace. The inputs of a layer are
+            the layers whose outputs reach it, directly or through operations that are not modules (e.g. getattr).
+
+        Returns:
+            network graph : [{'in': [], 'idx': [], 'out' = [], 'module' nn.Module}, ... ]
+        """
+        import torch.fx
+
+        class LeafModuleTracer(torch.fx.Tracer):
+            def is_leaf_module(self, m: nn.Module, module_qualified_name: str) -> bool:
+                return len(list(m.children())) == 0
+
+        trace = LeafModuleTracer().trace(self.network)
+        modules = dict(self.network.named_modules())
+
+        graph = []
+        sources = {}  # Indexes of the layers whose outputs reach each node of the trace
+        for node in trace.nodes:
+            node_sources = set()
+            for input_node in node.all_input_nodes:
+                node_sources.update(sources[input_node])
+
+            if node.op == 'call_module':
+                idx = len(graph)
+                for i in node_sources:
+                    graph[i]['out'].append(idx)
+                graph.append({'idx': idx, 'out': [], 'module': modules[node.target], 'in': sorted(node_sources)})
+                node_sources = {idx}
+
+            sources[node] = node_sources
+
+        if len(set(layer['module'] for layer in graph)) != len(graph):
+            raise ValueError("Same layer was used more than once!")
+
+        return graph
+
     @staticmethod
     def extract_pytorch_graph(inlined_graph) -> Dict:
         """
@@ -124,18 +310,31 @@ class NetworkGrapher:
         layers = defaultdict(lambda: defaultdict(list))
 
         for i, node in enumerate(inlined_graph.nodes()):
+            if node.kind() == 'prim::Constant':
+                continue
             layers[node.scopeName()]['in'].extend([i.unique() for i in node.inputs()])
             layers[node.scopeName()]['out'].extend([i.unique() for i in node.outputs()])
 
         # Remove indexes that are both in input and output
         for k in layers.keys():
-            for i in layers[k]['out'][:]:
-                if i in layers[k]['in']:
-                    # print(i)
-                    layers[k]['out'].remove(i)
-                    layers[k]['in'].remove(i)
+            in_counts = Counter(layers[k]['in'])
+            removed = Counter()
+            outputs = []
+            for i in layers[k]['out']:
+                if removed[i] < in_counts[i]:
+                    removed[i] += 1
+                else:
+                    outputs.append(i)
+            inputs = []
+            for i in layers[k]['in']:
+                if removed[i] > 0:
+                    removed[i] -= 1
+                else:
+                    inputs.append(i)
 
             layers[k] = dict(layers[k])
+            layers[k]['in'] = inputs
+            layers[k]['out'] = outputs
 
             # Remove duplicates in list
             layers[k]['in'] = list(set(layers[k]['in']))
@@ -150,9 +349,9 @@ class NetworkGrapher:
         """
 
         # Get all output indexes
-        layer_outputs = []
+        layer_outputs = set()
         for k in layers.keys():
-            layer_outputs.extend(layers[k]['out'])
+            layer_outputs.update(layers[k]['out'])
 
         # Remove inputs if not in layer_outputs
         for k in layers.keys():
@@ -167,9 +366,9 @@ class NetworkGrapher:
         """
 
         # Get all input indexes
-        layer_inputs = []
-        for i, k in enumerate(layers.keys()):
-            layer_inputs.extend(layers[k]['in'])
+        layer_inputs = set()
+        for k in layers.keys():
+            layer_inputs.update(layers[k]['in'])
 
         # Remove inputs if not in layer_outputs
         for k in layers.keys():
@@ -224,24 +423,18 @@ class NetworkGrapher:
         Returns:
             list of dicts representing the model graph
         """
-        new_layers = []
-
-        for i, k in enumerate(layers):
-            outputs = []
-            for j, q in enumerate(layers):
-                if i in layers[q]['in']:
-                    outputs.append(j)
+        new_layers = [{'idx': i, 'out': [], 'module': module_list[i]} for i in range(len(layers))]
 
-            new_layers.append({'idx': i,
-                               'out': outputs,
-                               'module': module_list[i]})
+        for j, q in enumerate(layers):
+            for i in sorted(set(layers[q]['in'])):
+                if 0 <= i < len(new_layers):
+                    new_layers[i]['out'].append(j)
 
-        for i, k in enumerate(new_layers):
-            inputs = []
-            for j, q in enumerate(new_layers):
-                if i in new_layers[j]['out']:
-                    inputs.append(j)
-            new_layers[i]['in'] = inputs
+        for layer in new_layers:
+            layer['in'] = []
+        for j, layer in enumerate(new_layers):
+            for i in layer['out']:
+                new_layers[i]['in'].append(j)
 
         return new_layers
 
@@ -299,6 +492,16 @@ class NetworkGrapher:
                            ))
 
 
+@lru_cache(maxsize=None)
+def _get_class_source_digest(cls: type) -> str:
+    """Get the digest of the source code of a class, or of its name if the source is not available."""
+    try:
+        source = inspect.getsource(cls)
+    except (OSError, TypeError):
+        source = "{}.{}".format(cls.__module__, cls.__qualname__)
+    return hashlib.sha1(source.encode()).hexdigest()
+
+
 if __name__ == '__main__':
     from torchsummary import summary
     from neuralteleportation.models.generic_models.residual_models import ResidualNet2
@@ -314,3 +517,4 @@ if __name__ == '__main__':
     grapher.print_graph()
 
     grapher.plot()
+
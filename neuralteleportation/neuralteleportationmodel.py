@@ -1,13 +1,13 @@
-from typing import Tuple, Callable, Union, List
+from typing import Tuple, Callable, Union, List, Iterable, Dict
 
 import numpy as np
 import torch
 import torch.nn as nn
 
 from neuralteleportation.changeofbasisutils import get_random_cob
-from neuralteleportation.layers.neuron import NeuronLayerMixin
-from neuralteleportation.network_graph import NetworkGrapher
 from neuralteleportation.layers.merge import Add, Concat
+from neuralteleportation.network_graph import NetworkGrapher
+from neuralteleportation.teleportation_plan import TeleportationPlan
 
 
 class NeuralTeleportationModel(nn.Module):
@@ -17,24 +17,40 @@ class NeuralTeleportationModel(nn.Module):
     Args:
         network (nn.Module):  Network to be wrapped for teleportation.
         input_shape (tuple): input shape used to compute the network graph.
+        flat_weights (bool): if true, the weights of the neuron layers are stored in a single contiguous tensor
+                             (see `flatten_weights`).
+        graph_cache_dir (str): directory in which the network graph is cached on disk (see `NetworkGrapher`).
+        graph_backend (str): backend used to compute the network graph, 'jit' to trace a forward pass on a sample
+                             input or 'fx' to trace the network symbolically without running it.
     """
 
-    def __init__(self, network: nn.Module, input_shape: Tuple) -> None:
+    def __init__(self, network: nn.Module, input_shape: Tuple, flat_weights: bool = False,
+                 graph_cache_dir: str = None, graph_backend: str = 'jit') -> None:
         super(NeuralTeleportationModel, self).__init__()
         self.network = network
 
-        device = next(self.network.parameters()).device
-        sample_input = torch.rand(input_shape).to(device)
+        sample_input = None
+        if graph_backend != 'fx':
+            param = next(self.network.parameters())
+            sample_input = torch.rand(input_shape, dtype=param.dtype, device=param.device)
 
         was_training = self.training
         self.eval()
-        self.grapher = NetworkGrapher(network, sample_input)
-        self.graph = self.grapher.get_graph()
+        self.grapher = NetworkGrapher(network, sample_input, cache_dir=graph_cache_dir, backend=graph_backend)
+        self.graph = self.grapher.graph
         if was_training:
             self.train()
 
+        self.plan = TeleportationPlan(self.graph)
+
         self.initialize_cob()
 
+        self._flat_weights = None
+        self._flat_weights_ptrs = None
+        self._hessian_eigenvectors = None
+        if flat_weights:
+            self.flatten_weights()
+
     def forward(self, x):
         return self.network(x)
 
@@ -45,11 +61,7 @@ class NeuralTeleportationModel(nn.Module):
         Returns:
             (int) cob size
         """
-        size = 0
-        neuron_layers = self.get_neuron_layers()
-        for i in range(len(neuron_layers) - 1):
-            size += neuron_layers[i].out_features
-        return size
+        return self.plan.cob_size
 
     def initialize_cob(self) -> None:
         """ Set the cob to ones. """
@@ -76,7 +88,7 @@ class NeuralTeleportationModel(nn.Module):
             Undo the current teleportation.
         """
         # Undo teleportation for weights
-        self.teleport_weights(1 / self.get_cob())
+        self.teleport_weights(self._cob_sign * torch.exp(-self._log_cob))
         # Set cob for activations to 1.
         self.initialize_cob()
 
@@ -103,18 +115,69 @@ class NeuralTeleportationModel(nn.Module):
             neural teleportation model after teleportation
         """
         if reset_teleportation:
-            self.undo_teleportation()
-            self.teleport_weights(cob)
+            # Teleport the weights directly from the current cob to the new cob
+            self.teleport_weights(self._get_cob_ratio(cob))
             self.teleport_activations(cob)
         else:
-            previous_cob = self.get_cob()
             # Teleport weights
             self.teleport_weights(cob)
-            # Set activation cob to product of previous cobs and new cob
-            self.teleport_activations(previous_cob * cob)
+            # Set activation cob to product of previous cobs and new cob, accumulated in log space
+            log_cob = self._log_cob + torch.log(torch.abs(cob.detach())).to(self._log_cob)
+            cob_sign = self._cob_sign * torch.sign(cob.detach()).to(self._cob_sign)
+            self.teleport_activations(cob_sign * torch.exp(log_cob))
+            self._log_cob = log_cob
 
         return self
 
+    def _get_cob_ratio(self, cob: torch.Tensor) -> torch.Tensor:
+        """
+            Get the cob that teleports the network from its current cob to the given cob.
+
+            The teleportation factors are separable, so undoing the current cob and applying the new cob is equivalent
+            to applying the ratio of the cobs. The ratio is computed in log space from the tracked current cob.
+
+        Args:
+            cob (torch.Tensor): cob to teleport the network, with optional leading batch dimensions
+
+        Returns:
+            (torch.Tensor) ratio between the cob and the current cob
+        """
+        log_cob = torch.log(torch.abs(cob)).to(self._log_cob)
+        cob_sign = torch.sign(cob).to(self._cob_sign)
+        return (cob_sign * self._cob_sign * torch.exp(log_cob - self._log_cob)).to(cob.device)
+
+    def get_teleported_weights(self, cobs: torch.Tensor, concat: bool = True, bias: bool = True,
+                               reset_teleportation: bool = True) -> Union[torch.Tensor, List[torch.Tensor]]:
+        """
+            Get the weights of the network teleported with each cob of a batch, without modifying the network.
+
+            The teleported weights of all the cobs are computed in a single pass over the layers, by broadcasting the
+            weights of each layer with the batch of cobs.
+
+        Args:
+            cobs (torch.Tensor): batch of cobs to teleport the network, of shape [K, cob_size]
+            concat (bool): if true weights are returned as a concatenated tensor of shape [K, nb_params],
+                            else as a list of tensors of shape [K, *parameter_shape] in the order of `get_weights`
+            bias (bool): if true bias is included
+            reset_teleportation (bool): if true, the teleportations are applied from the network before its current
+                                        teleportation, as with `teleport`.
+
+        Returns:
+            torch.Tensor or list containing the teleported weights for each cob
+        """
+        if reset_teleportation:
+            cobs = self._get_cob_ratio(cobs)
+
+        w = []
+        for layer_plan, (prev_cob, next_cob) in zip(self.plan.layers, self.plan.get_layer_cobs(cobs)):
+            if layer_plan.is_neuron:
+                w.extend(layer_plan.module.get_teleported_weights(prev_cob, next_cob, bias=bias))
+
+        if concat:
+            return torch.cat([weights.flatten(start_dim=1) for weights in w], dim=1)
+        else:
+            return w
+
     def teleport_weights(self, cob: torch.Tensor):
         """
             Teleport the network weights with the cob.
@@ -124,11 +187,34 @@ class NeuralTeleportationModel(nn.Module):
         for k, layer in enumerate(self.graph):
             layer['module'].teleport(prev_cob=layer['prev_cob'], next_cob=layer['cob'])
 
+    def get_weight_factors(self, cob: torch.Tensor) -> Dict[nn.Parameter, torch.Tensor]:
+        """
+            Get the factors by which the parameters of the neuron layers are scaled when teleporting the weights with
+            the cob (c.f. `teleport_weights`), without modifying the network.
+
+        Args:
+            cob (torch.Tensor): cob to teleport the network weights.
+
+        Returns:
+            Dict of the factor that broadcasts with each parameter.
+        """
+        factors = {}
+        for layer_plan, (prev_cob, next_cob) in zip(self.plan.layers, self.plan.get_layer_cobs(cob)):
+            if layer_plan.is_neuron:
+                module = layer_plan.module
+                factors.update(zip((module.weight, module.bias), module.get_weight_factors(prev_cob, next_cob)))
+        return factors
+
     def teleport_activations(self, cob: torch.Tensor):
         """
             Teleport the network activations and non-weight layers with the cob.
+
+            The cob is also tracked in log space (log of the absolute value and sign), to compute the ratio between
+            cobs without accumulating round-off errors over repeated teleportations.
         """
         self.set_change_of_basis(cob)
+        self._log_cob = torch.log(torch.abs(cob.detach())).double()
+        self._cob_sign = torch.sign(cob.detach()).double()
 
         for k, layer in enumerate(self.graph):
             layer['module'].apply_cob(prev_cob=layer['prev_cob'], next_cob=layer['cob'])
@@ -141,64 +227,9 @@ class NeuralTeleportationModel(nn.Module):
             cob (torch.Tensor): change of basis to be applied to the model.
             contains_ones (bool): whether the cob contains input and output ones.
         """
-
-        counter = 0
-        current_cob = None  # Cob for last neuron layer to be applied following to non-neuron layers ie. Activations
-
-        for i, layer in enumerate(self.graph):
-            if isinstance(layer['module'], NeuronLayerMixin):
-                # Check if this is the last neuron layer
-                if not np.array([isinstance(l['module'], NeuronLayerMixin) for l in self.graph[i + 1:]]).any():
-                    if contains_ones:
-                        current_cob = cob[counter: counter + layer['module'].out_features]
-                        assert torch.all(current_cob == 1), "Output layer cob values must be all ones."
-                        counter += layer['module'].out_features
-                    else:
-                        current_cob = layer['module'].get_output_cob()
-
-                # Check if this is the first neuron layer
-                elif not np.array([isinstance(l['module'], NeuronLayerMixin) for l in self.graph[:i]]).any():
-                    if contains_ones:
-                        initial_cob = cob[counter: counter + layer['module'].in_features]
-                        assert torch.all(current_cob == 1), "Input layer cob values must be all ones."
-                        counter += layer['module'].in_features
-                    else:
-                        initial_cob = layer['module'].get_input_cob()
-                    layer['prev_cob'] = initial_cob
-
-                    # Apply change of basis for all previous layers.
-                    for l in self.graph[:i]:
-                        l['prev_cob'] = initial_cob
-                        l['cob'] = initial_cob
-
-                    current_cob = cob[counter: counter + layer['module'].out_features]
-                    counter += layer['module'].out_features
-                else:
-                    current_cob = cob[counter: counter + layer['module'].out_features]
-                    counter += layer['module'].out_features
-
-            if isinstance(layer['module'], Add):
-                connection_layer_index = min(layer['in'])  # Get the first layer
-
-                if not np.array([isinstance(l['module'], NeuronLayerMixin) for l in self.graph[i + 1:]]).any():
-                    '''If there is no layer after, previous layer must be ones. '''
-                    raise ValueError("NOT SUPPORTED YET: Must have neuron layer after residual connection")
-
-                current_cob = self.graph[connection_layer_index]['cob']
-
-            if isinstance(layer['module'], Concat):
-                '''If the layer is concatenation the change of basis for this layer is the concatenation of all change
-                   of basis of previous connected layers.
-                '''
-                previous_layer_indexes = self.graph[i]['in']
-                current_cob = torch.cat([self.graph[j]['cob'] for j in previous_layer_indexes])
-
-            if i > 0:
-                # if multiple inputs, get input that is i-1 else get the first input
-                input_layer_index = max(layer['in'])
-                layer['prev_cob'] = self.graph[input_layer_index]['cob']
-
-            layer['cob'] = current_cob
+        for layer, (prev_cob, layer_cob) in zip(self.graph, self.plan.get_layer_cobs(cob, contains_ones)):
+            layer['prev_cob'] = prev_cob
+            layer['cob'] = layer_cob
 
     def reset_weights(self):
         """Reset all layers."""
@@ -216,7 +247,58 @@ class NeuralTeleportationModel(nn.Module):
         Returns:
             List of nn.Modules
         """
-        return [l for l in self.grapher.ordered_layers if isinstance(l, NeuronLayerMixin)]
+        return self.plan.neuron_layers
+
+    def flatten_weights(self):
+        """
+            Store the weights of the neuron layers (and the running statistics of batch norm layers) in a single
+            contiguous tensor, in the order of `get_weights`.
+
+            The parameters of the layers become views into the flat tensor, so they stay the same parameter objects.
+            `get_weights` then returns the flat tensor without copying it and `set_weights` copies the weights into
+            it in a single operation. Since the returned tensor is shared with the network, it must be cloned to keep
+            a snapshot of the weights.
+        """
+        tensors = [(layer, name) for layer in self.get_neuron_layers() for name in layer.get_weight_names()]
+        reference = getattr(*tensors[0])
+        if any(getattr(layer, name).dtype != reference.dtype for layer, name in tensors):
+            raise ValueError("All the weights of the neuron layers must have the same dtype to be flattened.")
+
+        flat_weights = torch.empty(sum(getattr(layer, name).numel() for layer, name in tensors),
+                                   dtype=reference.dtype, device=reference.device)
+        counter = 0
+        with torch.no_grad():
+            for layer, name in tensors:
+                tensor = getattr(layer, name)
+                view = flat_weights[counter:counter + tensor.numel()].view_as(tensor)
+                view.copy_(tensor)
+                if isinstance(tensor, nn.Parameter):
+                    tensor.data = view
+                else:
+                    setattr(layer, name, view)
+                counter += tensor.numel()
+
+        self._flat_weights = flat_weights
+        self._flat_weights_ptrs = [getattr(layer, name).data_ptr() for layer, name in tensors]
+
+    def _get_flat_weights(self) -> Union[torch.Tensor, None]:
+        """
+            Get the flat weights tensor if the weights were flattened, after checking that the layers still use it.
+
+            The weights are flattened again if the layers' tensors were replaced (e.g. by `to`, `cuda` or deepcopy).
+
+        Returns:
+            the flat weights tensor, or None if the weights are not flattened.
+        """
+        if self._flat_weights is None:
+            return None
+
+        ptrs = (getattr(layer, name).data_ptr()
+                for layer in self.get_neuron_layers() for name in layer.get_weight_names())
+        if any(ptr != flat_ptr for ptr, flat_ptr in zip(ptrs, self._flat_weights_ptrs)):
+            self.flatten_weights()
+
+        return self._flat_weights
 
     def get_weights(self, concat: bool = True, flatten=True, bias=True,
                     ignore_bn: bool = False, get_proxy_weight=False) -> Union[torch.Tensor, List[torch.Tensor]]:
@@ -231,9 +313,15 @@ class NeuralTeleportationModel(nn.Module):
             get_proxy_weight (bool): if true, will only get the proxy weights without updating.
 
         Returns:
-            torch.Tensor or list containing model weights
+            torch.Tensor or list containing model weights. If the weights were flattened, the concatenated weights
+            are the flat weights tensor shared with the network.
 
         """
+        if concat and flatten and bias and not ignore_bn:
+            flat_weights = self._get_flat_weights()
+            if flat_weights is not None:
+                return flat_weights
+
         w = []
 
         for k, layer in enumerate(self.get_neuron_layers()):
@@ -256,6 +344,14 @@ class NeuralTeleportationModel(nn.Module):
         Args:
             weights (Union[torch.Tensor, np.ndarray]): weights to set.
         """
+        weights = torch.as_tensor(weights)
+
+        flat_weights = self._get_flat_weights()
+        if flat_weights is not None:
+            with torch.no_grad():
+                flat_weights.copy_(weights)
+            return
+
         counter = 0
         for k, layer in enumerate(self.get_neuron_layers()):
             nb_params = layer.get_nb_params()
@@ -263,23 +359,35 @@ class NeuralTeleportationModel(nn.Module):
             layer.set_weights(w)
             counter += nb_params
 
-    def get_grad(self, data: torch.Tensor, target: torch.Tensor, loss_fn: Callable,
-                 concat: bool = True, zero_grad: bool = True) -> Union[torch.Tensor, List[torch.Tensor]]:
+    def get_grad(self, data: Union[torch.Tensor, Iterable[Tuple[torch.Tensor, torch.Tensor]]],
+                 target: torch.Tensor = None, loss_fn: Callable = None, concat: bool = True, zero_grad: bool = True,
+                 variance: bool = False) -> Union[torch.Tensor, List[torch.Tensor], Tuple]:
         """
             Return model gradients for data, target and loss function.
 
+            The data can also be an iterable of (data, target) batches (e.g. a DataLoader). The gradient of each batch
+            is then accumulated in place in a preallocated buffer, to return the mean (and optionally the variance)
+            of the gradients over the batches without keeping the gradient of every batch in memory.
+
         Args:
-            data (torch.Tensor): input data for the network
-            target (torch.Tensor): target ouput
-            loss_fn (Callable):
+            data (torch.Tensor, Iterable): input data for the network, or iterable of (data, target) batches
+            target (torch.Tensor): target ouput, if data is a single batch
+            loss_fn (Callable): loss function
             concat (bool): if true weights are returned as concatenated torch tensor,
                             else in the form of a list of Tensors
-            zero_grad (bool): if true gradients are reset before computing them on new data.
+            zero_grad (bool): if true gradients are reset before computing them on new data. Gradients are always
+                              reset between the batches of an iterable.
+            variance (bool): if true and data is an iterable of batches, the variance of the gradients over the
+                             batches is also returned
 
         Returns:
-            torch.Tensor or list containing model weights
+            torch.Tensor or list containing model gradients (mean gradients over the batches if data is an iterable),
+            and the variance of the gradients over the batches if variance is true.
 
         """
+        if not isinstance(data, torch.Tensor):
+            return self._get_mean_grad(data, loss_fn, concat=concat, variance=variance)
+
         if zero_grad:
             self.network.zero_grad()
 
@@ -298,7 +406,144 @@ class NeuralTeleportationModel(nn.Module):
         else:
             return grad
 
+    def _get_mean_grad(self, batches: Iterable[Tuple[torch.Tensor, torch.Tensor]], loss_fn: Callable,
+                       concat: bool = True, variance: bool = False) -> Union[torch.Tensor, List[torch.Tensor], Tuple]:
+        """
+            Compute the running mean (and variance, with Welford's algorithm) of the gradients over batches.
+
+            The statistics are accumulated in place in flat buffers, directly from the gradients of the parameters.
+
+        Args:
+            batches (Iterable): iterable of (data, target) batches
+            loss_fn (Callable): loss function
+            concat (bool): if true statistics are returned as flat tensors, else as lists of tensors per parameter
+            variance (bool): if true the variance of the gradients over the batches is also returned
+
+        Returns:
+            mean of the gradients, and their variance if variance is true.
+        """
+        params = self._get_parameters()
+        mean = torch.zeros(sum(p.numel() for p in params), dtype=params[0].dtype, device=params[0].device)
+        m2 = torch.zeros_like(mean) if variance else None
+
+        nb_batches = 0
+        for data_batch, target_batch in batches:
+            self.network.zero_grad()
+            loss_fn(self.network(data_batch), target_batch).backward()
+            nb_batches += 1
+
+            counter = 0
+            with torch.no_grad():
+                for param in params:
+                    grad = param.grad.flatten()
+                    layer_mean = mean[counter:counter + grad.numel()]
+                    if variance:
+                        delta = grad - layer_mean
+                        layer_mean.add_(delta, alpha=1 / nb_batches)
+                        m2[counter:counter + grad.numel()].add_(delta * (grad - layer_mean))
+                    else:
+                        layer_mean.add_(grad - layer_mean, alpha=1 / nb_batches)
+                    counter += grad.numel()
+
+        stats = [mean]
+        if variance:
+            stats.append(m2.div_(max(nb_batches - 1, 1)))
+        if not concat:
+            sizes = [p.numel() for p in params]
+            stats = [[s.view_as(p) for s, p in zip(stat.split(sizes), params)] for stat in stats]
+
+        return tuple(stats) if variance else stats[0]
+
+    def get_per_sample_grad(self, data: torch.Tensor, target: torch.Tensor, loss_fn: Callable,
+                            concat: bool = True) -> Union[torch.Tensor, List[torch.Tensor]]:
+        """
+            Return the gradient of the loss of each sample of the batch, from a single forward and backward pass.
+
+            Hooks on the neuron layers capture their input and the gradient of the loss with respect to their output,
+            from which each layer computes the per-sample gradients of its weights (e.g. outer products for linear
+            layers). The loss must be the mean (or sum) of the losses of the samples, as with the default reduction
+            of torch losses.
+
+        Args:
+            data (torch.Tensor): input data for the network
+            target (torch.Tensor): target ouput
+            loss_fn (Callable): loss function
+            concat (bool): if true gradients are returned as a tensor of shape [B, nb_params], else as a list of
+                           tensors of shape [B, *parameter_shape] in the order of `get_grad`
+
+        Returns:
+            torch.Tensor or list containing the gradients of each sample
+        """
+        inputs, grad_outputs = {}, {}
+
+        def save_input_hook(layer, input, output):
+            inputs[layer] = input[0].detach()
+            output.register_hook(lambda grad: grad_outputs.__setitem__(layer, grad.detach()))
+
+        layers = self.get_neuron_layers()
+        handles = [layer.register_forward_hook(save_input_hook) for layer in layers]
+        try:
+            loss = loss_fn(self.network(data), target)
+            torch.autograd.grad(loss, self._get_parameters())
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        # The gradients of a mean loss are the gradients of the samples' losses divided by the batch size
+        scale = data.shape[0] if getattr(loss_fn, 'reduction', 'mean') == 'mean' else 1
+        grads = []
+        for layer in layers:
+            grads.extend(g * scale for g in layer.get_per_sample_grad(inputs[layer], grad_outputs[layer]))
+
+        if concat:
+            return torch.cat([g.flatten(start_dim=1) for g in grads], dim=1)
+        else:
+            return grads
+
+    def get_per_sample_grad_statistics(self, data: torch.Tensor, target: torch.Tensor,
+                                       loss_fn: Callable) -> Dict[str, torch.Tensor]:
+        """
+            Compute statistics of the per-sample gradients of a batch, from a single forward and backward pass.
+
+        Args:
+            data (torch.Tensor): input data for the network
+            target (torch.Tensor): target ouput
+            loss_fn (Callable): loss function
+
+        Returns:
+            Dict containing:
+                'mean': mean of the per-sample gradients,
+                'variance': variance of the per-sample gradients (normalized by the batch size),
+                'fisher_diagonal': diagonal of the empirical Fisher information, the mean of the squared per-sample
+                                   gradients,
+                'gradient_diversity': sum of the squared norms of the per-sample gradients divided by the squared
+                                      norm of their sum.
+        """
+        grads = self.get_per_sample_grad(data, target, loss_fn)
+        mean = grads.mean(dim=0)
+        grad_sum = grads.sum(dim=0)
+        fisher_diagonal = grads.pow_(2).mean(dim=0)
+        return {'mean': mean,
+                'variance': fisher_diagonal - mean ** 2,
+                'fisher_diagonal': fisher_diagonal,
+                'gradient_diversity': fisher_diagonal.sum() * grads.shape[0] / grad_sum.pow(2).sum()}
+
     def get_hessian(self, data: torch.Tensor, target: torch.Tensor, loss_fn: Callable, zero_grad: bool = True):
+        """
+            Compute the dense Hessian of the loss, row by row.
+
+            The Hessian has nb_params^2 elements, so this is only a reference for toy models. Use
+            `get_hessian_vector_product`, `get_hessian_trace` or `get_hessian_top_eigenvalues` on real networks.
+
+        Args:
+            data (torch.Tensor): input data for the network
+            target (torch.Tensor): target ouput
+            loss_fn (Callable): loss function
+            zero_grad (bool): if true, the gradients of the network are reset
+
+        Returns:
+            (torch.Tensor) Hessian of the loss, of shape [nb_params, nb_params]
+        """
         if zero_grad:
             self.network.zero_grad()
 
@@ -308,38 +553,169 @@ class NeuralTeleportationModel(nn.Module):
         grads = torch.cat([grad.flatten() for grad in grads])
 
         nb_params = len(grads)
-        hessian = torch.empty((nb_params, nb_params))
-        print(hessian.shape)
-
-        # hessian = []
+        hessian = grads.new_empty((nb_params, nb_params))
         for i, grad in enumerate(grads):
-            h = torch.autograd.grad(grad, self.network.parameters(), create_graph=True)
-            h = torch.cat([grad.flatten() for grad in h])
-            hessian[i, :] = h
-
-        # hessian = torch.cat(hessian)
+            h = torch.autograd.grad(grad, self.network.parameters(), retain_graph=True)
+            hessian[i, :] = torch.cat([grad.flatten() for grad in h])
 
         return hessian
 
-    def get_hessian_trace(self, data: torch.Tensor, target: torch.Tensor, loss_fn: Callable, zero_grad: bool = True):
-        if zero_grad:
-            self.network.zero_grad()
+    def get_hessian_vector_product(self, data: torch.Tensor, target: torch.Tensor, loss_fn: Callable,
+                                   vector: torch.Tensor) -> torch.Tensor:
+        """
+            Compute the exact product between the Hessian of the loss and a vector, without computing the Hessian.
 
-        output = self.network(data)
-        loss = loss_fn(output, target)
-        grads = torch.autograd.grad(loss, self.network.parameters(), create_graph=True)
-        grads = torch.cat([grad.flatten() for grad in grads])
+        Args:
+            data (torch.Tensor): input data for the network
+            target (torch.Tensor): target ouput
+            loss_fn (Callable): loss function
+            vector (torch.Tensor): vector of the size of the parameters, in the order of `get_grad`
 
-        trace = 0
+        Returns:
+            (torch.Tensor) Hessian-vector product
+        """
+        params, grads = self._get_grad_graph(data, target, loss_fn)
+        return self._hessian_vector_product(params, grads, vector).detach()
 
-        for i, grad in enumerate(grads):
-            h = torch.autograd.grad(grad, self.network.parameters(), create_graph=True)
-            h = torch.cat([grad.flatten() for grad in h])
-            trace += h[i]
+    def get_hessian_trace(self, data: torch.Tensor, target: torch.Tensor, loss_fn: Callable,
+                          max_probes: int = 100, min_probes: int = 10, tol: float = 1e-2,
+                          per_layer: bool = False) -> torch.Tensor:
+        """
+            Estimate the trace of the Hessian of the loss with Hutchinson's method.
+
+            The trace is estimated as the mean of z^T H z over random Rademacher vectors z, using Hessian-vector
+            products. Probes are drawn until the standard error of the estimate is below `tol` times its magnitude.
+            Since the Rademacher vectors are independent between layers, the same probes also estimate the trace of
+            the Hessian's block of each neuron layer.
+
+        Args:
+            data (torch.Tensor): input data for the network
+            target (torch.Tensor): target ouput
+            loss_fn (Callable): loss function
+            max_probes (int): maximum number of random probes
+            min_probes (int): minimum number of random probes before checking the standard error
+            tol (float): relative standard error of the estimate at which to stop drawing probes
+            per_layer (bool): if true, the traces of each neuron layer's block of the Hessian are returned
+
+        Returns:
+            (torch.Tensor) trace of the Hessian, or traces of each neuron layer if per_layer is true
+        """
+        params, grads = self._get_grad_graph(data, target, loss_fn)
+        layer_sizes = [layer.weight.numel() + (layer.bias.numel() if layer.bias is not None else 0)
+                       for layer in self.get_neuron_layers()]
+        nb_params = sum(layer_sizes)
+
+        estimates = []
+        for i in range(max_probes):
+            z = torch.randint(0, 2, (nb_params,), device=grads[0].device).to(grads[0].dtype) * 2 - 1
+            hz = self._hessian_vector_product(params, grads, z).detach()
+            estimates.append(torch.stack([layer_z.dot(layer_hz) for layer_z, layer_hz
+                                          in zip(z.split(layer_sizes), hz.split(layer_sizes))]))
+
+            if i + 1 >= min_probes:
+                traces = torch.stack(estimates).sum(dim=1)
+                if traces.std() / np.sqrt(len(traces)) <= tol * traces.mean().abs():
+                    break
+
+        layer_traces = torch.stack(estimates).mean(dim=0)
+        return layer_traces if per_layer else layer_traces.sum()
+
+    def get_hessian_top_eigenvalues(self, data: torch.Tensor, target: torch.Tensor, loss_fn: Callable, k: int = 1,
+                                    max_iter: int = 100, tol: float = 1e-3, warm_start: bool = True) -> torch.Tensor:
+        """
+            Compute the k eigenvalues of the Hessian of the loss with the largest magnitude (e.g. the sharpness
+            lambda_max) with subspace iteration, using Hessian-vector products.
+
+            At each iteration, the Hessian is applied to an orthonormal basis of k vectors and the eigenvalues are
+            estimated with the Rayleigh-Ritz method. The iterations stop when the relative change of every eigenvalue
+            between two iterations is below `tol`. The eigenvectors are kept between calls and used as starting point
+            for the next call, so that successive estimates during training only need a few iterations.
+
+        Args:
+            data (torch.Tensor): input data for the network
+            target (torch.Tensor): target ouput
+            loss_fn (Callable): loss function
+            k (int): number of eigenvalues to compute
+            max_iter (int): maximum number of iterations
+            tol (float): relative change of the eigenvalues at which to stop iterating
+            warm_start (bool): if true, the eigenvectors from the previous call are used as starting point
+
+        Returns:
+            (torch.Tensor) top k eigenvalues, sorted by decreasing magnitude
+        """
+        if max_iter < 1:
+            raise ValueError("At least one iteration is required to estimate the eigenvalues of the Hessian.")
+
+        params, grads = self._get_grad_graph(data, target, loss_fn)
+        nb_params = sum(p.numel() for p in params)
+
+        basis = torch.randn(nb_params, k, dtype=grads[0].dtype, device=grads[0].device)
+        previous = self._hessian_eigenvectors
+        if warm_start and previous is not None and previous.shape[0] == nb_params:
+            nb_previous = min(k, previous.shape[1])
+            basis[:, :nb_previous] = previous[:, :nb_previous].to(basis)
+        basis, _ = torch.linalg.qr(basis)
+
+        previous_eigenvalues = None
+        for _ in range(max_iter):
+            h_basis = torch.stack([self._hessian_vector_product(params, grads, v).detach() for v in basis.T], dim=1)
+
+            # Rayleigh-Ritz: eigenvalues of the Hessian projected on the basis
+            eigenvalues, ritz_vectors = torch.linalg.eigh(basis.T.matmul(h_basis))
+            order = eigenvalues.abs().argsort(descending=True)
+            eigenvalues, ritz_vectors = eigenvalues[order], ritz_vectors[:, order]
+            basis, h_basis = basis.matmul(ritz_vectors), h_basis.matmul(ritz_vectors)
+
+            if previous_eigenvalues is not None and \
+                    torch.all((eigenvalues - previous_eigenvalues).abs() <= tol * eigenvalues.abs()):
+                break
+
+            previous_eigenvalues = eigenvalues
+            basis, _ = torch.linalg.qr(h_basis)
 
-        # hessian = torch.cat(hessian)
+        self._hessian_eigenvectors = basis
+        return eigenvalues
 
-        return trace
+    def _get_parameters(self) -> List[nn.Parameter]:
+        """
+            Get the parameters of the neuron layers, in the order of `get_grad`.
+        """
+        params = []
+        for layer in self.get_neuron_layers():
+            params.append(layer.weight)
+            if layer.bias is not None:
+                params.append(layer.bias)
+        return params
+
+    def _get_grad_graph(self, data: torch.Tensor, target: torch.Tensor,
+                        loss_fn: Callable) -> Tuple[List[nn.Parameter], Tuple[torch.Tensor, ...]]:
+        """
+            Compute the gradients of the loss with their graph, to compute Hessian-vector products.
+
+        Returns:
+            parameters of the neuron layers and gradients of the loss with respect to them.
+        """
+        params = self._get_parameters()
+        loss = loss_fn(self.network(data), target)
+        return params, torch.autograd.grad(loss, params, create_graph=True)
+
+    @staticmethod
+    def _hessian_vector_product(params: List[nn.Parameter], grads: Tuple[torch.Tensor, ...],
+                                vector: torch.Tensor) -> torch.Tensor:
+        """
+            Compute a Hessian-vector product by differentiating the gradients in the direction of the vector.
+
+        Args:
+            params (List[nn.Parameter]): parameters with respect to which the gradients were computed
+            grads (Tuple[torch.Tensor, ...]): gradients, with their graph
+            vector (torch.Tensor): flat vector of the size of the parameters
+
+        Returns:
+            (torch.Tensor) flat Hessian-vector product
+        """
+        vectors = [v.view_as(p) for v, p in zip(vector.type_as(grads[0]).split([p.numel() for p in params]), params)]
+        hvp = torch.autograd.grad(grads, params, grad_outputs=vectors, retain_graph=True)
+        return torch.cat([h.flatten() for h in hvp])
 
     def get_cob(self, concat=True, contain_ones=False):
         """
@@ -353,14 +729,13 @@ class NeuralTeleportationModel(nn.Module):
             List of change of basis for each layer.
         """
         cob = []
-        for i, layer in enumerate(self.graph):
-            if isinstance(layer['module'], NeuronLayerMixin):
-                # Last layer
-                if not np.array([isinstance(l['module'], NeuronLayerMixin) for l in self.graph[i + 1:]]).any():
+        for layer_plan in self.plan.layers:
+            if layer_plan.is_neuron:
+                layer = self.graph[layer_plan.idx]
+                if layer_plan.is_output:
                     if contain_ones:
                         cob.append(layer['cob'])
-                # First layer
-                elif not np.array([isinstance(l['module'], NeuronLayerMixin) for l in self.graph[:i]]).any():
+                elif layer_plan.is_input:
                     if contain_ones:
                         cob.append(layer['prev_cob'])
                     cob.append(layer['cob'])
@@ -373,46 +748,86 @@ class NeuralTeleportationModel(nn.Module):
             return cob
 
     def calculate_cob(self, initial_weights: List[torch.Tensor], target_weights: List[torch.Tensor],
-                      concat: bool = True, eta: float = 0.1, steps: int = 1000):
+                      concat: bool = True, steps: int = 1000):
         """
             Calculate the change of basis to teleport the initial weights to the target weights.
             Each cob is calculated individually following a closed form solution to
                         min_T ||T(initial_weights) - target_weights||
 
+            The graph is walked in the order of the teleportation plan, so that the layers after a residual connection
+            use the cob of the source of the connection and the layers after a concatenation use the concatenated
+            cobs. The cob of the layer that feeds the output layer is computed jointly with the output layer.
 
         Args:
-            initial_weights (List[torch.Tensor]): initial weights on which teleportation is applied
+            initial_weights (List[torch.Tensor]): initial weights on which teleportation is applied, one weight tensor
+                                                  per neuron layer (as returned by get_weights with bias=False)
             target_weights (List[torch.Tensor]): target weigths to obtain with teleportation.
             concat (bool): whether to concat cob into one tensor
-            eta (float): learning rate for the gradient descent for the last cob optimisation
-            steps (int): number of gradient descent steps for the last cob optimisation
+            steps (int): maximum number of Newton iterations for the last cob optimisation
 
         Returns:
             (torch.Tensor) calculated change of basis
         """
-        layers = self.get_neuron_layers()
-
-        cob = [layers[0].get_input_cob()]
-        for i in range(len(layers) - 2):
-            t = layers[i].calculate_cob(initial_weights[i], target_weights[i], cob[-1])
-            cob.append(t)
-
-        last_cob = layers[-2].calculate_last_cob(initial_weights[-2], target_weights[-2],
-                                                 initial_weights[-1], target_weights[-1],
-                                                 cob[-1], eta, steps)
+        output_layer = self.plan.layers[self.plan.output_idx].module
+        last_cob_idx = self._get_last_cob_layer_idx()
 
-        if last_cob is None:
-            last_cob = layers[-2].calculate_cob(initial_weights[-2], target_weights[-2], cob[-1])
-
-        cob.append(last_cob)
-
-        cob.pop(0)  # Remove input layer cob.
+        cob = []
+        layer_cobs = []  # Output cob of every layer of the graph
+        neuron_idx = 0
+        for layer_plan in self.plan.layers:
+            module = layer_plan.module
+            prev_cob = layer_cobs[layer_plan.prev_idx] if layer_plan.prev_idx is not None else None
+
+            if layer_plan.is_neuron:
+                if layer_plan.is_input:
+                    prev_cob = module.get_input_cob().to(initial_weights[neuron_idx])
+                    layer_cobs = [prev_cob] * len(layer_cobs)
+
+                if layer_plan.is_output:
+                    current_cob = module.get_output_cob()
+                else:
+                    current_cob = None
+                    if layer_plan.idx == last_cob_idx:
+                        current_cob = module.calculate_last_cob(initial_weights[neuron_idx],
+                                                                target_weights[neuron_idx],
+                                                                initial_weights[-1], target_weights[-1],
+                                                                prev_cob, steps, next_layer=output_layer)
+                    if current_cob is None:
+                        current_cob = module.calculate_cob(initial_weights[neuron_idx], target_weights[neuron_idx],
+                                                           prev_cob)
+                    cob.append(current_cob)
+                neuron_idx += 1
+            elif isinstance(module, Add):
+                current_cob = layer_cobs[layer_plan.sources[0]]
+            elif isinstance(module, Concat):
+                current_cob = torch.cat([layer_cobs[j] for j in layer_plan.sources])
+            else:
+                current_cob = prev_cob
+
+            layer_cobs.append(current_cob)
 
         if concat:
             return torch.cat(cob)
         else:
             return cob
 
+    def _get_last_cob_layer_idx(self) -> Union[int, None]:
+        """
+            Get the index in the graph of the neuron layer whose output cob is the input cob of the output layer.
+
+        Returns:
+            index of the layer, or None if the input cob of the output layer is a concatenation of cobs.
+        """
+        idx = self.plan.layers[self.plan.output_idx].prev_idx
+        while idx is not None:
+            layer_plan = self.plan.layers[idx]
+            if layer_plan.is_neuron:
+                return idx
+            if isinstance(layer_plan.module, Concat):
+                return None
+            idx = layer_plan.sources[0] if isinstance(layer_plan.module, Add) else layer_plan.prev_idx
+        return None
+
     def get_params(self):
         return self.get_weights(), self.get_cob()
 
@@ -420,49 +835,50 @@ class NeuralTeleportationModel(nn.Module):
         self.teleport_activations(cob)
         self.set_weights(weights)
 
-    def get_layer_hessians(self, data: torch.Tensor, target: torch.Tensor, loss_fn: Callable,
-                           zero_grad: bool = True):
-        if zero_grad:
-            self.network.zero_grad()
+    def get_layer_hessians(self, data: torch.Tensor, target: torch.Tensor, loss_fn: Callable) -> List[torch.Tensor]:
+        """
+            Compute the block of the Hessian of the loss of each neuron layer, from Hessian-vector products restricted
+            to the parameters of the layer.
 
-        output = self.network(data)
-        loss = loss_fn(output, target)
-        grads = torch.autograd.grad(loss, self.network.parameters(), create_graph=True)
-        grads = [grad.flatten() for grad in grads]
+            The full Hessian is never built, but each block is dense, with nb_layer_params^2 elements.
+
+        Args:
+            data (torch.Tensor): input data for the network
+            target (torch.Tensor): target ouput
+            loss_fn (Callable): loss function
+
+        Returns:
+            (List[torch.Tensor]) Hessian's block of each neuron layer, of shape [nb_layer_params, nb_layer_params]
+        """
+        params, grads = self._get_grad_graph(data, target, loss_fn)
 
         hessians = []
-        for i, grad in enumerate(grads):
-            hessian = torch.empty((len(grad), len(grad)))
-            for j, g in enumerate(grad):
-                h = torch.autograd.grad(g, list(self.network.parameters())[i], create_graph=True)
-                h = torch.cat([grad.flatten() for grad in h])
-                hessian[j, :] = h
-            print(grad.shape)
-            print(list(self.network.parameters())[i].shape)
-            hessians.append(hessian)
+        start = 0
+        for layer in self.get_neuron_layers():
+            end = start + (2 if layer.bias is not None else 1)
+            layer_params, layer_grads = params[start:end], grads[start:end]
+            basis = torch.eye(sum(p.numel() for p in layer_params), dtype=grads[0].dtype, device=grads[0].device)
+            hessians.append(torch.stack([self._hessian_vector_product(layer_params, layer_grads, v).detach()
+                                         for v in basis]))
+            start = end
 
         return hessians
 
     def get_layer_hessian_traces(self, data: torch.Tensor, target: torch.Tensor, loss_fn: Callable,
-                                 zero_grad: bool = True):
-        if zero_grad:
-            self.network.zero_grad()
+                                 **kwargs) -> torch.Tensor:
+        """
+            Estimate the trace of each neuron layer's block of the Hessian of the loss with Hutchinson's method.
 
-        output = self.network(data)
-        loss = loss_fn(output, target)
-        grads = torch.autograd.grad(loss, self.network.parameters(), create_graph=True)
-        grads = [grad.flatten() for grad in grads]
+        Args:
+            data (torch.Tensor): input data for the network
+            target (torch.Tensor): target ouput
+            loss_fn (Callable): loss function
+            **kwargs: parameters of the estimator, see `get_hessian_trace`
 
-        traces = []
-        for i, grad in enumerate(grads):
-            trace = 0
-            for j, g in enumerate(grad):
-                h = torch.autograd.grad(g, list(self.network.parameters())[i], create_graph=True)
-                h = torch.cat([grad.flatten() for grad in h])
-                trace += h[j]
-            traces.append(trace)
-
-        return traces
+        Returns:
+            (torch.Tensor) trace of the Hessian's block of each neuron layer
+        """
+        return self.get_hessian_trace(data, target, loss_fn, per_layer=True, **kwargs)
 
 
 if __name__ == '__main__':
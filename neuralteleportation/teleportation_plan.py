@@ -0,0 +1,176 @@
+from dataclasses import dataclass, field
+from typing import List, Dict, Tuple
+
+import torch
+import torch.nn as nn
+
+from neuralteleportation.layers.merge import Add, Concat
+from neuralteleportation.layers.neuron import NeuronLayerMixin
+
+
+@dataclass
+class LayerPlan:
+    """
+        Precomputed information required to assign the change of basis of a single layer of the network graph.
+
+    Args:
+        idx (int): index of the layer in the network graph.
+        module (nn.Module): module of the layer.
+        is_neuron (bool): whether the layer is a neuron layer (i.e. contains weights).
+        is_input (bool): whether the layer is the first neuron layer of the network.
+        is_output (bool): whether the layer is the last neuron layer of the network.
+        cob_slice (slice): slice of the layer's output cob in the cob vector without input and output ones.
+        cob_slice_with_ones (slice): slice of the layer's output cob in the cob vector with input and output ones.
+        input_cob_slice_with_ones (slice): slice of the input cob in the cob vector with input and output ones
+                                           (only for the input layer).
+        prev_idx (int): index of the layer from which the previous cob is taken.
+        sources (List[int]): indexes of the layers from which the cob is taken for Add and Concat layers.
+        has_neuron_after (bool): whether there is a neuron layer after this layer in the graph.
+    """
+    idx: int
+    module: nn.Module
+    is_neuron: bool = False
+    is_input: bool = False
+    is_output: bool = False
+    cob_slice: slice = None
+    cob_slice_with_ones: slice = None
+    input_cob_slice_with_ones: slice = None
+    prev_idx: int = None
+    sources: List[int] = field(default_factory=list)
+    has_neuron_after: bool = False
+
+
+class TeleportationPlan:
+    """
+        Teleportation plan compiled once from the network graph.
+
+        The plan precomputes, for every layer of the graph, where its change of basis is located in the flat cob
+        vector and from which layers it is derived (Add/Concat sources and input layer). Applying a cob to the
+        network is then a single pass over the precomputed slices instead of repeated scans of the graph.
+
+    Args:
+        graph (List[Dict]): network graph as computed by the NetworkGrapher.
+    """
+
+    def __init__(self, graph: List[Dict]):
+        self.layers = []
+        self.neuron_layers = []
+        self.input_idx = None
+        self.output_idx = None
+
+        neuron_indexes = [i for i, layer in enumerate(graph) if isinstance(layer['module'], NeuronLayerMixin)]
+        if neuron_indexes:
+            self.input_idx = neuron_indexes[0]
+            self.output_idx = neuron_indexes[-1]
+
+        counter = 0
+        counter_with_ones = 0
+        for i, layer in enumerate(graph):
+            module = layer['module']
+            layer_plan = LayerPlan(idx=i, module=module,
+                                   has_neuron_after=self.output_idx is not None and i < self.output_idx)
+
+            if isinstance(module, NeuronLayerMixin):
+                layer_plan.is_neuron = True
+                self.neuron_layers.append(module)
+                if i == self.output_idx:
+                    layer_plan.is_output = True
+                    layer_plan.cob_slice_with_ones = slice(counter_with_ones, counter_with_ones + module.out_features)
+                    counter_with_ones += module.out_features
+                else:
+                    if i == self.input_idx:
+                        layer_plan.is_input = True
+                        layer_plan.input_cob_slice_with_ones = slice(counter_with_ones,
+                                                                     counter_with_ones + module.in_features)
+                        counter_with_ones += module.in_features
+                    layer_plan.cob_slice = slice(counter, counter + module.out_features)
+                    layer_plan.cob_slice_with_ones = slice(counter_with_ones, counter_with_ones + module.out_features)
+                    counter += module.out_features
+                    counter_with_ones += module.out_features
+
+            if isinstance(module, Add):
+                layer_plan.sources = [min(layer['in'])]
+            elif isinstance(module, Concat):
+                layer_plan.sources = list(layer['in'])
+
+            if i > 0:
+                # if multiple inputs, get input that is i-1 else get the first input
+                layer_plan.prev_idx = max(layer['in'])
+
+            self.layers.append(layer_plan)
+
+        self.cob_size = counter
+        self.cob_size_with_ones = counter_with_ones
+
+    def get_layer_cobs(self, cob: torch.Tensor, contains_ones: bool = False) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+            Compute the previous and current change of basis of every layer of the graph from the network's cob.
+
+            The cob can have leading batch dimensions (e.g. [K, cob_size] for K different cobs), in which case the
+            change of basis of each layer has the same leading batch dimensions.
+
+        Args:
+            cob (torch.Tensor): change of basis of the network, of shape [..., cob_size].
+            contains_ones (bool): whether the cob contains input and output ones.
+
+        Returns:
+            List of (prev_cob, cob) for each layer of the graph.
+        """
+        prev_cobs = []
+        cobs = []
+        current_cob = None  # Cob for last neuron layer to be applied following to non-neuron layers ie. Activations
+
+        for layer_plan in self.layers:
+            prev_cob = None
+
+            if layer_plan.is_output:
+                if contains_ones:
+                    current_cob = cob[..., layer_plan.cob_slice_with_ones]
+                    assert torch.all(current_cob == 1), "Output layer cob values must be all ones."
+                else:
+                    current_cob = self._expand_ones(layer_plan.module.get_output_cob(), cob)
+
+            elif layer_plan.is_input:
+                if contains_ones:
+                    initial_cob = cob[..., layer_plan.input_cob_slice_with_ones]
+                    assert torch.all(initial_cob == 1), "Input layer cob values must be all ones."
+                    current_cob = cob[..., layer_plan.cob_slice_with_ones]
+                else:
+                    initial_cob = self._expand_ones(layer_plan.module.get_input_cob(), cob)
+                    current_cob = cob[..., layer_plan.cob_slice]
+                prev_cob = initial_cob
+
+                # Apply change of basis for all previous layers.
+                prev_cobs = [initial_cob] * len(prev_cobs)
+                cobs = [initial_cob] * len(cobs)
+
+            elif layer_plan.is_neuron:
+                current_cob = cob[..., layer_plan.cob_slice_with_ones if contains_ones else layer_plan.cob_slice]
+
+            if isinstance(layer_plan.module, Add):
+                if not layer_plan.has_neuron_after:
+                    '''If there is no layer after, previous layer must be ones. '''
+                    raise ValueError("NOT SUPPORTED YET: Must have neuron layer after residual connection")
+
+                current_cob = cobs[layer_plan.sources[0]]
+
+            if isinstance(layer_plan.module, Concat):
+                '''If the layer is concatenation the change of basis for this layer is the concatenation of all change
+                   of basis of previous connected layers.
+                '''
+                current_cob = torch.cat([cobs[j] for j in layer_plan.sources], dim=-1)
+
+            if layer_plan.prev_idx is not None:
+                prev_cob = cobs[layer_plan.prev_idx]
+
+            prev_cobs.append(prev_cob)
+            cobs.append(current_cob)
+
+        return list(zip(prev_cobs, cobs))
+
+    @staticmethod
+    def _expand_ones(ones: torch.Tensor, cob: torch.Tensor) -> torch.Tensor:
+        """Expand the input or output cob of ones to the batch dimensions of the network's cob."""
+        if cob.dim() == 1:
+            return ones
+        return ones.to(cob).expand(*cob.shape[:-1], -1)
@@ -1,6 +1,6 @@
 import copy
 from dataclasses import dataclass, fields
-from typing import Sequence, Callable, Dict, Any, Tuple
+from typing import Sequence, Callable, Dict, Any, Tuple, Union
 
 from torch import Tensor
 from torch.nn.modules.loss import _Loss
@@ -19,6 +19,12 @@ class TrainingConfig:
     logger: BaseLogger = None
     shuffle_batches: bool = False
     max_batch: int = None
+    # Data loading (c.f. ``torch.utils.data.DataLoader``)
+    num_workers: int = 0
+    prefetch_factor: int = None  # Batches loaded in advance by each worker (DataLoader's default if None)
+    persistent_workers: bool = False
+    pin_memory: bool = False  # Only used when CUDA is available
+    eval_batch_size: int = None  # Batch size for evaluation, ``batch_size`` if None
 
 
 @dataclass
@@ -36,7 +42,7 @@ class TeleportationTrainingConfig(TrainingConfig):
 @dataclass
 class TrainingMetrics:
     criterion: _Loss
-    metrics: Sequence[Callable[[Tensor, Tensor], float]]
+    metrics: Sequence[Callable[[Tensor, Tensor], Union[Tensor, float]]]
 
 
 _SERIALIZATION_EXCLUDED_FIELDS = ['logger']
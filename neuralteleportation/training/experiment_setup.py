@@ -1,10 +1,13 @@
+from collections import OrderedDict
 from pathlib import Path
 from typing import Tuple, List, Callable, Dict, Union, Any, Sequence
 
+import torch
 import torchvision.transforms as transforms
 from torch import nn, optim
 from torch.optim import Optimizer
-from torchvision.datasets import VisionDataset, MNIST, CIFAR10, CIFAR100
+from torch.utils.data import DataLoader, Dataset
+from torchvision.datasets import MNIST, CIFAR10, CIFAR100
 
 from neuralteleportation.models.model_zoo import mlpcob, resnetcob, vggcob, densenetcob
 from neuralteleportation.models.model_zoo.densenetcob import densenet121COB
@@ -13,6 +16,7 @@ from neuralteleportation.models.model_zoo.resnetcob import resnet18COB
 from neuralteleportation.models.model_zoo.vggcob import vgg16COB, vgg16_bnCOB
 from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
 from neuralteleportation.training.config import TrainingConfig, TeleportationTrainingConfig
+from neuralteleportation.training.tensor_dataset import TensorCacheDataset
 from neuralteleportation.utils.optimtools import initialize_model
 
 __dataset_config__ = {"mnist": {"cls": MNIST, "input_channels": 1, "image_size": (28, 28), "num_classes": 10},
@@ -44,19 +48,45 @@ __dataset_config__ = {"mnist": {"cls": MNIST, "input_channels": 1, "image_size":
                                    ])}}
 __models__ = [MLPCOB, vgg16COB, resnet18COB, densenet121COB, vgg16_bnCOB]
 
+# Data loaders reused across epochs (and their workers, if persistent), by dataset and loader parameters
+_dataloaders: "OrderedDict[Tuple, DataLoader]" = OrderedDict()
+_DATALOADERS_CACHE_SIZE = 8
+
 
 def get_dataset_info(dataset_name: str, *tags: str) -> Dict[str, Any]:
     return {tag: __dataset_config__[dataset_name.lower()][tag] for tag in tags}
 
 
-def get_dataset_subsets(dataset_name: str, root: Path = "/tmp", download: bool = True, transform=None) \
-        -> Tuple[VisionDataset, VisionDataset, VisionDataset]:
+def get_dataset_subsets(dataset_name: str, root: Path = "/tmp", download: bool = True, transform=None,
+                        backend: str = "torchvision") -> Tuple[Dataset, Dataset, Dataset]:
+    """Gets the train, validation and test sets of a dataset. The validation and test sets are the test split.
+
+    Args:
+        dataset_name: Name of the dataset (c.f. ``__dataset_config__``).
+        root: Root directory of the data.
+        download: Whether to download the dataset if it is not found in the root directory.
+        transform: Transform of the images, if the dataset does not define its own train and test transforms.
+        backend: "torchvision" to load the images and transform them one by one with the torchvision datasets,
+            or "tensor" to decode them once in tensor files under the root directory and transform them by batches.
+            With the "tensor" backend, the validation and test sets are the same dataset.
+
+    Returns:
+        The train, validation and test sets.
+    """
     if transform is None:
         transform = transforms.ToTensor()
     dataset_conf = __dataset_config__[dataset_name.lower()]
     dataset_cls = dataset_conf["cls"]
     train_transform = dataset_conf["train_transform"] if "train_transform" in dataset_conf.keys() else transform
     test_transform = dataset_conf["test_transform"] if "test_transform" in dataset_conf.keys() else transform
+    if backend == "tensor":
+        train_set = TensorCacheDataset.from_vision_dataset(dataset_cls, root, train=True, download=download,
+                                                           transform=train_transform)
+        test_set = TensorCacheDataset.from_vision_dataset(dataset_cls, root, train=False, download=download,
+                                                          transform=test_transform)
+        return train_set, test_set, test_set
+    if backend != "torchvision":
+        raise ValueError(f"Unknown dataset backend: {backend}")
     train_set = dataset_cls(str(root), train=True, download=download, transform=train_transform)
     val_set = dataset_cls(str(root), train=False, download=download, transform=test_transform)
     test_set = dataset_cls(str(root), train=False, download=download, transform=test_transform)
@@ -75,7 +105,8 @@ def get_model_names() -> List[str]:
 
 
 def get_model(dataset_name: str, model_name: str, device: str = 'cpu',
-              initializer: Dict[str, Union[str, float]] = None, **model_kwargs) -> NeuralTeleportationModel:
+              initializer: Dict[str, Union[str, float]] = None, graph_backend: str = 'jit',
+              **model_kwargs) -> NeuralTeleportationModel:
     # Look up if the requested model is available in the model zoo
     model_factories = _get_model_factories()
     if model_name not in model_factories:
@@ -102,7 +133,8 @@ def get_model(dataset_name: str, model_name: str, device: str = 'cpu',
 
     # Transform the base ``nn.Module`` to a ``NeuralTeleportationModel``
     input_channels, image_size = get_dataset_info(dataset_name, "input_channels", "image_size").values()
-    model = NeuralTeleportationModel(network=model, input_shape=(2, input_channels, *image_size))
+    model = NeuralTeleportationModel(network=model, input_shape=(2, input_channels, *image_size),
+                                     graph_backend=graph_backend)
 
     return model.to(device)
 
@@ -118,6 +150,53 @@ def get_optimizer_from_model_and_config(model: nn.Module, config: TrainingConfig
     return getattr(optim, optimizer_name)(model.parameters(), **optimizer_kwargs)
 
 
+def get_dataloader_from_dataset_and_config(dataset: Dataset, config: TrainingConfig, train: bool = True,
+                                           batch_size: int = None, shuffle: bool = None,
+                                           drop_last: bool = None) -> DataLoader:
+    """Gets a data loader for a dataset, with the data loading parameters of the configuration.
+
+    The data loaders are cached by dataset and parameters, so that the loaders (and their workers, if
+    ``persistent_workers`` is set) are reused across epochs instead of being created every time a dataset is iterated.
+    Since persistent workers keep a copy of the dataset, changes made to the dataset after its first iteration might
+    not be seen by the workers.
+
+    Args:
+        dataset: Dataset to load.
+        config: Collection of hyperparameters regarding the training, including the data loading parameters.
+        train: Whether the loader is used for training. If true, the batches are shuffled and the last batch is
+            dropped according to the configuration. Otherwise, the evaluation batch size is used.
+        batch_size: Batch size that overrides the batch size of the configuration.
+        shuffle: Whether to shuffle the batches, overriding the configuration.
+        drop_last: Whether to drop the last incomplete batch, overriding the configuration.
+
+    Returns:
+        Data loader for the dataset.
+    """
+    if batch_size is None:
+        batch_size = config.batch_size if train else (config.eval_batch_size or config.batch_size)
+    if shuffle is None:
+        shuffle = config.shuffle_batches and train
+    if drop_last is None:
+        drop_last = config.drop_last_batch and train
+
+    loader_kwargs = dict(batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, num_workers=config.num_workers,
+                         pin_memory=config.pin_memory and torch.cuda.is_available())
+    if config.num_workers > 0:
+        loader_kwargs.update(persistent_workers=config.persistent_workers)
+        if config.prefetch_factor is not None:
+            loader_kwargs.update(prefetch_factor=config.prefetch_factor)
+
+    # The loader keeps a reference to the dataset, so its id is not reused as long as the loader is cached
+    key = (id(dataset), *sorted(loader_kwargs.items()))
+    if key in _dataloaders:
+        _dataloaders.move_to_end(key)
+    else:
+        _dataloaders[key] = DataLoader(dataset, **loader_kwargs)
+        if len(_dataloaders) > _DATALOADERS_CACHE_SIZE:
+            _dataloaders.popitem(last=False)
+    return _dataloaders[key]
+
+
 def get_lr_scheduler_from_optimizer_and_config(optimizer: Optimizer, config: TrainingConfig):
     lr_scheduler_name, _, lr_scheduler_kwargs = config.lr_scheduler
     return getattr(optim.lr_scheduler, lr_scheduler_name)(optimizer, **lr_scheduler_kwargs)
@@ -1,4 +1,4 @@
-from copy import deepcopy
+import math
 from dataclasses import dataclass, field
 from numbers import Number
 from typing import Callable, Union
@@ -6,21 +6,24 @@ from typing import Callable, Union
 import torch
 from numpy import number
 from torch import Tensor
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 
 from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
 from neuralteleportation.training.config import TrainingMetrics, TeleportationTrainingConfig
-from neuralteleportation.training.experiment_setup import get_optimizer_from_model_and_config
+from neuralteleportation.training.experiment_setup import (
+    get_optimizer_from_model_and_config, get_dataloader_from_dataset_and_config,
+)
 
 
 def teleport_model_to_optimize_metric(model: NeuralTeleportationModel, train_dataset: Dataset, metrics: TrainingMetrics,
                                       config: "OptimalTeleportationTrainingConfig", **kwargs) \
         -> NeuralTeleportationModel:
     print(f"Selecting best of {config.num_teleportations} random COBs "
-          f"w.r.t. {config.optim_metric.__name__}")
+          f"w.r.t. {config.optim_metric.__name__} ({config.search} search)")
 
-    # Extract a single batch on which to compute gradients for each model to be compared
-    dataloader = DataLoader(train_dataset, batch_size=config.batch_size)
+    # Extract the batches on which to compute the metric for each model to be compared
+    dataloader = get_dataloader_from_dataset_and_config(train_dataset, config, train=False,
+                                                        batch_size=config.batch_size)
     data, target = [], []
     for (data_batch, target_batch), _ in zip(dataloader, range(config.num_batches)):
         data.append(data_batch)
@@ -28,45 +31,125 @@ def teleport_model_to_optimize_metric(model: NeuralTeleportationModel, train_dat
     data = torch.stack(data).to(device=config.device)
     target = torch.stack(target).to(device=config.device)
 
+    if config.search == "exhaustive":
+        optimal_cob = _exhaustive_search(model, data, target, metrics, config)
+    elif config.search == "successive_halving":
+        optimal_cob = _successive_halving(model, data, target, metrics, config)
+    else:
+        raise ValueError(f"Unknown search for the optimal teleportation: {config.search}")
+
+    return model.teleport(optimal_cob)
+
+
+def _save_buffers(model: NeuralTeleportationModel) -> Callable[[], None]:
+    """
+        Save the persistent buffers of the model (e.g. batch norm statistics), which do not depend on the cob.
+
+    Args:
+        model (NeuralTeleportationModel): model whose buffers to save.
+
+    Returns:
+        function that restores the buffers of the model to their saved values.
+    """
+    state_dict = model.state_dict(keep_vars=True)
+    buffers = [(buffer, buffer.clone()) for name, buffer in model.named_buffers() if name in state_dict]
+
+    def restore_buffers():
+        with torch.no_grad():
+            for buffer, saved_buffer in buffers:
+                buffer.copy_(saved_buffer)
+
+    return restore_buffers
+
+
+def _exhaustive_search(model: NeuralTeleportationModel, data: Tensor, target: Tensor, metrics: TrainingMetrics,
+                       config: "OptimalTeleportationTrainingConfig") -> Tensor:
+    """
+        Select the cob that optimizes the metric among the current cob and random cobs, all evaluated on every batch.
+
+        The candidates are evaluated in place on the model, so only the cob of the best candidate is kept in memory.
+        The buffers are restored after each random candidate, to be only updated by the evaluation of the current model.
+
+    Returns:
+        selected cob.
+    """
     optimal_metric = config.optim_metric(model=model, data=data, target=target, metrics=metrics, config=config)
-    model.cpu()  # Move model to CPU to avoid having 2 models on the GPU (to avoid possible CUDA OOM error)
-    optimal_model = model
+    optimal_cob = model.get_cob()
+    restore_buffers = _save_buffers(model)
 
     for _ in range(config.num_teleportations):
-        teleported_model = deepcopy(model).random_teleport(cob_range=config.cob_range,
-                                                           sampling_type=config.cob_sampling)
-        teleported_model.to(config.device)  # Move model back to chosen device before computing gradients
-        metric = config.optim_metric(model=teleported_model, data=data, target=target, metrics=metrics, config=config)
-        teleported_model.cpu()  # Move model back to CPU after computation is done (to avoid possible CUDA OOM error)
+        cob = model.generate_random_cob(cob_range=config.cob_range, sampling_type=config.cob_sampling)
+        model.teleport(cob)
+        metric = config.optim_metric(model=model, data=data, target=target, metrics=metrics, config=config)
+        restore_buffers()
         if metric > optimal_metric:
-            optimal_model = teleported_model
+            optimal_cob = cob
             optimal_metric = metric
 
-    return optimal_model.to(config.device)
+    return optimal_cob
+
+
+def _successive_halving(model: NeuralTeleportationModel, data: Tensor, target: Tensor, metrics: TrainingMetrics,
+                        config: "OptimalTeleportationTrainingConfig") -> Tensor:
+    """
+        Select the cob that optimizes the metric among the current cob and random cobs by successive halving.
+
+        All the candidates are first evaluated on a single batch. At each round, only the best fraction of the
+        candidates (``config.keep_fraction``) is kept, and the survivors are evaluated on more batches (up to all the
+        batches), until a single candidate remains. Since the candidates are evaluated multiple times, the buffers are
+        restored after each evaluation, including the evaluations of the current model.
+
+    Returns:
+        selected cob.
+    """
+    if not 0 < config.keep_fraction < 1:
+        raise ValueError(f"The fraction of candidates kept by successive halving must be in (0, 1), "
+                         f"got {config.keep_fraction}")
+
+    cobs = [model.get_cob()] + [model.generate_random_cob(cob_range=config.cob_range, sampling_type=config.cob_sampling)
+                                for _ in range(config.num_teleportations)]
+    restore_buffers = _save_buffers(model)
+
+    candidates = list(range(len(cobs)))
+    num_batches = 1
+    while len(candidates) > 1:
+        metric_values = []
+        for idx in candidates:
+            model.teleport(cobs[idx])
+            metric_values.append(config.optim_metric(model=model, data=data[:num_batches],
+                                                     target=target[:num_batches], metrics=metrics, config=config))
+            restore_buffers()
+        num_kept = max(1, min(len(candidates) - 1, int(len(candidates) * config.keep_fraction)))
+        ranking = sorted(range(len(candidates)), key=lambda i: metric_values[i], reverse=True)
+        candidates = [candidates[i] for i in sorted(ranking[:num_kept])]
+        num_batches = min(len(data), math.ceil(num_batches / config.keep_fraction))
+    return cobs[candidates[0]]
 
 
 @dataclass
 class OptimalTeleportationTrainingConfig(TeleportationTrainingConfig):
     teleport_fn: Callable = field(default=teleport_model_to_optimize_metric)
     num_teleportations: int = 10
-    num_batches: int = 1
+    num_batches: int = 1  # Number of batches on which the candidates are evaluated (at most, if successive halving)
     optim_metric: Callable[..., Number] = None  # Required
+    search: str = "exhaustive"  # "exhaustive" or "successive_halving"
+    keep_fraction: float = 0.5  # Fraction of the candidates kept at each round of successive halving
 
 
 def weighted_grad_norm(model: NeuralTeleportationModel, data: Tensor, target: Tensor,
                        metrics: TrainingMetrics, order: Union[str, number] = 'fro', **kwargs) -> Number:
-    weights = model.get_weights()
-    gradients = torch.stack([model.get_grad(data_batch, target_batch, metrics.criterion)
-                             for data_batch, target_batch in zip(data, target)]).mean(dim=0)
+    weights = [weight for layer in model.get_neuron_layers() for weight in (layer.weight, layer.bias)
+               if weight is not None]
+    gradients = model.get_grad(zip(data, target), loss_fn=metrics.criterion, concat=False)
 
     # Compute the gradient/weight ratio where possible
-    ratio = gradients / weights
+    ratio = torch.cat([(gradient / weight.detach()).flatten() for gradient, weight in zip(gradients, weights)])
 
-    # Identify where the ratio is numerically unstable (division by 0-valued weights)
-    nan_ratio_mask = torch.isnan(ratio)
+    # Identify where the ratio is numerically unstable (division by 0-valued weights, e.g. batch norm biases)
+    unstable_ratio_mask = ~torch.isfinite(ratio)
 
     # Replace unstable values by statistically representative measures
-    ratio[nan_ratio_mask] = ratio[~nan_ratio_mask].mean()
+    ratio[unstable_ratio_mask] = ratio[~unstable_ratio_mask].mean()
 
     # Compute the norm of the ratio and move result to CPU (to avoid cluttering GPU if fct is called repeatedly)
     return torch.norm(ratio, p=order).item()
@@ -74,8 +157,8 @@ def weighted_grad_norm(model: NeuralTeleportationModel, data: Tensor, target: Te
 
 def loss_lookahead_diff(model: NeuralTeleportationModel, data: Tensor, target: Tensor,
                         metrics: TrainingMetrics, config: OptimalTeleportationTrainingConfig, **kwargs) -> Number:
-    # Save the state of the model, prior to performing the lookahead
-    state_dict = model.state_dict()
+    # Save a copy of the state of the model, prior to performing the lookahead
+    state_dict = {name: value.clone() for name, value in model.state_dict().items()}
 
     # Initialize a new optimizer to perform lookahead
     optimizer = get_optimizer_from_model_and_config(model, config)
@@ -87,10 +170,12 @@ def loss_lookahead_diff(model: NeuralTeleportationModel, data: Tensor, target: T
 
     # Take a step using the gradient at the teleported point
     loss.backward()
+    optimizer.step()
 
     # Compute loss after the optimizer step
-    lookahead_loss = torch.stack([metrics.criterion(model(data_batch), target_batch)
-                                  for data_batch, target_batch in zip(data, target)]).mean(dim=0)
+    with torch.no_grad():
+        lookahead_loss = torch.stack([metrics.criterion(model(data_batch), target_batch)
+                                      for data_batch, target_batch in zip(data, target)]).mean(dim=0)
 
     # Restore the state of the model prior to the lookahead
     model.load_state_dict(state_dict)
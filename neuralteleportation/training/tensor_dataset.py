@@ -0,0 +1,213 @@
+import os
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from torch import Tensor
+from torch.utils.data import Dataset
+from torchvision.datasets import VisionDataset
+
+
+class BatchTransform:
+    """
+        Tensor equivalent of a torchvision pipeline of transforms, applied to whole batches of uint8 images.
+
+        Only the transforms used by the datasets of the experiments are supported: RandomCrop (with zero padding),
+        RandomHorizontalFlip, ToTensor and Normalize. The random crop and flip of each image of the batch are applied
+        together as a single gather on the padded batch, so the crops must have the size of the images.
+
+    Args:
+        crop_size (Tuple[int, int]): size of the random crop, which must be the size of the images.
+        crop_padding (int): padding of the images before the random crop, no random crop if None.
+        flip_probability (float): probability of flipping each image horizontally.
+        mean (Sequence[float]): mean of each channel used to normalize the images, after scaling them to [0, 1].
+        std (Sequence[float]): standard deviation of each channel used to normalize the images.
+    """
+
+    def __init__(self, crop_size: Tuple[int, int] = None, crop_padding: int = None, flip_probability: float = 0,
+                 mean: Sequence[float] = None, std: Sequence[float] = None):
+        self.crop_size = crop_size
+        self.crop_padding = crop_padding
+        self.flip_probability = flip_probability
+        self.mean = mean
+        self.std = std
+
+    @classmethod
+    def from_transform(cls, transform) -> "BatchTransform":
+        """
+            Create the batch transform equivalent to a torchvision transform.
+
+        Args:
+            transform: torchvision transform or Compose of torchvision transforms.
+
+        Returns:
+            equivalent batch transform.
+        """
+        batch_transform = cls()
+        for t in transform.transforms if isinstance(transform, transforms.Compose) else [transform]:
+            if isinstance(t, transforms.RandomCrop) and not t.pad_if_needed and t.fill == 0 \
+                    and t.padding_mode == 'constant' and isinstance(t.padding, int):
+                batch_transform.crop_size = tuple(t.size)
+                batch_transform.crop_padding = t.padding
+            elif isinstance(t, transforms.RandomHorizontalFlip):
+                batch_transform.flip_probability = t.p
+            elif isinstance(t, transforms.Normalize):
+                batch_transform.mean, batch_transform.std = t.mean, t.std
+            elif not isinstance(t, transforms.ToTensor):
+                raise ValueError(f"Transform {t} is not supported on batches of tensors.")
+        return batch_transform
+
+    def check_image_size(self, image_size: Tuple[int, int]):
+        """
+            Check that the transform can be applied to images of the given size.
+
+        Args:
+            image_size (Tuple[int, int]): height and width of the images.
+
+        Raises:
+            ValueError: if the size of the random crop is not the size of the images.
+        """
+        if self.crop_size is not None and tuple(self.crop_size) != tuple(image_size):
+            raise ValueError(f"Random crops of size {tuple(self.crop_size)} are not supported on batches of images of "
+                             f"size {tuple(image_size)}, the crops must have the size of the images.")
+
+    def __call__(self, images: Tensor) -> Tensor:
+        """
+            Transform a batch of images.
+
+        Args:
+            images (Tensor): uint8 images of shape [batch, channels, height, width].
+
+        Returns:
+            float images of shape [batch, channels, height, width].
+        """
+        if self.crop_padding or self.flip_probability:
+            images = self._crop_and_flip(images)
+
+        images = images.float().div_(255)
+        if self.mean is not None:
+            mean = torch.as_tensor(self.mean, dtype=images.dtype).view(-1, 1, 1)
+            std = torch.as_tensor(self.std, dtype=images.dtype).view(-1, 1, 1)
+            images = images.sub_(mean).div_(std)
+        return images
+
+    def _crop_and_flip(self, images: Tensor) -> Tensor:
+        batch_size, channels, height, width = images.shape
+        self.check_image_size((height, width))
+        padding = self.crop_padding or 0
+        if padding:
+            images = F.pad(images, [padding] * 4)
+
+        rows = torch.arange(height).expand(batch_size, -1)
+        cols = torch.arange(width).expand(batch_size, -1)
+        if padding:
+            rows = rows + torch.randint(0, 2 * padding + 1, (batch_size, 1))
+            cols = cols + torch.randint(0, 2 * padding + 1, (batch_size, 1))
+        if self.flip_probability:
+            flip = torch.rand(batch_size, 1) < self.flip_probability
+            cols = torch.where(flip, cols.flip(-1), cols)
+
+        return images[torch.arange(batch_size)[:, None, None, None], torch.arange(channels)[None, :, None, None],
+                      rows[:, None, :, None], cols[:, None, None, :]]
+
+
+class TensorCacheDataset(Dataset):
+    """
+        Dataset of images decoded once in a memory-mapped uint8 tensor file, transformed by batches.
+
+        The images are stored as an array of shape [N, channels, height, width] in a numpy file, so that the processes
+        loading the dataset share the same pages of memory. When the data loader requests a batch of samples, the
+        images of the whole batch are transformed at once by tensor operations.
+
+    Args:
+        images_path (Path): numpy file of the uint8 images of the dataset.
+        targets (Tensor): targets of the images.
+        transform (BatchTransform): transform applied to batches of images.
+    """
+
+    def __init__(self, images_path: Path, targets: Tensor, transform: BatchTransform = None):
+        self.images_path = Path(images_path)
+        self.targets = targets
+        self.transform = transform
+        self._images = None
+
+    @property
+    def images(self) -> np.ndarray:
+        # The memory map is opened lazily, in each process that loads the dataset
+        if self._images is None:
+            self._images = np.load(str(self.images_path), mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        # Do not pickle the content of the memory map when the dataset is sent to the data loader's workers
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def __getitem__(self, index: int) -> Tuple[Tensor, Tensor]:
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices: Sequence[int]) -> List[Tuple[Tensor, Tensor]]:
+        images = torch.from_numpy(self.images[np.asarray(indices)])
+        if self.transform is not None:
+            images = self.transform(images)
+        targets = self.targets[torch.as_tensor(indices)]
+        return list(zip(images, targets))
+
+    @classmethod
+    def from_vision_dataset(cls, dataset_cls: type, root: Union[str, Path], train: bool, download: bool = True,
+                            transform=None) -> "TensorCacheDataset":
+        """
+            Create a dataset from the images of a torchvision dataset, decoded in a tensor file under the data root.
+
+            The tensor file is only created the first time the split of the dataset is loaded.
+
+        Args:
+            dataset_cls (type): torchvision dataset class (e.g. MNIST or CIFAR10).
+            root (Path): root directory of the data.
+            train (bool): whether to load the train split of the dataset, or the test split.
+            download (bool): whether to download the dataset if the tensor file does not exist.
+            transform: torchvision transform applied to the images, replaced by the equivalent batch transform.
+
+        Returns:
+            dataset of the decoded images.
+        """
+        cache_dir = Path(root) / 'tensor_cache'
+        split = 'train' if train else 'test'
+        images_path = cache_dir / f'{dataset_cls.__name__}_{split}_images.npy'
+        targets_path = cache_dir / f'{dataset_cls.__name__}_{split}_targets.npy'
+
+        if not images_path.exists() or not targets_path.exists():
+            vision_dataset = dataset_cls(str(root), train=train, download=download)
+            images, targets = _decode_vision_dataset(vision_dataset)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            for path, array in [(targets_path, targets), (images_path, images)]:
+                tmp_path = path.with_suffix('.tmp.npy')
+                np.save(str(tmp_path), array)
+                os.replace(str(tmp_path), str(path))
+
+        targets = torch.from_numpy(np.load(str(targets_path))).long()
+        dataset = cls(images_path, targets)
+        if transform is not None:
+            dataset.transform = BatchTransform.from_transform(transform)
+            dataset.transform.check_image_size(dataset.images.shape[-2:])
+        return dataset
+
+
+def _decode_vision_dataset(dataset: VisionDataset) -> Tuple[np.ndarray, np.ndarray]:
+    """Get the images of a torchvision dataset as a uint8 array of shape [N, channels, height, width]."""
+    if hasattr(dataset, 'data'):
+        images = np.asarray(dataset.data)
+    else:
+        images = np.stack([np.asarray(image) for image, _ in dataset])
+    if images.ndim == 3:
+        images = images[:, None]  # Grayscale images
+    elif images.shape[-1] in (1, 3):
+        images = images.transpose(0, 3, 1, 2)  # Channels last images
+    return np.ascontiguousarray(images, dtype=np.uint8), np.asarray(dataset.targets, dtype=np.int64)
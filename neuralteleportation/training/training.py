@@ -1,9 +1,7 @@
-from collections import defaultdict
-from statistics import mean
-from typing import Sequence, Callable, Any, Dict
+import time
+from typing import Sequence, Callable, Any, Dict, Iterable
 
 import numpy as np
-import pandas as pd
 import torch
 from torch import Tensor
 from torch import nn
@@ -12,12 +10,16 @@ from torch.optim.optimizer import Optimizer
 from torch.utils.data import DataLoader, Dataset
 from tqdm import tqdm
 
+from neuralteleportation.metrics import MetricsAccumulator
 from neuralteleportation.training.config import TrainingConfig, TrainingMetrics, TeleportationTrainingConfig
 from neuralteleportation.training.experiment_setup import (
     get_optimizer_from_model_and_config,
-    get_lr_scheduler_from_optimizer_and_config, get_teleportation_epochs,
+    get_lr_scheduler_from_optimizer_and_config, get_teleportation_epochs, get_dataloader_from_dataset_and_config,
 )
-from neuralteleportation.utils.optimtools import get_optimizer_lr, update_optimizer_params
+from neuralteleportation.utils.optimtools import get_optimizer_lr, teleport_optimizer_state
+
+# Minimum time in seconds between two updates of the metrics displayed in the progress bars
+PROGRESS_BAR_INTERVAL = 1.
 
 
 def train(model: nn.Module, train_dataset: Dataset, metrics: TrainingMetrics, config: TrainingConfig,
@@ -29,26 +31,31 @@ def train(model: nn.Module, train_dataset: Dataset, metrics: TrainingMetrics, co
     if config.lr_scheduler is not None:
         lr_scheduler_interval = config.lr_scheduler[1]
 
-    train_loader = DataLoader(
-        train_dataset, batch_size=config.batch_size, shuffle=config.shuffle_batches, drop_last=config.drop_last_batch)
+    train_loader = get_dataloader_from_dataset_and_config(train_dataset, config)
 
     for epoch in range(config.epochs):
         if (isinstance(config, TeleportationTrainingConfig)
                 and epoch in get_teleportation_epochs(config)):
+            params = list(model.parameters())
+            cob = model.get_cob()
             model = config.teleport_fn(model=model, train_dataset=train_dataset, metrics=metrics, config=config)
-            # Force a new optimizer in case the model was swapped as a result of the teleportations
-            # We need to recreate the optimizer with the new model's parameters and update it
-            # with the previous optimizer's parameters otherwise any changes to the old optimizer will be lost
-            old_optimizer_state = optimizer.state_dict()
-            optimizer = get_optimizer_from_model_and_config(model, config)
-            if lr_scheduler:
-                # Similar to the optimizer, the lr scheduler needs to be updated after its recreation.
-                old_scheduler_state = lr_scheduler.state_dict()
-                lr_scheduler = get_lr_scheduler_from_optimizer_and_config(optimizer, config)
-                lr_scheduler.load_state_dict(old_scheduler_state)
-            # update the optimizer, because for certain LrSchedulers, when they are recreated,
-            # they overwrite the previous parameters set in the optimizer (c.f OneCycleLR)
-            optimizer = update_optimizer_params(optimizer, old_optimizer_state)
+            if not _same_parameters(params, model.parameters()):
+                # Force a new optimizer in case the model was swapped as a result of the teleportations
+                # We need to recreate the optimizer with the new model's parameters and update it
+                # with the previous optimizer's state otherwise any changes to the old optimizer will be lost
+                old_optimizer_state = optimizer.state_dict()
+                optimizer = get_optimizer_from_model_and_config(model, config)
+                if lr_scheduler:
+                    # Similar to the optimizer, the lr scheduler needs to be updated after its recreation.
+                    old_scheduler_state = lr_scheduler.state_dict()
+                    lr_scheduler = get_lr_scheduler_from_optimizer_and_config(optimizer, config)
+                    lr_scheduler.load_state_dict(old_scheduler_state)
+                # Load the previous state after recreating the lr scheduler, because for certain LrSchedulers,
+                # when they are recreated, they overwrite the previous parameters set in the optimizer (c.f OneCycleLR)
+                optimizer.load_state_dict(old_optimizer_state)
+            # The state of the optimizer (e.g. momentum) was computed for the weights before teleportation,
+            # so it is teleported along with the weights
+            teleport_optimizer_state(optimizer, model.get_weight_factors(model.get_cob() / cob))
         if lr_scheduler:
             print("Current LR: ", get_optimizer_lr(optimizer))
         train_epoch(model, metrics, optimizer, train_loader, epoch,
@@ -85,18 +92,24 @@ def train(model: nn.Module, train_dataset: Dataset, metrics: TrainingMetrics, co
     return model
 
 
+def _same_parameters(params: Sequence[Tensor], other_params: Iterable[Tensor]) -> bool:
+    """Checks whether two collections of parameters are made of the same parameter objects, in the same order."""
+    other_params = list(other_params)
+    return len(params) == len(other_params) and all(p is q for p, q in zip(params, other_params))
+
+
 def train_epoch(model: nn.Module, metrics: TrainingMetrics, optimizer: Optimizer, train_loader: DataLoader, epoch: int,
                 device: str = 'cpu', progress_bar: bool = True, config: TrainingConfig = None, lr_scheduler=None) -> None:
     lr_scheduler_interval = None
     if config.lr_scheduler is not None:
         lr_scheduler_interval = config.lr_scheduler[1]
-    
-    # Init data structures to keep track of the metrics at each batch
-    metrics_by_batch = {metric.__name__: [] for metric in metrics.metrics}
-    metrics_by_batch.update(loss=[])
-    
+
+    # Keep running sums of the metrics on the device, to avoid waiting for the device at each batch
+    accumulator = MetricsAccumulator()
+
     model.train()
     pbar = tqdm(enumerate(train_loader))
+    last_display = time.monotonic()
     for batch_idx, (data, target) in pbar:
         if batch_idx == config.max_batch:
             break
@@ -104,12 +117,13 @@ def train_epoch(model: nn.Module, metrics: TrainingMetrics, optimizer: Optimizer
         optimizer.zero_grad()
         output = model(data)
         loss = metrics.criterion(output, target)
-        metrics_by_batch["loss"].append(loss.item())
-        for metric in metrics.metrics:
-            metrics_by_batch[metric.__name__].append(metric(output, target))
+        batch_results = compute_metrics(metrics.metrics, y=target, y_hat=output, to_tensor=False)
+        batch_results.update(loss=loss)
+        accumulator.update(batch_results, batch_size=len(target))
         loss.backward()
         optimizer.step()
-        if progress_bar:
+        if progress_bar and time.monotonic() - last_display >= PROGRESS_BAR_INTERVAL:
+            # Reading the loss synchronizes with the device, so the progress bar is only updated periodically
             output = 'Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(epoch,
                                                                               (batch_idx + 1) *
                                                                               train_loader.batch_size,
@@ -118,6 +132,7 @@ def train_epoch(model: nn.Module, metrics: TrainingMetrics, optimizer: Optimizer
                                                                               len(train_loader),
                                                                               loss.item())
             pbar.set_postfix_str(output)
+            last_display = time.monotonic()
         if lr_scheduler and lr_scheduler_interval == "step":
             lr_scheduler.step()
     pbar.update()
@@ -125,7 +140,7 @@ def train_epoch(model: nn.Module, metrics: TrainingMetrics, optimizer: Optimizer
 
     # Log the mean of each metric at the end of the epoch
     if config is not None and config.logger is not None:
-        reduced_metrics = {metric: mean(values_by_batch) for metric, values_by_batch in metrics_by_batch.items()}
+        reduced_metrics = accumulator.compute()
         config.logger.log_metrics(reduced_metrics, epoch=epoch)
         for metric_name, value in reduced_metrics.items():
             config.logger.add_scalar(f"train_{metric_name}", value, epoch)
@@ -134,31 +149,34 @@ def train_epoch(model: nn.Module, metrics: TrainingMetrics, optimizer: Optimizer
 def test(model: nn.Module, dataset: Dataset,
          metrics: TrainingMetrics, config: TrainingConfig,
          eval_mode: bool = True) -> Dict[str, Any]:
-    test_loader = DataLoader(dataset, batch_size=config.batch_size)
+    test_loader = get_dataloader_from_dataset_and_config(dataset, config, train=False)
     if eval_mode:
         model.eval()
-    results = defaultdict(list)
+    # Keep running sums of the metrics on the device, to avoid waiting for the device at each batch
+    accumulator = MetricsAccumulator()
     pbar = tqdm(enumerate(test_loader))
+    last_display = time.monotonic()
     with torch.no_grad():
         for i, (data, target) in pbar:
             if i == config.max_batch:
                 break
             data, target = data.to(config.device), target.to(config.device)
             output = model(data)
-            results['loss'].append(metrics.criterion(output, target).item())
+            batch_results = {'loss': metrics.criterion(output, target)}
 
             if metrics is not None:
-                batch_results = compute_metrics(
-                    metrics.metrics, y=target, y_hat=output, to_tensor=False)
-                for k in batch_results.keys():
-                    results[k].append(batch_results[k])
+                batch_results.update(compute_metrics(
+                    metrics.metrics, y=target, y_hat=output, to_tensor=False))
+            accumulator.update(batch_results, batch_size=len(target))
 
             pbar.update()
-            pbar.set_postfix(loss=pd.DataFrame(results['loss']).mean().values,
-                             accuracy=pd.DataFrame(results['accuracy']).mean().values)
+            if time.monotonic() - last_display >= PROGRESS_BAR_INTERVAL:
+                # Reading the running means synchronizes with the device, so they are only displayed periodically
+                pbar.set_postfix(accumulator.compute())
+                last_display = time.monotonic()
 
     pbar.close()
-    reduced_results = dict(pd.DataFrame(results).mean())
+    reduced_results = accumulator.compute()
     if config.logger is not None:
         config.logger.log_metrics(reduced_results, epoch=0)
     return reduced_results
@@ -169,7 +187,7 @@ def compute_metrics(metrics: Sequence[Callable[[Tensor, Tensor], Tensor]], y_hat
     results = {}
     for metric in metrics:
         m = metric(y_hat, y)
-        if to_tensor:
+        if to_tensor and not isinstance(m, Tensor):
             m = torch.tensor(m)
         results[prefix + metric.__name__] = m
     return results
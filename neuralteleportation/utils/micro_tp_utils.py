@@ -313,7 +313,8 @@ def micro_teleportation_dot_product(network, dataset, nb_teleport=100, network_d
 def dot_product_between_teleportation(network, dataset,
                                       network_descriptor=None,
                                       nb_teleport=100,
-                                      device='cpu') -> None:
+                                      device='cpu',
+                                      teleport_batch_size=10) -> None:
     """
     This method tests the scalar product between the initial and teleported set of weights and plots the results with
     respect to the order of magnitude of the change of basis of the teleportation
@@ -329,6 +330,8 @@ def dot_product_between_teleportation(network, dataset,
                                 calculation
 
         device:                 Device used to compute the network operations ('cpu' or 'cuda')
+
+        teleport_batch_size:    Number of teleportations of the weights computed at once
     """
     series_dir = f'images/series_dot_prod_vs_cob/{network_descriptor}'
 
@@ -361,17 +364,17 @@ def dot_product_between_teleportation(network, dataset,
         dot_product_result = 0
         angle = 0
 
-        for _ in tqdm(range(0, nb_teleport)):
-            # reset the weights
-            model.set_weights(w1)
-
-            # teleport and get the new weights
-            model.random_teleport(cob_range=cob, sampling_type='intra_landscape')
-            w2 = model.get_weights().detach().to(device)
+        for i in tqdm(range(0, nb_teleport, teleport_batch_size)):
+            # teleport the initial weights with a batch of random cobs at once
+            random_cobs = torch.stack([model.generate_random_cob(cob_range=cob, sampling_type='intra_landscape')
+                                       for _ in range(min(teleport_batch_size, nb_teleport - i))])
+            with torch.no_grad():
+                w2 = model.get_teleported_weights(random_cobs, reset_teleportation=False).to(device)
 
             # cos(theta) = (w1 w2)/(||w1|| ||w2||)
-            dot_product_result += normalized_dot_product(w1, w2)
-            angle += np.degrees(torch.acos(normalized_dot_product(w1, w2)).cpu())
+            normalized_dot_products = torch.matmul(w2, w1) / (tensor_norm(w1) * w2.norm(dim=1))
+            dot_product_result += normalized_dot_products.sum()
+            angle += np.degrees(torch.acos(normalized_dot_products).sum().cpu())
 
         dot_product_result /= nb_teleport
         angle /= nb_teleport
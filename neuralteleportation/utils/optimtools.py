@@ -1,7 +1,20 @@
+from typing import Dict
+
+import torch
 import torch.nn as nn
+from torch import optim
 from torch.nn import init
 from torch.optim import Optimizer
 
+# Names of the states of each optimizer, by the power of the inverse of the weight factor by which they are scaled
+# when the weights are teleported: 1 for states that accumulate gradients, 2 for states that accumulate squared
+# gradients, and 0 for states that accumulate normalized gradients (only their sign changes).
+__optimizer_state_powers__ = {optim.SGD: {"momentum_buffer": 1},
+                              optim.Adam: {"exp_avg": 1, "exp_avg_sq": 2, "max_exp_avg_sq": 2},
+                              optim.AdamW: {"exp_avg": 1, "exp_avg_sq": 2, "max_exp_avg_sq": 2},
+                              optim.RMSprop: {"square_avg": 2, "grad_avg": 1, "momentum_buffer": 0},
+                              optim.Adagrad: {"sum": 2}}
+
 
 def get_optimizer_lr(optimizer: Optimizer) -> float:
     for param_group in optimizer.param_groups:
@@ -17,6 +30,40 @@ def update_optimizer_params(optimizer: Optimizer, new_state) -> Optimizer:
     return optimizer
 
 
+def teleport_optimizer_state(optimizer: Optimizer, weight_factors: Dict[torch.Tensor, torch.Tensor]) -> Optimizer:
+    """Transform the state of an optimizer in place, consistently with a teleportation of the parameters.
+
+    When a parameter is scaled by a factor f, the gradient of the loss with respect to the parameter is scaled by 1 / f.
+    The states accumulating gradients (e.g. momentum and Adam's first moment) are therefore divided by f, and the states
+    accumulating squared gradients (e.g. Adam's second moment) by f^2. RMSprop's momentum accumulates gradients
+    normalized by the root of the second moment, so only its sign changes.
+
+    The state of the parameters is reset for optimizers whose state is not supported (c.f.
+    ``__optimizer_state_powers__``), since it cannot be teleported.
+
+    Args:
+        optimizer: Optimizer of the parameters.
+        weight_factors: Factor by which each teleported parameter was scaled (c.f.
+            ``NeuralTeleportationModel.get_weight_factors``).
+
+    Returns:
+        The optimizer, with its state transformed in place.
+    """
+    state_powers = __optimizer_state_powers__.get(type(optimizer))
+    with torch.no_grad():
+        for param, factor in weight_factors.items():
+            if param not in optimizer.state:
+                continue
+            if state_powers is None:
+                del optimizer.state[param]
+                continue
+            for name, value in optimizer.state[param].items():
+                if name in state_powers and torch.is_tensor(value) and value.shape == param.shape:
+                    power = state_powers[name]
+                    value.div_(factor.to(value).pow(power) if power else factor.to(value).sign())
+    return optimizer
+
+
 def initialize_model(model, init_type: str, init_gain: float, non_linearity: str = None) -> nn.Module:
     def init_func(m):
         if init_type == 'none': # use the default initialization
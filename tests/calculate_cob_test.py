@@ -18,7 +18,8 @@ def test_calculate_cob(network, model_name=None, input_shape=(1, 1, 28, 28), noi
     model_name = model_name or network.__class__.__name__
     model = NeuralTeleportationModel(network=network, input_shape=input_shape)
 
-    w1 = model.get_weights(concat=False, flatten=False, bias=False)
+    # Teleportation is applied in place, so the initial weights must be copied before teleporting.
+    w1 = [w.detach().clone() for w in model.get_weights(concat=False, flatten=False, bias=False)]
     model.random_teleport()
     w2 = model.get_weights(concat=False, flatten=False, bias=False)
 
@@ -59,7 +60,7 @@ def test_calculate_cob_weights(network, model_name=None, input_shape=(1, 1, 28,
     model = NeuralTeleportationModel(network=network, input_shape=input_shape)
 
     initial_weights = model.get_weights()
-    w1 = model.get_weights(concat=False, flatten=False, bias=False)
+    w1 = [w.detach().clone() for w in model.get_weights(concat=False, flatten=False, bias=False)]
 
     model.random_teleport()
     c1 = model.get_cob()
@@ -158,3 +159,29 @@ if __name__ == '__main__':
     test_calculate_cob(network=mlp_model, model_name="MLP", verbose=True)
     test_calculate_cob_weights(network=mlp_model, model_name="MLP", verbose=True)
     test_calculate_ones(network=mlp_model, model_name="MLP", verbose=True)
+
+    from neuralteleportation.models.generic_models.residual_models import ResidualNet
+    from neuralteleportation.models.generic_models.dense_models import DenseNet2
+    from neuralteleportation.models.model_zoo.unetcob import UNetCOB
+
+    from neuralteleportation.layers.activation import ReLUCOB
+    from neuralteleportation.layers.neuron import Conv2dCOB, BatchNorm2dCOB, LinearCOB
+    from neuralteleportation.layers.neuralteleportation import FlattenCOB
+
+    cnn_model = torch.nn.Sequential(
+        Conv2dCOB(1, 16, 3),
+        BatchNorm2dCOB(16),
+        ReLUCOB(),
+        Conv2dCOB(16, 32, 3, stride=2),
+        ReLUCOB(),
+        FlattenCOB(),
+        LinearCOB(32 * 12 * 12, 10)
+    )
+
+    for network, model_name, input_shape in [(cnn_model, "CNN", (1, 1, 28, 28)),
+                                             (ResidualNet(), "ResidualNet", (1, 1, 28, 28)),
+                                             (DenseNet2(), "DenseNet2", (1, 1, 28, 28)),
+                                             (UNetCOB(input_channels=1, output_channels=4), "UNet", (1, 1, 32, 32))]:
+        test_calculate_cob(network=network, model_name=model_name, input_shape=input_shape)
+        test_calculate_cob_weights(network=network, model_name=model_name, input_shape=input_shape, verbose=False)
+        test_calculate_ones(network=network, model_name=model_name, input_shape=input_shape)
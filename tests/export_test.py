@@ -0,0 +1,59 @@
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from neuralteleportation.export import export_network
+from neuralteleportation.layers.neuralteleportation import NeuralTeleportationLayerMixin
+from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
+
+
+def test_export_network(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None,
+                        sampling_type: str = 'intra_landscape'):
+    """
+        Test that the network exported from a teleported model contains no change of basis layer and has the same
+        outputs as the teleported model.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+        sampling_type (str): Sampling type of the change of basis
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape)
+    x = torch.rand((4,) + tuple(input_shape[1:]))
+
+    # Update the running statistics of batch norm layers.
+    model.train()
+    model(x)
+    model.eval()
+
+    model.random_teleport(cob_range=0.9, sampling_type=sampling_type)
+    w1 = model.get_weights().detach().clone()
+    pred1 = model(x).detach()
+
+    exported_network = export_network(model)
+    pred2 = exported_network(x).detach()
+
+    assert not any(isinstance(m, NeuralTeleportationLayerMixin) for m in exported_network.modules())
+    assert np.allclose(w1.numpy(), model.get_weights().detach().numpy()), "Model was modified."
+    assert np.allclose(pred1.numpy(), pred2.numpy(), atol=1e-5), \
+        "Export did not work for model {}. Average difference: {}".format(model_name, (pred1 - pred2).abs().mean())
+
+    print("Export successful for " + model_name + " model with " + sampling_type + " sampling.")
+
+
+if __name__ == '__main__':
+    from tests.cobmodels_test import MLP, Net, Net2, Net3, Net4, ConvTransposeNet
+    from neuralteleportation.models.generic_models.residual_models import ResidualNet2
+    from neuralteleportation.models.generic_models.dense_models import DenseNet3
+    from neuralteleportation.models.model_zoo.resnetcob import resnet18COB
+
+    for model in [MLP, Net, Net2, Net3, Net4, ConvTransposeNet, ResidualNet2, DenseNet3]:
+        test_export_network(model())
+        test_export_network(model(), sampling_type='inter_landscape')
+
+    test_export_network(resnet18COB(num_classes=10), input_shape=(1, 3, 32, 32), model_name="resnet18COB")
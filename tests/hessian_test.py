@@ -0,0 +1,162 @@
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
+
+
+def test_hessian_vector_product(network: nn.Module, input_shape: Tuple = (4, 1, 8, 8), model_name: str = None):
+    """
+        Test that the Hessian-vector product is the same as the product with the dense Hessian.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network.double(), input_shape=input_shape)
+    data, target = torch.rand(input_shape, dtype=torch.double), torch.randint(0, 10, (input_shape[0],))
+    loss_fn = nn.CrossEntropyLoss()
+
+    hessian = model.get_hessian(data, target, loss_fn).detach().double()
+    vector = torch.rand(hessian.shape[0], dtype=torch.double)
+    hvp = model.get_hessian_vector_product(data, target, loss_fn, vector)
+
+    assert np.allclose(hessian.matmul(vector).numpy(), hvp.numpy()), "Hessian-vector product is wrong."
+
+    print("Hessian-vector product successful for " + model_name + " model.")
+
+
+def test_hessian_trace(network: nn.Module, input_shape: Tuple = (4, 1, 8, 8), model_name: str = None):
+    """
+        Test that the Hutchinson estimate of the trace of the Hessian is close to the exact trace, and that the
+        traces of the layers sum to the trace.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network.double(), input_shape=input_shape)
+    data, target = torch.rand(input_shape, dtype=torch.double), torch.randint(0, 10, (input_shape[0],))
+    loss_fn = nn.CrossEntropyLoss()
+
+    trace = model.get_hessian(data, target, loss_fn).detach().diagonal().sum()
+    torch.manual_seed(0)
+    estimated_trace = model.get_hessian_trace(data, target, loss_fn, max_probes=1000, tol=1e-3)
+    torch.manual_seed(0)
+    layer_traces = model.get_layer_hessian_traces(data, target, loss_fn, max_probes=1000, tol=1e-3)
+
+    assert len(layer_traces) == len(model.get_neuron_layers())
+    assert np.isclose(estimated_trace.item(), layer_traces.sum().item())
+    assert np.isclose(trace.item(), estimated_trace.item(), rtol=0.2), \
+        "Trace estimate {} is far from the trace {}".format(estimated_trace, trace)
+
+    print("Hessian trace successful for " + model_name + " model.")
+
+
+def test_layer_hessians(network: nn.Module, input_shape: Tuple = (4, 1, 8, 8), model_name: str = None):
+    """
+        Test that the Hessian of each layer is its diagonal block of the dense Hessian.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network.double(), input_shape=input_shape)
+    data, target = torch.rand(input_shape, dtype=torch.double), torch.randint(0, 10, (input_shape[0],))
+    loss_fn = nn.CrossEntropyLoss()
+
+    hessian = model.get_hessian(data, target, loss_fn).detach()
+    layer_hessians = model.get_layer_hessians(data, target, loss_fn)
+
+    assert len(layer_hessians) == len(model.get_neuron_layers())
+    start = 0
+    for layer_hessian in layer_hessians:
+        end = start + len(layer_hessian)
+        assert np.allclose(hessian[start:end, start:end].numpy(), layer_hessian.numpy()), "Layer Hessian is wrong."
+        start = end
+    assert start == len(hessian)
+
+    print("Layer Hessians successful for " + model_name + " model.")
+
+
+def test_hessian_top_eigenvalues(network: nn.Module, input_shape: Tuple = (4, 1, 8, 8), model_name: str = None,
+                                 k: int = 3):
+    """
+        Test that the top eigenvalues of the Hessian are the eigenvalues of the dense Hessian with the largest
+        magnitude, and that a warm started call converges faster.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+        k (int): Number of eigenvalues
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network.double(), input_shape=input_shape)
+    data, target = torch.rand(input_shape, dtype=torch.double), torch.randint(0, 10, (input_shape[0],))
+    loss_fn = nn.CrossEntropyLoss()
+
+    hessian = model.get_hessian(data, target, loss_fn).detach().double()
+    hessian_eigenvalues = torch.linalg.eigvalsh(hessian)
+    hessian_eigenvalues = hessian_eigenvalues[hessian_eigenvalues.abs().argsort(descending=True)][:k]
+
+    eigenvalues = model.get_hessian_top_eigenvalues(data, target, loss_fn, k=k, max_iter=1000, tol=1e-6)
+    assert np.allclose(hessian_eigenvalues.numpy(), eigenvalues.numpy(), rtol=1e-4), \
+        "Top eigenvalues {} are different from {}".format(eigenvalues, hessian_eigenvalues)
+
+    warm_eigenvalues = model.get_hessian_top_eigenvalues(data, target, loss_fn, k=k, max_iter=1)
+    assert np.allclose(hessian_eigenvalues.numpy(), warm_eigenvalues.numpy(), rtol=1e-4)
+
+    try:
+        model.get_hessian_top_eigenvalues(data, target, loss_fn, k=k, max_iter=0)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Hessian top eigenvalues accepted zero iterations.")
+
+    print("Hessian top eigenvalues successful for " + model_name + " model.")
+
+
+if __name__ == '__main__':
+    from torch.nn.modules import Flatten
+    from neuralteleportation.layers.layer_utils import swap_model_modules_for_COB_modules
+
+    torch.manual_seed(0)
+
+    mlp_model = swap_model_modules_for_COB_modules(torch.nn.Sequential(
+        Flatten(),
+        nn.Linear(64, 8),
+        nn.ReLU(),
+        nn.Linear(8, 10)
+    ))
+
+    cnn_model = swap_model_modules_for_COB_modules(torch.nn.Sequential(
+        nn.Conv2d(1, 2, 3),
+        nn.ReLU(),
+        Flatten(),
+        nn.Linear(72, 10)
+    ))
+
+    test_hessian_vector_product(mlp_model, model_name="MLP")
+    test_hessian_vector_product(cnn_model, model_name="Convolutional")
+
+    test_hessian_trace(mlp_model, model_name="MLP")
+    test_hessian_trace(cnn_model, model_name="Convolutional")
+
+    test_layer_hessians(mlp_model, model_name="MLP")
+    test_layer_hessians(cnn_model, model_name="Convolutional")
+
+    test_hessian_top_eigenvalues(mlp_model, model_name="MLP")
+    test_hessian_top_eigenvalues(cnn_model, model_name="Convolutional")
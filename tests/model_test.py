@@ -1,3 +1,4 @@
+import copy
 from typing import Tuple
 
 import numpy as np
@@ -73,6 +74,221 @@ def test_teleport(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), verbo
     return diff_average
 
 
+def test_teleport_preserves_parameters(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28),
+                                      model_name: str = None):
+    """
+        Test that teleportation and set_weights() update the parameters in place, so that an optimizer created before
+        the teleportation is still attached to the model's parameters.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape)
+    params = list(model.parameters())
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    w1 = model.get_weights().detach().clone()
+
+    model.random_teleport()
+    model.set_weights(model.get_weights().detach())
+    model.undo_teleportation()
+
+    assert all(p is q for p, q in zip(params, model.parameters())), "Parameters were replaced."
+    assert all(p is q for p, q in zip(params, optimizer.param_groups[0]['params']))
+    assert np.allclose(w1.numpy(), model.get_weights().detach().numpy(), atol=1e-5)
+
+    print("In place teleportation successful for " + model_name + " model.")
+
+
+def test_batched_teleported_weights(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28),
+                                    model_name: str = None, nb_cobs: int = 4):
+    """
+        Test that the weights teleported with a batch of cobs are the same as the weights obtained by teleporting
+        the model with each cob one after the other.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+        nb_cobs (int): Number of cobs in the batch
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape)
+    model.random_teleport()
+    w1 = model.get_weights().detach().clone()
+    cob1 = model.get_cob()
+
+    cobs = torch.stack([model.generate_random_cob() for _ in range(nb_cobs)])
+    batched_weights = model.get_teleported_weights(cobs).detach()
+
+    assert batched_weights.shape == (nb_cobs, w1.shape[0])
+    assert np.allclose(w1.numpy(), model.get_weights().detach().numpy()), "Model was modified."
+    for cob, weights in zip(cobs, batched_weights):
+        model.teleport(cob)
+        assert np.allclose(weights.numpy(), model.get_weights().detach().numpy(), rtol=1e-4, atol=1e-5)
+        model.teleport(cob1)
+
+    print("Batched teleportation successful for " + model_name + " model.")
+
+
+def test_flat_weights(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None):
+    """
+        Test that flattening the weights of the model preserves the weights and the parameters, and that
+        get_weights() and set_weights() then use the flat weights tensor.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape)
+    params = list(model.parameters())
+    w1 = model.get_weights().detach().clone()
+
+    model.flatten_weights()
+    w2 = model.get_weights()
+
+    assert all(p is q for p, q in zip(params, model.parameters())), "Parameters were replaced."
+    assert np.allclose(w1.numpy(), w2.numpy()), "Weights changed when flattened."
+    assert w2.data_ptr() == model.get_weights().data_ptr(), "get_weights() copied the flat weights."
+
+    model.random_teleport()
+    assert np.allclose(w2.numpy(), torch.cat([p.flatten() for p in params]).detach().numpy())
+
+    model.set_weights(w1)
+    assert np.allclose(w1.numpy(), torch.cat([p.flatten() for p in params]).detach().numpy())
+
+    print("Flat weights successful for " + model_name + " model.")
+
+
+def test_repeated_teleport(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None,
+                           nb_teleport: int = 100):
+    """
+        Test that undoing the teleportation after many teleportations gives back the initial weights.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+        nb_teleport (int): Number of teleportations with and without reset
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape)
+    w1 = model.get_weights().detach().clone()
+
+    for _ in range(nb_teleport):
+        model.random_teleport(cob_range=0.9)
+    for _ in range(nb_teleport):
+        model.random_teleport(reset_teleportation=False)
+    model.undo_teleportation()
+
+    assert np.allclose(w1.numpy(), model.get_weights().detach().numpy(), atol=1e-5)
+    assert np.allclose(model.get_cob().numpy(), 1)
+
+    print("Repeated teleportations successful for " + model_name + " model.")
+
+
+def test_get_grad_batches(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None,
+                          nb_batches: int = 5):
+    """
+        Test that the mean and variance of the gradients accumulated over batches are the same as the statistics of
+        the gradients of each batch.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+        nb_batches (int): Number of batches
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape)
+    loss_fn = nn.CrossEntropyLoss()
+    batches = [(torch.rand((4,) + tuple(input_shape[1:])), torch.randint(0, 10, (4,))) for _ in range(nb_batches)]
+
+    grads = torch.stack([model.get_grad(data, target, loss_fn) for data, target in batches])
+    mean, var = model.get_grad(batches, loss_fn=loss_fn, variance=True)
+
+    # The network may have been teleported by previous tests, so the tolerance is relative to the gradients' scale
+    scale = grads.abs().max().item()
+    assert np.allclose(grads.mean(dim=0).numpy(), mean.numpy(), rtol=1e-4, atol=1e-5 * scale)
+    assert np.allclose(grads.var(dim=0).numpy(), var.numpy(), rtol=1e-4, atol=1e-5 * scale ** 2)
+    assert np.allclose(mean.numpy(), model.get_grad(batches, loss_fn=loss_fn).numpy())
+
+    print("Gradients over batches successful for " + model_name + " model.")
+
+
+def test_per_sample_grad(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None,
+                         batch_size: int = 4):
+    """
+        Test that the per-sample gradients are the same as the gradients computed on each sample separately.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+        batch_size (int): Number of samples
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape)
+    model.eval()
+    model.random_teleport()
+    loss_fn = nn.CrossEntropyLoss()
+    data, target = torch.rand((batch_size,) + tuple(input_shape[1:])), torch.randint(0, 10, (batch_size,))
+
+    grads = torch.stack([model.get_grad(data[i:i + 1], target[i:i + 1], loss_fn) for i in range(batch_size)])
+    per_sample_grads = model.get_per_sample_grad(data, target, loss_fn).detach()
+    statistics = model.get_per_sample_grad_statistics(data, target, loss_fn)
+
+    atol = 1e-5 * grads.abs().max().item()
+    assert per_sample_grads.shape == grads.shape
+    assert np.allclose(grads.numpy(), per_sample_grads.numpy(), rtol=1e-4, atol=atol)
+    assert np.allclose(grads.mean(dim=0).numpy(), statistics['mean'].numpy(), rtol=1e-4, atol=atol)
+    assert np.allclose(grads.pow(2).mean(dim=0).numpy(), statistics['fisher_diagonal'].numpy(), rtol=1e-4,
+                       atol=atol * grads.abs().max().item())
+
+    print("Per-sample gradients successful for " + model_name + " model.")
+
+
+def test_inplace_activations(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None):
+    """
+        Test that the teleported network with inplace activations has the same outputs and gradients as the same
+        network with out-of-place activations.
+
+    Args:
+        network (nn.Module): Network to be tested, with inplace activations
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape)
+    model.random_teleport(sampling_type='inter_landscape')
+
+    out_of_place_model = copy.deepcopy(model)
+    for module in out_of_place_model.modules():
+        if hasattr(module, 'inplace'):
+            module.inplace = False
+
+    loss_fn = nn.CrossEntropyLoss()
+    data, target = torch.rand((4,) + tuple(input_shape[1:])), torch.randint(0, 10, (4,))
+    grad = model.get_grad(data, target, loss_fn)
+    expected_grad = out_of_place_model.get_grad(data, target, loss_fn)
+
+    assert np.allclose(grad.numpy(), expected_grad.numpy(), rtol=1e-4, atol=1e-5 * expected_grad.abs().max().item())
+    with torch.no_grad():
+        assert np.allclose(model(data).numpy(), out_of_place_model(data).numpy(), atol=1e-5)
+
+    print("Inplace activations successful for " + model_name + " model.")
+
+
 def test_reset_weights(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None):
     """
         test_reset_weights checks if method reset_weights() in NeuralTeleportationModel works
@@ -130,6 +346,31 @@ def test_set_cob(network, model_name, input_shape=(1, 1, 28, 28), verbose=False)
     print("Set cob successful for " + model_name + " model.")
 
 
+def test_set_cob_with_ones(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None):
+    """
+        Test if a cob containing the input and output ones can be set back to the network.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network, input_shape=input_shape)
+    model.random_teleport()
+    cob = model.get_cob()
+    cob_with_ones = model.get_cob(contain_ones=True)
+
+    model.initialize_cob()
+    model.set_change_of_basis(cob_with_ones, contains_ones=True)
+
+    assert torch.allclose(model.get_cob(), cob), "Set cob with ones did not work."
+    assert torch.allclose(model.get_cob(contain_ones=True), cob_with_ones), "Set cob with ones did not work."
+
+    print("Set cob with ones successful for " + model_name + " model.")
+
+
 def test_multiple_teleport(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), verbose: bool = False,
                            atol: float = 1e-5, model_name: str = None):
     """
@@ -177,7 +418,10 @@ def test_multiple_teleport(network: nn.Module, input_shape: Tuple = (1, 1, 28, 2
 if __name__ == '__main__':
     import torch.nn as nn
     from torch.nn.modules import Flatten
+    from neuralteleportation.layers.activation import ELUCOB, LeakyReLUCOB, ReLUCOB
     from neuralteleportation.layers.layer_utils import swap_model_modules_for_COB_modules
+    from neuralteleportation.layers.neuralteleportation import FlattenCOB
+    from neuralteleportation.layers.neuron import BatchNorm2dCOB, Conv2dCOB, ConvTranspose2dCOB, LinearCOB
 
     cnn_model = torch.nn.Sequential(
         nn.Conv2d(1, 32, 3, 1),
@@ -214,15 +458,59 @@ if __name__ == '__main__':
 
     test_set_weights(network=mlp_relu_model, model_name="MLP")
     test_teleport(network=mlp_relu_model, model_name="MLP")
+    test_teleport_preserves_parameters(network=mlp_relu_model, model_name="MLP")
+    test_batched_teleported_weights(network=mlp_relu_model, model_name="MLP")
+    test_flat_weights(network=mlp_relu_model, model_name="MLP")
     test_reset_weights(network=mlp_relu_model, model_name="MLP")
 
     test_set_weights(network=cnn_model, model_name="Convolutional")
     test_teleport(network=cnn_model, model_name="Convolutional")
+    test_teleport_preserves_parameters(network=cnn_model, model_name="Convolutional")
+    test_batched_teleported_weights(network=cnn_model, model_name="Convolutional")
+    test_flat_weights(network=cnn_model, model_name="Convolutional")
     test_reset_weights(network=cnn_model, model_name="Convolutional")
 
     test_set_cob(network=mlp_relu_model, model_name="MLP")
     test_set_cob(network=cnn_model, model_name="Convolutional")
 
+    test_set_cob_with_ones(network=mlp_relu_model, model_name="MLP")
+    test_set_cob_with_ones(network=cnn_model, model_name="Convolutional")
+
     test_multiple_teleport(network=mlp_relu_model, model_name="MLP")
     test_multiple_teleport(network=cnn_model, model_name="Convolutional")
     test_multiple_teleport(network=mlp_nonlinear_model, model_name="MLP")
+
+    test_repeated_teleport(network=mlp_relu_model, model_name="MLP")
+    test_repeated_teleport(network=cnn_model, model_name="Convolutional")
+
+    test_get_grad_batches(network=mlp_relu_model, model_name="MLP")
+    test_get_grad_batches(network=cnn_model, model_name="Convolutional")
+
+    test_per_sample_grad(network=mlp_relu_model, model_name="MLP")
+    test_per_sample_grad(network=cnn_model, model_name="Convolutional")
+
+    # Layers without a closed form of the per-sample gradients
+    generic_cnn_model = torch.nn.Sequential(
+        Conv2dCOB(1, 4, 3, stride=2, padding=1, padding_mode='circular'),
+        ReLUCOB(),
+        ConvTranspose2dCOB(4, 2, 3, stride=2),
+        ReLUCOB(),
+        FlattenCOB(),
+        LinearCOB(2 * 29 * 29, 10)
+    )
+    test_per_sample_grad(network=generic_cnn_model, model_name="Generic convolutional")
+
+    inplace_cnn_model = torch.nn.Sequential(
+        Conv2dCOB(1, 16, 3, 1),
+        BatchNorm2dCOB(16),
+        ReLUCOB(inplace=True),
+        Conv2dCOB(16, 16, 3, stride=2),
+        BatchNorm2dCOB(16),
+        LeakyReLUCOB(inplace=True),
+        Conv2dCOB(16, 16, 3, stride=2),
+        BatchNorm2dCOB(16),
+        ELUCOB(inplace=True),
+        FlattenCOB(),
+        LinearCOB(400, 10, bias=False)
+    )
+    test_inplace_activations(network=inplace_cnn_model, model_name="Inplace convolutional")
@@ -9,6 +9,43 @@ class TestDensenetCOB(TestCase, TestTorchVisionModels):
     models_functions = [densenet121COB]
     default_input_shape = (1, 3, 224, 224)
 
+    def test_shared_storage(self):
+        """
+        Test that concatenating the features of the dense blocks in a shared storage gives the same gradients for a
+        teleported model, and that it reduces the memory of the tensors saved for the backward pass.
+        """
+        import torch
+        from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
+
+        x = torch.rand(4, 3, 32, 32)
+        y = torch.randint(0, 10, (4,))
+        cob = None
+        grads, saved_bytes = [], []
+        for shared_storage in [False, True]:
+            torch.manual_seed(0)
+            network = DenseNetCOB(12, (6, 12), 16, num_classes=10, shared_storage=shared_storage)
+            model = NeuralTeleportationModel(network, input_shape=(2, 3, 32, 32))
+            cob = model.generate_random_cob(sampling_type='inter_landscape') if cob is None else cob
+            model.teleport(cob)
+            model.train()
+
+            storages = {}
+
+            def save_storage(tensor):
+                storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+                return tensor
+
+            for _ in range(2):  # A new storage must be used for every forward pass
+                model.zero_grad()
+                storages.clear()
+                with torch.autograd.graph.saved_tensors_hooks(save_storage, lambda tensor: tensor):
+                    loss = torch.nn.functional.cross_entropy(model(x), y)
+                loss.backward()
+            grads.append(torch.cat([p.grad.flatten() for p in model.parameters()]))
+            saved_bytes.append(sum(storages.values()))
+
+        assert torch.allclose(grads[0], grads[1], atol=1e-6)
+        assert saved_bytes[1] < 0.9 * saved_bytes[0]
 
 if __name__ == '__main__':
     unittest.main()
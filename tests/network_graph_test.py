@@ -0,0 +1,91 @@
+import tempfile
+from typing import Tuple
+from unittest import mock
+
+import torch
+import torch.nn as nn
+
+from neuralteleportation.network_graph import NetworkGrapher, _get_class_source_digest
+
+
+def test_graph_cache(network_fn, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None):
+    """
+        Test that the graph loaded from the memory and disk caches is the same as the graph computed from the network,
+        and that its layers are the modules of the new network.
+
+    Args:
+        network_fn (Callable): function that creates the network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+    """
+    network = network_fn().eval()
+    model_name = model_name or network.__class__.__name__
+    sample_input = torch.rand(input_shape)
+    graph = NetworkGrapher(network, sample_input, use_cache=False).graph
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        NetworkGrapher.clear_cache()
+        NetworkGrapher(network, sample_input, cache_dir=cache_dir)
+
+        new_network = network_fn().eval()
+        expected_graph = NetworkGrapher(new_network, sample_input, use_cache=False).graph
+        memory_graph = NetworkGrapher(new_network, sample_input).graph
+
+        NetworkGrapher.clear_cache()
+        disk_graph = NetworkGrapher(new_network, sample_input, cache_dir=cache_dir).graph
+
+    assert [layer['module'] for layer in graph] == [layer['module'] for layer in
+                                                    NetworkGrapher(network, sample_input).graph]
+    assert memory_graph == expected_graph, "Memory graph cache FAILED for " + model_name + " model."
+    assert disk_graph == expected_graph, "Disk graph cache FAILED for " + model_name + " model."
+
+    # A different input shape must not use the cached graph
+    other_grapher = NetworkGrapher(new_network, torch.rand((2,) + tuple(input_shape[1:])))
+    assert other_grapher.get_cache_key() != NetworkGrapher(new_network, sample_input).get_cache_key()
+
+    # Editing the source of the modules' classes (e.g. their forward pass) must not use the cached graph
+    grapher = NetworkGrapher(new_network, sample_input)
+    key = grapher.get_cache_key()
+    with mock.patch('inspect.getsource', side_effect=lambda cls: "edited " + cls.__qualname__):
+        _get_class_source_digest.cache_clear()
+        edited_key = grapher.get_cache_key()
+    _get_class_source_digest.cache_clear()
+    assert edited_key != key and grapher.get_cache_key() == key
+
+    print("Graph cache successful for " + model_name + " model.")
+
+
+def test_fx_graph(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None):
+    """
+        Test that the graph computed by symbolic tracing is the same as the graph computed by the jit trace.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+    """
+    model_name = model_name or network.__class__.__name__
+    network.eval()
+    jit_graph = NetworkGrapher(network, torch.rand(input_shape), use_cache=False).graph
+    fx_graph = NetworkGrapher(network, use_cache=False, backend='fx').graph
+
+    assert fx_graph == jit_graph, "Symbolic graph FAILED for " + model_name + " model."
+
+    print("Symbolic graph successful for " + model_name + " model.")
+
+
+if __name__ == '__main__':
+    from neuralteleportation.models.generic_models.residual_models import ResidualNet2
+    from neuralteleportation.models.generic_models.dense_models import DenseNet3
+    from neuralteleportation.models.model_zoo.resnetcob import resnet18COB
+    from tests.cobmodels_test import MLP
+
+    for model in [MLP, ResidualNet2, DenseNet3]:
+        test_graph_cache(model)
+
+    test_graph_cache(lambda: resnet18COB(num_classes=10), input_shape=(1, 3, 32, 32), model_name="resnet18COB")
+
+    for model in [MLP, ResidualNet2, DenseNet3]:
+        test_fx_graph(model())
+
+    test_fx_graph(resnet18COB(num_classes=10), input_shape=(1, 3, 32, 32), model_name="resnet18COB")
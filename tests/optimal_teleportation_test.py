@@ -0,0 +1,96 @@
+import copy
+import math
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset
+
+from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
+from neuralteleportation.training.config import TrainingMetrics
+from neuralteleportation.training.teleport.optim import (
+    OptimalTeleportationTrainingConfig, teleport_model_to_optimize_metric, loss_lookahead_diff, weighted_grad_norm
+)
+
+
+def test_successive_halving(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None,
+                            num_teleportations: int = 20):
+    """
+        Test that the successive halving search selects the same cob as the exhaustive search for a metric that does
+        not depend on the number of batches, with fewer evaluations of the metric.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+        num_teleportations (int): Number of candidate cobs
+    """
+    model_name = model_name or network.__class__.__name__
+    torch.manual_seed(0)
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape)
+    dataset = TensorDataset(torch.rand((32,) + tuple(input_shape[1:])), torch.randint(0, 10, (32,)))
+    metrics = TrainingMetrics(nn.CrossEntropyLoss(), [])
+
+    nb_batches_evaluated = []
+
+    def cob_metric(model, data, **kwargs):
+        nb_batches_evaluated.append(len(data))
+        return -(model.get_cob() - 1).abs().max().item()
+
+    selected_cobs = []
+    for search in ["exhaustive", "successive_halving"]:
+        config = OptimalTeleportationTrainingConfig(batch_size=4, num_batches=8, num_teleportations=num_teleportations,
+                                                    optim_metric=cob_metric, search=search)
+        np.random.seed(0)
+        selected_cobs.append(teleport_model_to_optimize_metric(copy.deepcopy(model), dataset, metrics, config)
+                             .get_cob())
+
+    exhaustive_cost = (num_teleportations + 1) * 8
+    assert torch.allclose(selected_cobs[0], selected_cobs[1])
+    assert sum(nb_batches_evaluated) - exhaustive_cost < exhaustive_cost
+
+    config = OptimalTeleportationTrainingConfig(optim_metric=cob_metric, search="successive_halving", keep_fraction=0)
+    try:
+        teleport_model_to_optimize_metric(model, dataset, metrics, config)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Successive halving accepted an invalid fraction of candidates to keep.")
+
+    print("Successive halving successful for " + model_name + " model.")
+
+
+def test_optim_metrics(network: nn.Module, input_shape: Tuple = (1, 1, 28, 28), model_name: str = None):
+    """
+        Test that the metrics of the optimal teleportation can be evaluated on the batches of the search without
+        modifying the parameters of the model.
+
+    Args:
+        network (nn.Module): Network to be tested
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+    """
+    model_name = model_name or network.__class__.__name__
+    torch.manual_seed(0)
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape)
+    config = OptimalTeleportationTrainingConfig(optimizer=("SGD", {"lr": 1e-3}))
+    metrics = TrainingMetrics(nn.CrossEntropyLoss(), [])
+    data, target = torch.rand((2, 4) + tuple(input_shape[1:])), torch.randint(0, 10, (2, 4))
+
+    parameters = [parameter.detach().clone() for parameter in model.parameters()]
+    assert loss_lookahead_diff(model, data, target, metrics=metrics, config=config) > 0
+    assert 0 < weighted_grad_norm(model, data, target, metrics=metrics) < math.inf
+    assert all(torch.equal(parameter, saved) for parameter, saved in zip(model.parameters(), parameters))
+
+    print("Optimal teleportation metrics successful for " + model_name + " model.")
+
+
+if __name__ == '__main__':
+    from tests.cobmodels_test import MLP
+    from neuralteleportation.models.model_zoo.resnetcob import resnet18COB
+
+    torch.manual_seed(0)
+    test_successive_halving(MLP())
+    test_optim_metrics(MLP())
+    test_optim_metrics(resnet18COB(num_classes=10).eval(), input_shape=(1, 3, 32, 32), model_name="resnet18COB")
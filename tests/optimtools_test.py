@@ -0,0 +1,67 @@
+import copy
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+from torch import optim
+
+from neuralteleportation.neuralteleportationmodel import NeuralTeleportationModel
+from neuralteleportation.utils.optimtools import teleport_optimizer_state
+
+
+def test_teleport_optimizer_state(network: nn.Module, optimizer_cls: type, input_shape: Tuple = (1, 1, 28, 28),
+                                  model_name: str = None, nb_steps: int = 3, **optimizer_kwargs):
+    """
+        Test that the teleported state of an optimizer is the state that the optimizer would have accumulated on the
+        teleported model.
+
+        The learning rate is zero so that the weights do not change between the steps, and the gradients of the
+        teleported model are the gradients of the model divided by the weight factors.
+
+    Args:
+        network (nn.Module): Network to be tested
+        optimizer_cls (type): class of the optimizer
+        input_shape (tuple): Input shape of network
+        model_name (str): The name or label assigned to differentiate the model
+        nb_steps (int): Number of steps of the optimizer
+        optimizer_kwargs: Arguments of the optimizer, other than the learning rate
+    """
+    model_name = model_name or network.__class__.__name__
+    model = NeuralTeleportationModel(network=network, input_shape=input_shape).eval()
+    loss_fn = nn.CrossEntropyLoss()
+    batches = [(torch.rand((4,) + tuple(input_shape[1:])), torch.randint(0, 10, (4,))) for _ in range(nb_steps)]
+
+    def accumulate_state(model: NeuralTeleportationModel) -> optim.Optimizer:
+        optimizer = optimizer_cls(model.parameters(), lr=0, **optimizer_kwargs)
+        for data, target in batches:
+            optimizer.zero_grad()
+            loss_fn(model(data), target).backward()
+            optimizer.step()
+        return optimizer
+
+    optimizer = accumulate_state(model)
+    cob = model.generate_random_cob(sampling_type='inter_landscape')
+    teleported_model = copy.deepcopy(model).teleport(cob)
+    expected_optimizer = accumulate_state(teleported_model)
+
+    model.teleport(cob)
+    teleport_optimizer_state(optimizer, model.get_weight_factors(cob))
+
+    for param, expected_param in zip(model.parameters(), teleported_model.parameters()):
+        for name, value in optimizer.state[param].items():
+            expected_value = expected_optimizer.state[expected_param][name]
+            assert torch.allclose(value, expected_value, rtol=1e-3, atol=1e-5 * expected_value.abs().max()), \
+                f"Teleported {name} of {optimizer_cls.__name__} FAILED for {model_name} model."
+
+    print(f"Teleported state of {optimizer_cls.__name__} successful for {model_name} model.")
+
+
+if __name__ == '__main__':
+    from tests.cobmodels_test import MLP
+    from neuralteleportation.models.generic_models.residual_models import ResidualNet2
+
+    for network_fn in [MLP, ResidualNet2]:
+        test_teleport_optimizer_state(network_fn(), optim.SGD, momentum=0.9)
+        test_teleport_optimizer_state(network_fn(), optim.Adam)
+        test_teleport_optimizer_state(network_fn(), optim.AdamW, amsgrad=True)
+        test_teleport_optimizer_state(network_fn(), optim.RMSprop, momentum=0.9, centered=True, eps=1e-12)
@@ -0,0 +1,114 @@
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from torch.utils.data import DataLoader
+from torchvision.datasets import VisionDataset
+
+from neuralteleportation.training.tensor_dataset import BatchTransform, TensorCacheDataset
+
+
+class FakeCIFAR(VisionDataset):
+    """Small dataset of random channels last uint8 images, with the attributes of torchvision's CIFAR datasets."""
+
+    def __init__(self, root, train=True, download=False, transform=None):
+        super().__init__(root, transform=transform)
+        generator = np.random.RandomState(0 if train else 1)
+        self.data = generator.randint(0, 256, (20, 8, 8, 3), dtype=np.uint8)
+        self.targets = list(generator.randint(0, 10, 20))
+
+    def __getitem__(self, index):
+        image = transforms.functional.to_pil_image(self.data[index])
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.targets[index]
+
+    def __len__(self):
+        return len(self.data)
+
+
+def test_batch_transform_normalize():
+    """
+        Test that the batch transform without random augmentation gives the same images as the torchvision transform.
+    """
+    transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.4, 0.5, 0.6), (0.2, 0.3, 0.1))])
+    dataset = FakeCIFAR('/tmp', transform=transform)
+    expected = torch.stack([image for image, _ in dataset])
+
+    images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2)
+    assert torch.allclose(BatchTransform.from_transform(transform)(images), expected, atol=1e-5)
+
+    print("Batch transform normalization successful.")
+
+
+def test_batch_transform_crop_and_flip(padding: int = 2):
+    """
+        Test that every image transformed by the random crop and flip of the batch transform is a crop of the padded
+        image, flipped or not.
+
+    Args:
+        padding (int): padding of the images before the random crop.
+    """
+    transform = transforms.Compose([transforms.RandomCrop(8, padding=padding), transforms.RandomHorizontalFlip(),
+                                    transforms.ToTensor()])
+    batch_transform = BatchTransform.from_transform(transform)
+    assert batch_transform.crop_padding == padding and batch_transform.flip_probability == 0.5
+
+    images = torch.from_numpy(FakeCIFAR('/tmp').data).permute(0, 3, 1, 2)
+    padded_images = F.pad(images, [padding] * 4).float() / 255
+    transformed_images = batch_transform(images)
+
+    for padded_image, transformed_image in zip(padded_images, transformed_images):
+        crops = [padded_image[:, i:i + 8, j:j + 8] for i in range(2 * padding + 1) for j in range(2 * padding + 1)]
+        crops += [crop.flip(-1) for crop in crops]
+        assert any(torch.equal(crop, transformed_image) for crop in crops)
+
+    # Crops smaller than the images are not supported
+    transform = transforms.Compose([transforms.RandomCrop(6, padding=padding), transforms.ToTensor()])
+    try:
+        BatchTransform.from_transform(transform)(images)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Batch transform accepted a random crop smaller than the images.")
+
+    print("Batch transform crop and flip successful.")
+
+
+def test_tensor_cache_dataset():
+    """
+        Test that the tensor cache dataset is decoded once in the data root and loads the same samples as the
+        torchvision dataset, with or without workers.
+    """
+    transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.4, 0.5, 0.6), (0.2, 0.3, 0.1))])
+    expected_images, expected_targets = next(iter(DataLoader(FakeCIFAR('/tmp', transform=transform), batch_size=20)))
+
+    with tempfile.TemporaryDirectory() as root:
+        TensorCacheDataset.from_vision_dataset(FakeCIFAR, root, train=True)
+        dataset = TensorCacheDataset.from_vision_dataset(FakeCIFAR, root, train=True, transform=transform)
+        assert isinstance(dataset.images, np.memmap)
+
+        for num_workers in [0, 2]:
+            images, targets = next(iter(DataLoader(dataset, batch_size=20, num_workers=num_workers)))
+            assert torch.allclose(images, expected_images, atol=1e-5)
+            assert torch.equal(targets, expected_targets)
+
+        image, target = dataset[3]
+        assert torch.allclose(image, expected_images[3], atol=1e-5) and target == expected_targets[3]
+
+        try:
+            TensorCacheDataset.from_vision_dataset(FakeCIFAR, root, train=True, transform=transforms.RandomCrop(6))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Tensor cache dataset accepted a random crop smaller than the images.")
+
+    print("Tensor cache dataset successful.")
+
+
+if __name__ == '__main__':
+    test_batch_transform_normalize()
+    test_batch_transform_crop_and_flip()
+    test_tensor_cache_dataset()